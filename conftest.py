@@ -5,6 +5,10 @@ from hypothesis import settings
 from flask import g, request_started
 from inventorius import app as inventorius_flask_app
 from inventorius.db import get_mongo_client
+from inventorius.indexes import ensure_indexes
+import inventorius.autocomplete as autocomplete
+import inventorius.cache as cache
+import inventorius.mirrors as mirrors
 
 
 # give tests longer to complete on ci server
@@ -37,4 +41,10 @@ def clientContext():
     get_mongo_client().testing.bin.drop()
     get_mongo_client().testing.sku.drop()
     get_mongo_client().testing.user.drop()
+    get_mongo_client().testing.stock.drop()
+    get_mongo_client().testing.codes.drop()
+    ensure_indexes(get_mongo_client().testing, refresh=True)
+    autocomplete.reset()
+    cache.clear()
+    mirrors.reset()
     yield inventorius_flask_app.test_client()
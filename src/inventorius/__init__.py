@@ -16,6 +16,7 @@ from flask import Flask
 # from urllib.parse import urlencode
 
 from inventorius.bin import bin
+from inventorius.bulk import bulk
 from inventorius.batch import batch
 from inventorius.inventorius import inventorius
 from inventorius.sku import sku
@@ -23,7 +24,13 @@ from inventorius.sku import sku
 # from inventorius.data_models import Bin, MyEncoder, Uniq, Batch, Sku
 from inventorius.user import user
 from inventorius.util import login_manager, no_cache, principals
-from inventorius.resource_models import StatusEndpoint
+from inventorius.resource_models import HypermediaEndpoint, StatusEndpoint
+from inventorius.cache import cache_stats
+from inventorius.autocomplete import ensure_index
+from inventorius.coherence import ensure_watcher
+from inventorius.db import db, get_mongo_client
+from inventorius.stock import rebuild_stock
+from inventorius.codes import rebuild_codes
 
 import platform
 import os
@@ -56,6 +63,7 @@ BAD_REQUEST = ('Bad Request', 400)
 
 
 app.register_blueprint(bin)
+app.register_blueprint(bulk)
 app.register_blueprint(batch)
 app.register_blueprint(inventorius)
 app.register_blueprint(sku)
@@ -74,13 +82,22 @@ def cors_allow_all(response):
         # TODO: this is a little embarassing, but it will work for now
         print("!!! Using CORS - DEVELOPMENT ------------!!!------- DANGER ---------!!!---------- !!!")
         response.headers['Access-Control-Allow-Origin'] = 'http://localhost:8080'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization,If-Match,If-None-Match'
+        response.headers['Access-Control-Expose-Headers'] = 'ETag'
         response.headers['Access-Control-Allow-Methods'] = 'GET,PUT,POST,PATCH,OPTIONS,DELETE'
 
     return response
 
 
 app.after_request(cors_allow_all)
+
+
+@app.before_request
+def start_background_threads():
+    ensure_watcher(db._get_current_object())
+    ensure_index(db._get_current_object())
+
+
 login_manager.init_app(app)
 principals.init_app(app)
 
@@ -91,3 +108,26 @@ def get_version():
     return StatusEndpoint(
         version="0.3.11"
     ).get_response()
+
+
+@app.route("/api/status/cache", methods=["GET"])
+@no_cache
+def get_cache_status():
+    """Counters of this worker's entity cache."""
+    return HypermediaEndpoint(state=cache_stats()).get_response()
+
+
+@app.cli.command("rebuild-stock")
+def rebuild_stock_command():
+    """Rebuild the stock collection from the contents of every bin."""
+    count = rebuild_stock(get_mongo_client().inventoriusdb)
+    print(f"rebuilt stock collection with {count} rows")
+
+
+@app.cli.command("rebuild-codes")
+def rebuild_codes_command():
+    """Rebuild the codes collection from every sku and batch."""
+    count, conflicts = rebuild_codes(get_mongo_client().inventoriusdb)
+    print(f"rebuilt codes collection with {count} rows")
+    for owner_id, codes in conflicts.items():
+        print(f"{owner_id}: owned codes already owned by another item: {', '.join(codes)}")
@@ -0,0 +1,217 @@
+"""In-memory prefix index of sku and batch codes and names, for autocomplete.
+
+Every worker keeps one `PrefixIndex` per database: a sorted list of
+`(key, value, kind, owner_type, owner_id)` entries, where `key` is the
+casefolded code or name word that is matched and `value` is what is shown
+(the code, or the whole name). A prefix query is a bisect to the first key
+at or after the prefix, then a walk while keys still start with it, so it
+is O(log n + k) for k hits.
+
+The index is built once, from one scan of the skus and batches, by a
+background thread of the worker started with the worker's first request.
+Requests only wait for that first build. From then on it is updated in
+place: writes made by this worker through `index_item` and `forget_item`,
+writes made by other workers through the change stream of
+inventorius.coherence. The thread scans again only when `mark_stale` asks
+it to, e.g. when the coherence watcher may have missed changes. A rebuilt
+index is swapped in at once, with the writes made during its scan applied
+on top.
+"""
+import os
+from bisect import bisect_left, insort
+from threading import Event, Lock, Thread
+
+from pymongo.errors import PyMongoError
+
+CODE = "code"
+NAME = "name"
+
+# how long requests wait for the first build before answering from an
+# empty index, and how soon a failed build is tried again
+first_build_seconds = 10.0
+retry_seconds = 1.0
+
+
+def item_entries(owner_type, owner_id, name=None, owned_codes=(), associated_codes=()):
+    entries = set()
+    for code in [*(owned_codes or ()), *(associated_codes or ())]:
+        entries.add((code.casefold(), code, CODE, owner_type, owner_id))
+    if name:
+        for word in name.casefold().split():
+            entries.add((word, name, NAME, owner_type, owner_id))
+    return entries
+
+
+class PrefixIndex:
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = []
+        # owner_id -> entries of that item, to replace them on update
+        self.item_entries = {}
+        # owner_id -> entries (None once deleted) written during a rebuild
+        self.pending = None
+        self.built = Event()
+
+    def rebuild(self, database):
+        with self.lock:
+            self.pending = {}
+        try:
+            item_entries = {}
+            for owner_type in ("sku", "batch"):
+                for doc in database[owner_type].find(
+                        {}, {"name": 1, "owned_codes": 1, "associated_codes": 1}):
+                    item_entries[doc["_id"]] = item_entries_of_doc(owner_type, doc)
+            entries = sorted(entry for item in item_entries.values() for entry in item)
+        except BaseException:
+            with self.lock:
+                self.pending = None
+            raise
+        with self.lock:
+            pending, self.pending = self.pending, None
+            self.entries = entries
+            self.item_entries = item_entries
+            # the scan may have read these items before they were written
+            for owner_id, written in pending.items():
+                self._replace(owner_id, written)
+        self.built.set()
+
+    def replace_item(self, owner_id, entries):
+        with self.lock:
+            if self.pending is not None:
+                self.pending[owner_id] = entries
+            self._replace(owner_id, entries)
+
+    def _replace(self, owner_id, entries):
+        for entry in self.item_entries.pop(owner_id, ()):
+            index = bisect_left(self.entries, entry)
+            if index < len(self.entries) and self.entries[index] == entry:
+                del self.entries[index]
+        if entries:
+            self.item_entries[owner_id] = entries
+            for entry in entries:
+                insort(self.entries, entry)
+
+    def complete(self, prefix, limit):
+        """Up to `limit` hits for `prefix`, ordered by key, one per shown value."""
+        key = prefix.casefold()
+        hits = []
+        seen = set()
+        with self.lock:
+            index = bisect_left(self.entries, (key,))
+            while index < len(self.entries) and len(hits) < limit:
+                entry_key, value, kind, owner_type, owner_id = self.entries[index]
+                if not entry_key.startswith(key):
+                    break
+                index += 1
+                if (value, owner_id) in seen:
+                    continue
+                seen.add((value, owner_id))
+                hits.append({"value": value, "kind": kind,
+                             "type": owner_type, "id": owner_id})
+        return hits
+
+
+def item_entries_of_doc(owner_type, doc):
+    return item_entries(owner_type, doc["_id"], doc.get("name"),
+                        doc.get("owned_codes"), doc.get("associated_codes"))
+
+
+class IndexRefresher(Thread):
+    """Builds one PrefixIndex, then rebuilds it each time it is woken."""
+
+    def __init__(self, database, index):
+        super().__init__(name=f"autocomplete-{database.name}", daemon=True)
+        self.database = database
+        self.index = index
+        self.wake = Event()
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.index.rebuild(self.database)
+            except PyMongoError as e:
+                print(f"autocomplete index of {self.database.name} not rebuilt: {e}")
+                self.stopped.wait(retry_seconds)
+                continue
+            self.wake.wait()
+            self.wake.clear()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+
+# (id(client), database name) -> (pid, PrefixIndex, IndexRefresher); the pid
+# makes a forked worker build its own index with its own thread
+_indexes = {}
+_indexes_lock = Lock()
+
+
+def _database_key(database):
+    return (id(database.client), database.name)
+
+
+def _entry(database):
+    entry = _indexes.get(_database_key(database))
+    if entry is not None and entry[0] == os.getpid():
+        return entry
+    return None
+
+
+def ensure_index(database):
+    """The PrefixIndex of `database`, with a thread of this process keeping
+    it built. Cheap once the thread runs, so it is called on every request."""
+    entry = _entry(database)
+    if entry is None:
+        with _indexes_lock:
+            entry = _entry(database)
+            if entry is None:
+                index = PrefixIndex()
+                refresher = IndexRefresher(database, index)
+                refresher.start()
+                entry = _indexes[_database_key(database)] = (os.getpid(), index, refresher)
+    return entry[1]
+
+
+def prefix_index(database):
+    """The PrefixIndex of `database`, once its first build is in."""
+    index = ensure_index(database)
+    index.built.wait(first_build_seconds)
+    return index
+
+
+def index_item(database, owner_type, item):
+    """Updates the entries of a written Sku or Batch, if there is an index."""
+    entry = _entry(database)
+    if entry is not None:
+        entry[1].replace_item(item.id, item_entries(
+            owner_type, item.id, item.name, item.owned_codes, item.associated_codes))
+
+
+def index_doc(database, owner_type, doc):
+    """Like `index_item`, for a raw sku or batch document."""
+    entry = _entry(database)
+    if entry is not None:
+        entry[1].replace_item(doc["_id"], item_entries_of_doc(owner_type, doc))
+
+
+def mark_stale(database):
+    """Has the index of `database` rebuilt now, in the background."""
+    entry = _entry(database)
+    if entry is not None:
+        entry[2].wake.set()
+
+
+def forget_item(database, owner_id):
+    entry = _entry(database)
+    if entry is not None:
+        entry[1].replace_item(owner_id, None)
+
+
+def reset():
+    """Drops every index, e.g. after the collections were dropped."""
+    with _indexes_lock:
+        for _, _, refresher in _indexes.values():
+            refresher.stop()
+        _indexes.clear()
@@ -9,8 +9,14 @@ from inventorius.validation import new_batch_schema, batch_patch_schema, prefixe
 from voluptuous import All, Required
 import inventorius.util_error_responses as problem
 import inventorius.util_success_responses as success
-
-from pymongo import TEXT
+from inventorius.autocomplete import forget_item, index_item
+from inventorius.cache import document_exists, invalidate
+from inventorius.revisions import (
+    REV_KEY, bump_rev, if_match_allows, if_match_query, rev_etag, with_rev)
+from inventorius.codes import (
+    code_changes, owned_code_conflict_reason, register_codes, unregister_codes)
+
+from pymongo import ReturnDocument
 from bson.decimal128 import Decimal128
 
 import json
@@ -33,29 +39,29 @@ def batches_post():
         return problem.duplicate_resource_response("id")
 
     if batch.sku_id:
-        existing_sku = db.sku.find_one({"_id": batch.sku_id})
-        if not existing_sku:
+        if not document_exists(db, "sku", batch.sku_id):
             return problem.invalid_params_response(problem.missing_resource_param_error("sku_id", "must be an existing sku id"))
 
+    conflicts = register_codes(
+        db, "batch", [(batch.id, batch.owned_codes, batch.associated_codes)])
+    if conflicts:
+        return problem.duplicate_resource_response(
+            "owned_codes", owned_code_conflict_reason(conflicts[batch.id]))
     admin_increment_code("BAT", batch.id)
-    db.batch.insert_one(batch.to_mongodb_doc())
-
-    # Add text index if not yet created
-    # TODO: This should probably be turned into a global flag
-    if "name_text" not in db.batch.index_information().keys():
-        db.sku.create_index([("name", TEXT)])
+    db.batch.insert_one(with_rev(batch.to_mongodb_doc()))
+    index_item(db, "batch", batch)
 
     return BatchEndpoint.from_batch(batch).created_success_response()
 
 
 @batch.route("/api/batch/<id>", methods=["GET"])
 def batch_get(id):
-    existing = Batch.from_mongodb_doc(db.batch.find_one({"_id": id}))
+    resp = BatchEndpoint.cached_get_response(id)
 
-    if not existing:
+    if resp is None:
         return problem.missing_batch_response(id)
     else:
-        return BatchEndpoint.from_batch(existing).get_response()
+        return resp
 
 
 @batch.route("/api/batch/<id>", methods=["PATCH"])
@@ -69,45 +75,51 @@ def batch_patch(id):
     except MultipleInvalid as e:
         return problem.invalid_params_response(e)
 
-    existing_batch = Batch.from_mongodb_doc(db.batch.find_one({"_id": id}))
-    if not existing_batch:
-        return problem.missing_batch_response(id)
-
     if json.get("sku_id"):
-        existing_sku = db.sku.find_one({"_id": json['sku_id']})
-        if not existing_sku:
+        if not document_exists(db, "sku", json['sku_id']):
+            if not db.batch.find_one({"_id": id}, {"_id": 1}):
+                return problem.missing_batch_response(id)
             return problem.invalid_params_response(problem.missing_resource_param_error("sku_id", "must be an existing sku id"))
 
-    if (existing_batch.sku_id
-        and "sku_id" in json
-        and existing_batch.sku_id != json["sku_id"]
-            and not forced):
+    codes_changed = "owned_codes" in json or "associated_codes" in json
+    if codes_changed:
+        old_codes = db.batch.find_one(
+            {"_id": id}, {"owned_codes": 1, "associated_codes": 1})
+        if not old_codes:
+            return problem.missing_batch_response(id)
+        new_codes, added_codes, removed_codes = code_changes(old_codes, json)
+        conflicts = register_codes(db, "batch", [(id, *new_codes)])
+        if conflicts:
+            return problem.duplicate_resource_response(
+                "owned_codes", owned_code_conflict_reason(conflicts[id]))
+
+    query = {"_id": id, **if_match_query(request.if_match)}
+    if "sku_id" in json and not forced:
+        # a set sku can only be changed with force=true
+        query["sku_id"] = {"$in": [None, "", json["sku_id"]]}
+
+    update = Batch.patch_to_mongodb_update(json)
+    if update:
+        updated_batch = Batch.from_mongodb_doc(db.batch.find_one_and_update(
+            query, bump_rev(update), return_document=ReturnDocument.AFTER))
+    else:
+        updated_batch = Batch.from_mongodb_doc(db.batch.find_one(query))
+
+    if not updated_batch:
+        if codes_changed:
+            unregister_codes(db, id, *added_codes)
+        current = db.batch.find_one({"_id": id}, {REV_KEY: 1})
+        if not current:
+            return problem.missing_batch_response(id)
+        if not if_match_allows(request.if_match, current.get(REV_KEY)):
+            return problem.precondition_failed_response(
+                url_for("batch.batch_get", id=id), rev_etag(current.get(REV_KEY)))
         return problem.dangerous_operation_unforced_response("sku_id", "The sku of this batch has already been set. Can not change without force=true.")
+    invalidate(db, "batch", id)
+    if codes_changed:
+        unregister_codes(db, id, *removed_codes)
+    index_item(db, "batch", updated_batch)
 
-    new_batch_doc = Batch.from_json({"_id": id, **json}).to_mongodb_doc()
-
-    if "props" in json.keys():
-        db.batch.update_one({"_id": id},
-                            {"$set": {"props": new_batch_doc['props']}})
-    if "name" in json.keys():
-        db.batch.update_one({"_id": id},
-                            {"$set": {"name": new_batch_doc['name']}})
-
-    if "sku_id" in json.keys():
-        if not json["sku_id"]:
-            db.batch.update_one({"_id": id}, {"$unset": {"sku_id": ""}})
-        else:
-            db.batch.update_one({"_id": id},
-                                {"$set": {"sku_id": json['sku_id']}})
-
-    if "owned_codes" in json.keys():
-        db.batch.update_one({"_id": id},
-                            {"$set": {"owned_codes": json['owned_codes']}})
-    if "associated_codes" in json.keys():
-        db.batch.update_one({"_id": id},
-                            {"$set": {"associated_codes": json['associated_codes']}})
-
-    updated_batch = Batch.from_mongodb_doc(db.batch.find_one({"_id": id}))
     return BatchEndpoint.from_batch(updated_batch).redirect_response(False)
 
 
@@ -119,14 +131,15 @@ def batch_delete(id):
         return problem.missing_batch_response(id)
     else:
         db.batch.delete_one({"_id": id})
+        invalidate(db, "batch", id)
+        unregister_codes(db, id)
+        forget_item(db, id)
         return BatchEndpoint.from_batch(existing).deleted_success_response()
 
 
 @batch.route("/api/batch/<id>/bins", methods=["GET"])
 def batch_bins_get(id):
     resp = Response()
-    existing = Batch.from_mongodb_doc(db.batch.find_one({"_id": id}))
-
-    if not existing:
+    if not document_exists(db, "batch", id):
         return problem.missing_batch_response(id)
     return BatchBinsEndpoint.from_id(id, retrieve=True).get_response()
@@ -1,8 +1,12 @@
 from flask import Blueprint, request, Response, url_for, after_this_request
 from voluptuous.error import MultipleInvalid
 from inventorius.data_models import Bin, DataModelJSONEncoder as Encoder
-from inventorius.db import db
+from inventorius.cache import invalidate
+from inventorius.db import db, raw_collection
 from inventorius.resource_models import BinEndpoint
+from inventorius.revisions import (
+    REV_KEY, bump_rev, if_match_allows, if_match_query, rev_etag, with_rev)
+from inventorius.stock import remove_bin_stock
 from inventorius.util import get_body_type, admin_increment_code, no_cache
 import inventorius.util_error_responses as problem
 import inventorius.util_success_responses as success
@@ -27,17 +31,17 @@ def bins_post():
 
     bin = Bin.from_json(json)
     admin_increment_code("BIN", bin.id)
-    db.bin.insert_one(bin.to_mongodb_doc())
+    db.bin.insert_one(with_rev(bin.to_mongodb_doc()))
     return BinEndpoint.from_bin(bin).created_success_response()
 
 
 @bin.route('/api/bin/<id>', methods=['GET'])
 def bin_get(id):
-    existing = Bin.from_mongodb_doc(db.bin.find_one({"_id": id}))
-    if existing is None:
+    resp = BinEndpoint.cached_get_response(id)
+    if resp is None:
         return problem.missing_bin_response(id)
     else:
-        return BinEndpoint.from_bin(existing).get_response()
+        return resp
 
 
 @bin.route('/api/bin/<id>', methods=['PATCH'])
@@ -48,13 +52,26 @@ def bin_patch(id):
     except MultipleInvalid as e:
         return problem.invalid_params_response(e)
 
-    existing = Bin.from_mongodb_doc(db.bin.find_one({"_id": id}))
+    # only the id and revision are read, so contents and props stay undecoded
+    doc = raw_collection(db.bin).find_one({"_id": id})
+    existing = Bin.from_raw_bson(doc)
     if existing is None:
-        problem.missing_bin_response(id)
+        return problem.missing_bin_response(id)
+    if not if_match_allows(request.if_match, doc.get(REV_KEY)):
+        return problem.precondition_failed_response(
+            url_for("bin.bin_get", id=id), rev_etag(doc.get(REV_KEY)))
 
     if "props" in json.keys():
-        db.bin.update_one({"_id": id},
-                          {"$set": {"props": json['props']}})
+        result = db.bin.update_one({"_id": id, **if_match_query(request.if_match)},
+                                   bump_rev({"$set": {"props": json['props']}}))
+        if result.matched_count == 0:
+            # changed or deleted since it was read
+            current = db.bin.find_one({"_id": id}, {REV_KEY: 1})
+            if current is None:
+                return problem.missing_bin_response(id)
+            return problem.precondition_failed_response(
+                url_for("bin.bin_get", id=id), rev_etag(current.get(REV_KEY)))
+        invalidate(db, "bin", id)
 
     return BinEndpoint.from_bin(existing).updated_success_response()
 
@@ -62,12 +79,14 @@ def bin_patch(id):
 @bin.route('/api/bin/<id>', methods=['DELETE'])
 @no_cache
 def bin_delete(id):
-    existing = Bin.from_mongodb_doc(db.bin.find_one({"_id": id}))
+    existing = Bin.from_raw_bson(raw_collection(db.bin).find_one({"_id": id}))
     if existing is None:
         return problem.missing_bin_response(id)
         
     if request.args.get('force', 'false') == 'true' or len(existing.contents.keys()) == 0:
         db.bin.delete_one({"_id": id})
+        invalidate(db, "bin", id)
+        remove_bin_stock(db, id)
         return success.bin_deleted_response(id)
     else:
         return problem.dangerous_operation_unforced_response("id", "bin must be empty")
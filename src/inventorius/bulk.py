@@ -0,0 +1,534 @@
+from flask import Blueprint, request, url_for
+from voluptuous import Optional
+from voluptuous.error import Invalid, MultipleInvalid
+from bson import encode
+from bson.errors import InvalidDocument
+from bson.raw_bson import RawBSONDocument
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import json
+
+from inventorius.data_models import Batch, Bin, Sku
+from inventorius.db import db, supports_transactions
+from inventorius.resource_models import HypermediaEndpoint
+from inventorius.stock import adjust_stock
+from inventorius.autocomplete import index_item
+from inventorius.cache import invalidate
+from inventorius.codes import add_code_rows, owned_code_conflict_reason, remove_code_rows
+from inventorius.revisions import bump_rev, with_rev
+from inventorius.util import admin_increment_code, allocate_codes, code_number, no_cache
+from inventorius.validation import (
+    prefixed_id, bulk_create_schema, bulk_lines_schema, bulk_move_line_schema, bulk_receive_line_schema,
+    new_batch_schema, new_bin_schema, new_sku_schema)
+import inventorius.util_error_responses as problem
+
+bulk = Blueprint("bulk", __name__)
+
+
+def existing_ids(collection, ids):
+    """Returns the subset of ids that exist in collection, in one query."""
+    if not ids:
+        return set()
+    return {doc["_id"] for doc in collection.find({"_id": {"$in": list(ids)}}, {"_id": 1})}
+
+
+def existing_item_ids(item_ids):
+    return (existing_ids(db.sku, {id for id in item_ids if id.startswith("SKU")})
+            | existing_ids(db.batch, {id for id in item_ids if id.startswith("BAT")}))
+
+
+def line_invalid_result(line_number, error):
+    return {
+        "line": line_number,
+        "status": 400,
+        "type": "validation-error",
+        "title": problem.problem_titles["validation-error"],
+        "invalid-params": problem.invalid_params(error),
+    }
+
+
+def line_missing_result(line_number, uri):
+    return {
+        "line": line_number,
+        "status": 404,
+        "type": "missing-resource",
+        "title": problem.problem_titles["missing-resource"],
+        "Id": uri,
+    }
+
+
+def item_uri(item_id):
+    if item_id.startswith("SKU"):
+        return url_for("sku.sku_get", id=item_id)
+    return url_for("batch.batch_get", id=item_id)
+
+
+def line_duplicate_result(line_number, name="id", reason="must not already exist"):
+    return {
+        "line": line_number,
+        "status": 409,
+        "type": "duplicate-resource",
+        "title": problem.problem_titles["duplicate-resource"],
+        "invalid-params": [{"name": name, "reason": reason}],
+    }
+
+
+def line_insufficient_result(line_number, availible, requested):
+    return {
+        "line": line_number,
+        "status": 405,
+        "type": "insufficient-quantity",
+        "title": problem.problem_titles["insufficient-quantity"],
+        "invalid-params": [{
+            "name": "quantity",
+            "reason": f"requested {requested} in total, but only {availible} is availible",
+        }],
+    }
+
+
+def bulk_response(endpoint, results, succeeded):
+    return HypermediaEndpoint(
+        resource_uri=url_for(endpoint),
+        state={
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "results": results,
+        }
+    ).get_response(200)
+
+
+@bulk.route("/api/bulk/receive", methods=["POST"])
+@no_cache
+def bulk_receive_post():
+    """Receives a list of `{"bin_id", "id", "quantity"}` lines.
+
+    Every line is validated and checked on its own and gets its own result.
+    Existence is checked with one $in query per collection and all
+    increments go to the database in one unordered bulk write."""
+    try:
+        lines = bulk_lines_schema(request.json)
+    except MultipleInvalid as e:
+        return problem.invalid_params_response(e)
+
+    results = [None] * len(lines)
+    valid_lines = []
+    for line_number, line in enumerate(lines):
+        try:
+            valid_lines.append((line_number, bulk_receive_line_schema(line)))
+        except MultipleInvalid as e:
+            results[line_number] = line_invalid_result(line_number, e)
+
+    bin_ids = existing_ids(db.bin, {line["bin_id"] for _, line in valid_lines})
+    item_ids = existing_item_ids({line["id"] for _, line in valid_lines})
+
+    # bin_id -> {item_id: quantity}
+    increments = {}
+    received_lines = []
+    for line_number, line in valid_lines:
+        if line["bin_id"] not in bin_ids:
+            results[line_number] = line_missing_result(
+                line_number, url_for("bin.bin_get", id=line["bin_id"]))
+        elif line["id"] not in item_ids:
+            results[line_number] = line_missing_result(line_number, item_uri(line["id"]))
+        else:
+            bin_increments = increments.setdefault(line["bin_id"], {})
+            bin_increments[line["id"]] = bin_increments.get(line["id"], 0) + line["quantity"]
+            received_lines.append((line_number, line))
+
+    if increments:
+        result = db.bin.bulk_write([
+            UpdateOne({"_id": bin_id}, bump_rev({"$inc": {
+                f"contents.{item_id}": quantity for item_id, quantity in bin_increments.items()}}))
+            for bin_id, bin_increments in increments.items()
+        ], ordered=False)
+        invalidate(db, "bin", *increments)
+        if result.matched_count < len(increments):
+            # some bins were deleted after the existence check
+            bin_ids = existing_ids(db.bin, increments.keys())
+        adjust_stock(db, [
+            (item_id, bin_id, quantity)
+            for bin_id, bin_increments in increments.items() if bin_id in bin_ids
+            for item_id, quantity in bin_increments.items()])
+
+    succeeded = 0
+    for line_number, line in received_lines:
+        if line["bin_id"] in bin_ids:
+            results[line_number] = {"line": line_number, "status": 201, "title": "items received"}
+            succeeded += 1
+        else:
+            results[line_number] = line_missing_result(
+                line_number, url_for("bin.bin_get", id=line["bin_id"]))
+
+    return bulk_response("bulk.bulk_receive_post", results, succeeded)
+
+
+def move_bin_updates(outgoing, incoming):
+    """Bin updates applying a pick list: one $inc per bin, then the unsets of
+    quantities that may have dropped to zero."""
+    increments = {}
+    for (bin_id, item_id), quantity in outgoing.items():
+        bin_increments = increments.setdefault(bin_id, {})
+        bin_increments[item_id] = bin_increments.get(item_id, 0) - quantity
+    for (bin_id, item_id), quantity in incoming.items():
+        bin_increments = increments.setdefault(bin_id, {})
+        bin_increments[item_id] = bin_increments.get(item_id, 0) + quantity
+
+    requests = [
+        UpdateOne({"_id": bin_id}, bump_rev({"$inc": {
+            f"contents.{item_id}": delta for item_id, delta in bin_increments.items() if delta}}))
+        for bin_id, bin_increments in increments.items()
+        if any(bin_increments.values())]
+    requests += [
+        UpdateOne({"_id": bin_id, f"contents.{item_id}": 0},
+                  bump_rev({"$unset": {f"contents.{item_id}": ""}}))
+        for bin_id, item_id in outgoing]
+    stock_changes = [
+        (item_id, bin_id, delta)
+        for bin_id, bin_increments in increments.items()
+        for item_id, delta in bin_increments.items() if delta]
+    return requests, stock_changes
+
+
+# attempts of a guarded move whose source kept changing under it
+MOVE_ATTEMPTS = 5
+
+
+class MoveOutcome:
+    """Why a pick list was not applied; all empty when it was."""
+
+    def __init__(self, shortfalls=None, missing_bins=(), conflicted_sources=()):
+        # {(source, item_id): availible}
+        self.shortfalls = shortfalls or {}
+        self.missing_bins = set(missing_bins)
+        # sources that had enough items, but changed while they were taken from
+        self.conflicted_sources = set(conflicted_sources)
+
+    @property
+    def failed(self):
+        return bool(self.shortfalls or self.missing_bins or self.conflicted_sources)
+
+
+def move_in_transaction(outgoing, incoming):
+    """Checks and applies a pick list in one transaction.
+
+    Returns a MoveOutcome; nothing is written when it failed."""
+    requests, stock_changes = move_bin_updates(outgoing, incoming)
+
+    def check_and_write(session):
+        bin_ids = list({bin_id for bin_id, _ in [*outgoing, *incoming]})
+        projection = {f"contents.{item_id}": 1 for _, item_id in outgoing}
+        found = {doc["_id"]: doc.get("contents", {}) for doc in db.bin.find(
+            {"_id": {"$in": bin_ids}}, projection, session=session)}
+        shortfalls = {}
+        for (source, item_id), quantity in outgoing.items():
+            availible = found.get(source, {}).get(item_id, 0)
+            if source in found and availible < quantity:
+                shortfalls[(source, item_id)] = availible
+        outcome = MoveOutcome(shortfalls, set(bin_ids) - set(found))
+        if outcome.failed:
+            return outcome
+        db.bin.bulk_write(requests, session=session)
+        adjust_stock(db, stock_changes, session=session)
+        return outcome
+
+    with db.client.start_session() as session:
+        return session.with_transaction(check_and_write)
+
+
+def return_to_sources(by_source, sources):
+    if sources:
+        db.bin.bulk_write([
+            UpdateOne({"_id": source}, bump_rev({"$inc": {
+                f"contents.{item_id}": quantity for item_id, quantity in by_source[source].items()}}))
+            for source in sources])
+
+
+def guarded_move_attempt(by_source, outgoing, incoming):
+    """One try of move_with_guarded_updates. Everything written is undone
+    unless the returned MoveOutcome is a success."""
+    taken = []
+    for source, items in by_source.items():
+        query = {"_id": source}
+        for item_id, quantity in items.items():
+            query[f"contents.{item_id}"] = {"$gte": quantity}
+        result = db.bin.update_one(query, bump_rev({"$inc": {
+            f"contents.{item_id}": -quantity for item_id, quantity in items.items()}}))
+        if result.matched_count == 0:
+            return_to_sources(by_source, taken)
+            doc = db.bin.find_one({"_id": source}, {f"contents.{item_id}": 1 for item_id in items})
+            if doc is None:
+                return MoveOutcome(missing_bins=[source])
+            contents = doc.get("contents", {})
+            shortfalls = {(source, item_id): contents.get(item_id, 0)
+                          for item_id, quantity in items.items()
+                          if contents.get(item_id, 0) < quantity}
+            # enough items again means a concurrent write got in between
+            return MoveOutcome(shortfalls, conflicted_sources=() if shortfalls else [source])
+        taken.append(source)
+
+    increments, stock_changes = move_bin_updates({}, incoming)
+    result = db.bin.bulk_write(increments)
+    if result.matched_count < len(increments):
+        # destinations deleted after the existence check: put everything back
+        destinations = {bin_id for bin_id, _ in incoming}
+        existing = existing_ids(db.bin, destinations)
+        return_to_sources(by_source, taken)
+        undo, _ = move_bin_updates(
+            {key: quantity for key, quantity in incoming.items() if key[0] in existing}, {})
+        if undo:
+            db.bin.bulk_write(undo)
+        return MoveOutcome(missing_bins=destinations - existing)
+
+    db.bin.bulk_write([
+        UpdateOne({"_id": source, f"contents.{item_id}": 0},
+                  bump_rev({"$unset": {f"contents.{item_id}": ""}}))
+        for source, item_id in outgoing])
+    adjust_stock(db, [(item_id, source, -quantity) for (source, item_id), quantity in outgoing.items()]
+                 + stock_changes)
+    return MoveOutcome()
+
+
+def move_with_guarded_updates(outgoing, incoming):
+    """Applies a pick list without a transaction.
+
+    Each source bin is decremented by one update guarded on every
+    quantity taken from it. When a guard fails the earlier decrements are
+    undone. The destinations are then incremented in one bulk_write; if a
+    destination is gone, every decrement and increment is undone. An
+    attempt that failed only because a source changed under it is retried,
+    MOVE_ATTEMPTS times at most. Returns a MoveOutcome like
+    move_in_transaction."""
+    by_source = {}
+    for (source, item_id), quantity in outgoing.items():
+        by_source.setdefault(source, {})[item_id] = quantity
+
+    for _ in range(MOVE_ATTEMPTS):
+        outcome = guarded_move_attempt(by_source, outgoing, incoming)
+        if not outcome.conflicted_sources:
+            break
+    return outcome
+
+
+@bulk.route("/api/bulk/move", methods=["POST"])
+@no_cache
+def bulk_move_post():
+    """Applies a pick list of `{"source", "destination", "id", "quantity"}` lines.
+
+    The list is applied completely or not at all. All moves out of the same
+    source bin are checked against what the bin holds before the request.
+    On a rejected list, the lines at fault carry their problem and the
+    others report status 409."""
+    try:
+        lines = bulk_lines_schema(request.json)
+    except MultipleInvalid as e:
+        return problem.invalid_params_response(e)
+
+    results = [None] * len(lines)
+    valid_lines = []
+    for line_number, line in enumerate(lines):
+        try:
+            valid_lines.append((line_number, bulk_move_line_schema(line)))
+        except MultipleInvalid as e:
+            results[line_number] = line_invalid_result(line_number, e)
+
+    bin_ids = existing_ids(db.bin, {line[end] for _, line in valid_lines
+                                    for end in ("source", "destination")})
+    item_ids = existing_item_ids({line["id"] for _, line in valid_lines})
+    for line_number, line in valid_lines:
+        if line["source"] not in bin_ids:
+            results[line_number] = line_missing_result(
+                line_number, url_for("bin.bin_get", id=line["source"]))
+        elif line["destination"] not in bin_ids:
+            results[line_number] = line_missing_result(
+                line_number, url_for("bin.bin_get", id=line["destination"]))
+        elif line["id"] not in item_ids:
+            results[line_number] = line_missing_result(line_number, item_uri(line["id"]))
+
+    if not any(results):
+        # (bin_id, item_id) -> quantity
+        outgoing = {}
+        incoming = {}
+        for _, line in valid_lines:
+            source_key = (line["source"], line["id"])
+            destination_key = (line["destination"], line["id"])
+            outgoing[source_key] = outgoing.get(source_key, 0) + line["quantity"]
+            incoming[destination_key] = incoming.get(destination_key, 0) + line["quantity"]
+
+        if supports_transactions(db.client):
+            outcome = move_in_transaction(outgoing, incoming)
+        else:
+            outcome = move_with_guarded_updates(outgoing, incoming)
+        # the guarded updates may have written and undone decrements
+        invalidate(db, "bin", *{bin_id for bin_id, _ in [*outgoing, *incoming]})
+
+        for line_number, line in valid_lines:
+            source_key = (line["source"], line["id"])
+            if line["source"] in outcome.missing_bins:
+                results[line_number] = line_missing_result(
+                    line_number, url_for("bin.bin_get", id=line["source"]))
+            elif line["destination"] in outcome.missing_bins:
+                results[line_number] = line_missing_result(
+                    line_number, url_for("bin.bin_get", id=line["destination"]))
+            elif source_key in outcome.shortfalls:
+                results[line_number] = line_insufficient_result(
+                    line_number, outcome.shortfalls[source_key], outgoing[source_key])
+            elif line["source"] in outcome.conflicted_sources:
+                results[line_number] = {"line": line_number, "status": 409,
+                                        "title": "not moved, the source bin changed meanwhile"}
+        if not outcome.failed:
+            results = [{"line": line_number, "status": 200, "title": "items moved"}
+                       for line_number in range(len(lines))]
+            return bulk_response("bulk.bulk_move_post", results, len(lines))
+
+    results = [result or {"line": line_number, "status": 409,
+                          "title": "not moved, other lines of the pick list failed"}
+               for line_number, result in enumerate(results)]
+    return bulk_response("bulk.bulk_move_post", results, 0)
+
+
+def request_items():
+    """Returns the items of a JSON array or NDJSON (application/x-ndjson) body.
+
+    NDJSON lines that do not parse are kept as strings, so they fail
+    validation with their line number."""
+    if request.mimetype == "application/x-ndjson":
+        items = []
+        for text in request.get_data(as_text=True).splitlines():
+            if not text.strip():
+                continue
+            try:
+                items.append(json.loads(text))
+            except ValueError:
+                items.append(text)
+        return items
+    return request.json
+
+
+def create_many(endpoint, collection, model_type, prefix, schema, get_endpoint,
+                check_references=None, codes_owner_type=None):
+    """Validates and inserts every item of the request body.
+
+    Items are validated first; the valid items without an id then get one
+    from a single block reservation. Items that can't be stored as BSON
+    (e.g. an int beyond 64 bits in their props) fail on their own line. The id
+    counter of `prefix` is advanced once, past the largest id in the
+    request, and the documents go out in one unordered insert_many, so a
+    duplicate only fails its own item. With `codes_owner_type` the items
+    claim their codes in one bulk write before they are inserted, like a
+    single POST does; items whose owned codes are taken are not inserted,
+    and the rows of items whose insert failed are removed again."""
+    try:
+        items = bulk_create_schema(request_items())
+    except MultipleInvalid as e:
+        return problem.invalid_params_response(e)
+
+    results = [None] * len(items)
+    # ids are allocated after validation, so invalid items don't use any up
+    id_optional_schema = schema.extend({Optional("id"): prefixed_id(prefix)})
+    valid = []
+    for line_number, item in enumerate(items):
+        try:
+            valid.append((line_number, id_optional_schema(item)))
+        except MultipleInvalid as e:
+            results[line_number] = line_invalid_result(line_number, e)
+    without_id = [item for _, item in valid if "id" not in item]
+    if without_id:
+        for item, code in zip(without_id, allocate_codes(prefix, len(without_id))):
+            item["id"] = code
+
+    models = []
+    docs = {}
+    for line_number, item in valid:
+        model = model_type.from_json(item)
+        try:
+            # encoded once here, and inserted as is
+            docs[line_number] = RawBSONDocument(encode(with_rev(model.to_mongodb_doc())))
+        except (OverflowError, InvalidDocument) as e:
+            results[line_number] = line_invalid_result(
+                line_number, MultipleInvalid([Invalid(f"can not be stored: {e}", ["props"])]))
+            continue
+        models.append((line_number, model))
+    if check_references:
+        models = check_references(models, results)
+    if not models:
+        return bulk_response(endpoint, results, 0)
+
+    admin_increment_code(prefix, max((model.id for _, model in models), key=code_number))
+
+    if codes_owner_type:
+        # a taken or repeated id fails before its codes are claimed, so the
+        # rows of the item that has the id are never touched
+        taken_ids = existing_ids(collection, {model.id for _, model in models})
+        unique = []
+        for line_number, model in models:
+            if model.id in taken_ids:
+                results[line_number] = line_duplicate_result(line_number)
+            else:
+                taken_ids.add(model.id)
+                unique.append((line_number, model))
+        conflicts, added_rows = add_code_rows(db, codes_owner_type, [
+            (model.id, model.owned_codes, model.associated_codes) for _, model in unique])
+        models = []
+        for line_number, model in unique:
+            if model.id in conflicts:
+                results[line_number] = line_duplicate_result(
+                    line_number, "owned_codes", owned_code_conflict_reason(conflicts[model.id]))
+            else:
+                models.append((line_number, model))
+        if not models:
+            return bulk_response(endpoint, results, 0)
+
+    try:
+        collection.insert_many([docs[line_number] for line_number, _ in models], ordered=False)
+        write_errors = {}
+    except BulkWriteError as e:
+        write_errors = {error["index"]: error for error in e.details["writeErrors"]}
+
+    if codes_owner_type and write_errors:
+        remove_code_rows(db, [row_id for index in write_errors
+                              for row_id in added_rows.get(models[index][1].id, ())])
+
+    for index, (line_number, model) in enumerate(models):
+        error = write_errors.get(index)
+        if error is None:
+            results[line_number] = {"line": line_number, "status": 201, "title": "created",
+                                    "Id": url_for(get_endpoint, id=model.id)}
+            if codes_owner_type:
+                index_item(db, codes_owner_type, model)
+        elif error["code"] == 11000:
+            results[line_number] = line_duplicate_result(line_number)
+        else:
+            results[line_number] = {"line": line_number, "status": 500, "title": error["errmsg"]}
+    return bulk_response(endpoint, results, len(models) - len(write_errors))
+
+
+def check_batch_skus(models, results):
+    sku_ids = existing_ids(db.sku, {batch.sku_id for _, batch in models if batch.sku_id})
+    checked = []
+    for line_number, batch in models:
+        if batch.sku_id and batch.sku_id not in sku_ids:
+            results[line_number] = line_invalid_result(line_number, problem.missing_resource_param_error(
+                "sku_id", "must be an existing sku id"))
+        else:
+            checked.append((line_number, batch))
+    return checked
+
+
+@bulk.route("/api/bulk/skus", methods=["POST"])
+@no_cache
+def bulk_skus_post():
+    return create_many("bulk.bulk_skus_post", db.sku, Sku, "SKU", new_sku_schema, "sku.sku_get",
+                       codes_owner_type="sku")
+
+
+@bulk.route("/api/bulk/batches", methods=["POST"])
+@no_cache
+def bulk_batches_post():
+    return create_many("bulk.bulk_batches_post", db.batch, Batch, "BAT", new_batch_schema,
+                       "batch.batch_get", check_batch_skus, codes_owner_type="batch")
+
+
+@bulk.route("/api/bulk/bins", methods=["POST"])
+@no_cache
+def bulk_bins_post():
+    return create_many("bulk.bulk_bins_post", db.bin, Bin, "BIN", new_bin_schema, "bin.bin_get")
@@ -0,0 +1,249 @@
+"""Per-worker read-through cache of sku, batch and bin documents.
+
+Documents are cached by `(database, collection, _id)` as BSON bytes, so a
+hit decodes a fresh dict and callers can't modify the cached copy. The
+cache is an LRU bounded to INVENTORIUS_CACHE_SIZE entries (default 10000),
+and every entry expires after INVENTORIUS_CACHE_TTL seconds (default 5).
+INVENTORIUS_CACHE=off turns it off.
+
+Handlers that write a cached collection call `invalidate` after the write.
+That keeps this worker's reads current. The TTL bounds how long writes
+made by other workers can go unseen. A read that raced with an
+invalidation is not stored, so an old document can't be put back after
+the write that replaced it. Missing documents are not cached.
+
+With INVENTORIUS_SHARED_CACHE set, a miss here is looked up in a second
+tier that every worker on the host shares (see inventorius.shared_cache)
+before going to mongodb. Invalidations drop the documents from both tiers,
+so the other workers' shared lookups see writes at once.
+
+GETs of a single sku, batch or bin also keep the encoded response body,
+by `_id` and `_rev` (see inventorius.revisions), in a second LRU of
+INVENTORIUS_RESPONSE_CACHE_SIZE entries (default 10000). Writes change
+`_rev`, so those entries are never stale; a GET of a cached, unchanged
+document is two lookups and a copy of the body.
+
+Only reads that can tolerate that staleness use the cache: GETs and the
+existence checks of items and skus. Checks right after a failed guarded
+update, and reads that a write decision depends on (e.g. whether a bin is
+empty), still go to mongodb.
+"""
+import os
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+import bson
+
+from inventorius.revisions import REV_KEY
+from inventorius.shared_cache import key_bytes, shared_table
+
+enabled = os.getenv("INVENTORIUS_CACHE", "on") != "off"
+max_entries = int(os.getenv("INVENTORIUS_CACHE_SIZE", "10000"))
+ttl_seconds = float(os.getenv("INVENTORIUS_CACHE_TTL", "5"))
+response_cache_size = int(os.getenv("INVENTORIUS_RESPONSE_CACHE_SIZE", "10000"))
+
+
+class EntityCache:
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = Lock()
+        # key -> (expires at, value), least recently used first
+        self.entries = OrderedDict()
+        # bumped by every invalidation, see `put`
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation):
+        """Stores `value` unless something was invalidated since `generation`."""
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (monotonic() + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def invalidate_matching(self, predicate):
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": enabled,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+# values are (bson bytes, _rev)
+entity_cache = EntityCache(max_entries, ttl_seconds)
+# encoded response bodies; keys include `_rev`, so entries never expire
+response_cache = EntityCache(response_cache_size, float("inf"))
+
+# called as listener(database, collection_name) by `invalidate`, see
+# inventorius.coherence
+invalidation_listeners = []
+
+
+def _key(database, collection_name, doc_id):
+    return (id(database.client), database.name, collection_name, doc_id)
+
+
+def cached_entry(database, collection_name, doc_id):
+    """`(bson bytes, _rev)` of a document, or None if there is no such document."""
+    key = _key(database, collection_name, doc_id)
+    entry = entity_cache.get(key)
+    if entry is not None:
+        return entry
+    generation = entity_cache.generation
+
+    shared = shared_table()
+    if shared is not None:
+        shared_key = key_bytes(database.name, collection_name, doc_id)
+        shared_generation = shared.generation()
+        raw = shared.get(shared_key)
+        if raw is not None:
+            entry = (raw, bson.decode(raw, database.codec_options).get(REV_KEY))
+            entity_cache.put(key, entry, generation)
+            return entry
+
+    doc = database[collection_name].find_one({"_id": doc_id})
+    if doc is None:
+        return None
+    entry = (bson.encode(doc), doc.get(REV_KEY))
+    entity_cache.put(key, entry, generation)
+    if shared is not None:
+        shared.put(shared_key, entry[0], ttl_seconds, shared_generation)
+    return entry
+
+
+def cached_document(database, collection_name, doc_id):
+    """`database[collection_name].find_one({"_id": doc_id})`, through the cache."""
+    if not enabled:
+        return database[collection_name].find_one({"_id": doc_id})
+    entry = cached_entry(database, collection_name, doc_id)
+    return None if entry is None else bson.decode(entry[0], database.codec_options)
+
+
+def cached_response(database, collection_name, doc_id, variant, render):
+    """`(response body, _rev)` of a document, or None if there is no such
+    document.
+
+    `render(doc)` encodes the body. It is called once per revision of the
+    document and `variant`, which is anything else the body depends on.
+    Documents without a `_rev` are rendered every time."""
+    if not enabled:
+        doc = database[collection_name].find_one({"_id": doc_id})
+        return None if doc is None else (render(doc), doc.get(REV_KEY))
+    entry = cached_entry(database, collection_name, doc_id)
+    if entry is None:
+        return None
+    raw, rev = entry
+    if rev is None:
+        return render(bson.decode(raw, database.codec_options)), None
+    key = _key(database, collection_name, doc_id) + (rev, variant)
+    generation = response_cache.generation
+    body = response_cache.get(key)
+    if body is None:
+        body = render(bson.decode(raw, database.codec_options))
+        response_cache.put(key, body, generation)
+    return body, rev
+
+
+def document_rev(database, collection_name, doc_id):
+    """`(exists, _rev)` of a document, from the cache or a read of `_rev` only."""
+    entry = entity_cache.get(_key(database, collection_name, doc_id)) if enabled else None
+    if entry is not None:
+        return True, entry[1]
+    doc = database[collection_name].find_one({"_id": doc_id}, {REV_KEY: 1})
+    return doc is not None, doc and doc.get(REV_KEY)
+
+
+def document_exists(database, collection_name, doc_id):
+    if not enabled:
+        return cached_document(database, collection_name, doc_id) is not None
+    return cached_entry(database, collection_name, doc_id) is not None
+
+
+def invalidate(database, collection_name, *doc_ids):
+    """Drops the documents a handler wrote and tells the listeners."""
+    invalidate_local(database, collection_name, *doc_ids)
+    for listener in invalidation_listeners:
+        listener(database, collection_name)
+
+
+def invalidate_local(database, collection_name, *doc_ids):
+    """Drops documents from the caches of this host, without telling the
+    listeners."""
+    if enabled:
+        entity_cache.invalidate(
+            [_key(database, collection_name, doc_id) for doc_id in doc_ids])
+        shared = shared_table()
+        if shared is not None:
+            shared.invalidate(
+                [key_bytes(database.name, collection_name, doc_id) for doc_id in doc_ids])
+
+
+def invalidate_collection(database, collection_name):
+    prefix = (id(database.client), database.name, collection_name)
+    entity_cache.invalidate_matching(lambda key: key[:3] == prefix)
+    shared = shared_table()
+    if shared is not None:
+        shared.invalidate_prefix(key_bytes(database.name, collection_name, ""))
+
+
+def clear(shared=True):
+    entity_cache.clear()
+    response_cache.clear()
+    table = shared_table() if shared else None
+    if table is not None:
+        table.clear()
+
+
+def cache_stats():
+    stats = entity_cache.stats()
+    responses = response_cache.stats()
+    stats["responses"] = {name: responses[name] for name in (
+        "entries", "max_entries", "hits", "misses", "evictions")}
+    shared = shared_table()
+    stats["shared"] = shared.stats() if shared is not None else None
+    return stats
@@ -0,0 +1,155 @@
+"""The codes collection: one `{code, kind, owner_type, owner_id}` row per code
+of every sku and batch.
+
+`kind` is "owned" or "associated". An owned code belongs to one item only,
+which the unique partial index on owned codes enforces; associated codes
+can be shared. A barcode lookup is a point read on the `code` index instead
+of a scan of `owned_codes` and `associated_codes` in both collections.
+
+Like the stock collection, rows mirror the item documents. Handlers claim
+the codes of an item with `register_codes` before writing the item, which
+is what makes a taken owned code fail the write, and drop rows with
+`unregister_codes`. `flask rebuild-codes` rebuilds the rows from the skus
+and batches. Until it has run once on a database that had skus or batches
+before this collection, `lookup_code` queries their code fields instead
+(see inventorius.mirrors).
+"""
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from inventorius.mirrors import mark_mirror_built, mirror_is_built
+
+OWNED = "owned"
+ASSOCIATED = "associated"
+
+
+def code_keys(owner_id, owned_codes=(), associated_codes=()):
+    keys = []
+    for kind, codes in ((OWNED, owned_codes), (ASSOCIATED, associated_codes)):
+        for code in dict.fromkeys(codes or ()):
+            keys.append({"code": code, "kind": kind, "owner_id": owner_id})
+    return keys
+
+
+def register_codes(database, owner_type, items, rollback=True):
+    """Adds the rows of `[(owner_id, owned_codes, associated_codes)]` in one
+    unordered bulk write. Rows that already exist are left alone.
+
+    Returns `{owner_id: [owned codes of other items]}` for the items whose
+    owned codes are taken. Unless `rollback` is false, the rows this call
+    added for those items are removed again."""
+    return add_code_rows(database, owner_type, items, rollback)[0]
+
+
+def add_code_rows(database, owner_type, items, rollback=True):
+    """Like `register_codes`, but returns `(conflicts, added)`, where `added`
+    is `{owner_id: [_id of each row this call added]}` for the items without
+    conflicts. `remove_code_rows` takes them back out."""
+    requests = []
+    request_owners = []
+    for owner_id, owned_codes, associated_codes in items:
+        for key in code_keys(owner_id, owned_codes, associated_codes):
+            requests.append(UpdateOne(
+                key, {"$setOnInsert": {"owner_type": owner_type}}, upsert=True))
+            request_owners.append((owner_id, key["code"]))
+    if not requests:
+        return {}, {}
+
+    try:
+        result = database.codes.bulk_write(requests, ordered=False)
+        errors = []
+        upserted = result.upserted_ids.items()
+    except BulkWriteError as e:
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+        errors = e.details["writeErrors"]
+        upserted = [(upsert["index"], upsert["_id"]) for upsert in e.details["upserted"]]
+
+    conflicts = {}
+    for error in errors:
+        owner_id, code = request_owners[error["index"]]
+        conflicts.setdefault(owner_id, []).append(code)
+    added = {}
+    rolled_back = []
+    for index, row_id in upserted:
+        owner_id = request_owners[index][0]
+        if owner_id in conflicts:
+            rolled_back.append(row_id)
+        else:
+            added.setdefault(owner_id, []).append(row_id)
+    if rollback and rolled_back:
+        remove_code_rows(database, rolled_back)
+    return conflicts, added
+
+
+def remove_code_rows(database, row_ids):
+    if row_ids:
+        database.codes.delete_many({"_id": {"$in": list(row_ids)}})
+
+
+def unregister_codes(database, owner_id, owned_codes=None, associated_codes=None):
+    """Removes the given rows of an item, or all of them when no codes are given."""
+    if owned_codes is None and associated_codes is None:
+        database.codes.delete_many({"owner_id": owner_id})
+        return
+    for kind, codes in ((OWNED, owned_codes), (ASSOCIATED, associated_codes)):
+        if codes:
+            database.codes.delete_many(
+                {"owner_id": owner_id, "kind": kind, "code": {"$in": list(codes)}})
+
+
+def code_changes(old_doc, patch):
+    """Compares the code lists of a patch with those of the stored item.
+
+    Returns `(new, added, removed)`, each an `(owned, associated)` pair of
+    lists; a list the patch does not touch is empty."""
+    new, added, removed = [], [], []
+    for field in ("owned_codes", "associated_codes"):
+        if field not in patch:
+            new.append([])
+            added.append([])
+            removed.append([])
+            continue
+        old_codes = old_doc.get(field) or []
+        new_codes = patch[field] or []
+        new.append(new_codes)
+        added.append([code for code in new_codes if code not in old_codes])
+        removed.append([code for code in old_codes if code not in new_codes])
+    return tuple(new), tuple(added), tuple(removed)
+
+
+def owned_code_conflict_reason(codes):
+    return "must not be owned by another item: " + ", ".join(sorted(codes))
+
+
+def codes_are_built(database):
+    return mirror_is_built(database, "codes", ("sku", "batch"))
+
+
+def lookup_code(database, code):
+    """Returns the `{kind, owner_type, owner_id}` rows of a code."""
+    if not codes_are_built(database):
+        return [{"kind": kind, "owner_type": owner_type, "owner_id": doc["_id"]}
+                for owner_type in ("sku", "batch")
+                for kind, field in ((OWNED, "owned_codes"), (ASSOCIATED, "associated_codes"))
+                for doc in database[owner_type].find({field: code}, {"_id": 1})]
+    return list(database.codes.find(
+        {"code": code}, {"_id": 0, "kind": 1, "owner_type": 1, "owner_id": 1}))
+
+
+def rebuild_codes(database):
+    """Replaces every code row with rows built from the skus and batches.
+
+    Returns `(rows, conflicts)`, the number of rows written and
+    `{owner_id: [codes]}` of owned codes that another item already owns."""
+    database.codes.delete_many({})
+    conflicts = {}
+    for owner_type in ("sku", "batch"):
+        items = [(doc["_id"], doc.get("owned_codes"), doc.get("associated_codes"))
+                 for doc in database[owner_type].find(
+                     {}, {"owned_codes": 1, "associated_codes": 1})]
+        for start in range(0, len(items), 1000):
+            conflicts.update(register_codes(
+                database, owner_type, items[start:start + 1000], rollback=False))
+    mark_mirror_built(database, "codes")
+    return database.codes.count_documents({}), conflicts
@@ -0,0 +1,177 @@
+"""Keeps the in-process caches of every worker coherent with mongodb.
+
+The entity cache (inventorius.cache) and the autocomplete index only see
+the writes of their own worker. With INVENTORIUS_CACHE_COHERENCE set, each
+worker runs a daemon thread that applies the writes of all workers:
+
+- "changestream": a change stream on each of `sku`, `batch` and `bin`;
+  only the sku and batch streams look up the updated document. Each change
+  invalidates its document, and sku and batch changes update their
+  autocomplete entries.
+  Change streams need a replica set (a single node one is enough) or a
+  sharded cluster.
+- "poll": writers bump a per-collection counter in the `admin`
+  collection (`{"_id": "cache_versions"}`), and the thread reads it every
+  INVENTORIUS_CACHE_POLL_SECONDS (default 1). A changed counter drops every
+  cached document of its collection.
+- "auto": "changestream" where the deployment supports it, else "poll".
+
+The default, "off", leaves staleness bounded by the cache TTL only. When the
+watcher fails, the caches are cleared and the watcher starts over, since
+changes may have been missed.
+"""
+import contextlib
+import os
+from threading import Event, Lock, Thread
+
+from pymongo.errors import PyMongoError
+
+import inventorius.autocomplete as autocomplete
+import inventorius.cache as cache
+from inventorius.db import supports_change_streams
+
+WATCHED_COLLECTIONS = ("sku", "batch", "bin")
+VERSIONS_ID = "cache_versions"
+
+coherence_mode = os.getenv("INVENTORIUS_CACHE_COHERENCE", "off")
+poll_seconds = float(os.getenv("INVENTORIUS_CACHE_POLL_SECONDS", "1"))
+retry_seconds = 1.0
+
+if coherence_mode not in ("off", "auto", "changestream", "poll"):
+    print(f"INVENTORIUS_CACHE_COHERENCE={coherence_mode} ignored: "
+          "expected 'off', 'auto', 'changestream' or 'poll'")
+    coherence_mode = "off"
+
+
+def clear_caches(database, shared=True):
+    cache.clear(shared)
+    autocomplete.mark_stale(database)
+
+
+def apply_change(database, change):
+    """Applies one change stream event to this worker's caches."""
+    operation = change["operationType"]
+    if operation not in ("insert", "update", "replace", "delete"):
+        # drop, rename, dropDatabase or invalidate
+        clear_caches(database)
+        return
+    collection_name = change["ns"]["coll"]
+    doc_id = change["documentKey"]["_id"]
+    cache.invalidate_local(database, collection_name, doc_id)
+    if collection_name in ("sku", "batch"):
+        if operation == "delete":
+            autocomplete.forget_item(database, doc_id)
+        elif change.get("fullDocument") is not None:
+            autocomplete.index_doc(database, collection_name, change["fullDocument"])
+
+
+def bump_version(database, collection_name):
+    if collection_name in WATCHED_COLLECTIONS:
+        database.admin.update_one(
+            {"_id": VERSIONS_ID}, {"$inc": {collection_name: 1}}, upsert=True)
+
+
+class CacheWatcher(Thread):
+    def __init__(self, database, mode):
+        super().__init__(name=f"cache-watcher-{database.name}", daemon=True)
+        self.database = database
+        self.mode = mode
+        # set once the watcher follows the database, e.g. for tests
+        self.ready = Event()
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.mode == "changestream":
+                    self.watch()
+                else:
+                    self.poll()
+            except PyMongoError as e:
+                print(f"cache watcher for {self.database.name} restarting: {e}")
+                self.ready.clear()
+                clear_caches(self.database)
+                self.stopped.wait(retry_seconds)
+
+    def watch(self):
+        # one stream per collection, which MongoDB 3.6 supports. The
+        # autocomplete index needs updated sku and batch documents; bin
+        # changes only invalidate, so they skip the lookup of the whole bin
+        with contextlib.ExitStack() as streams:
+            opened = [streams.enter_context(self.database[name].watch(
+                full_document="updateLookup" if name in ("sku", "batch") else None,
+                max_await_time_ms=100)) for name in WATCHED_COLLECTIONS]
+            # anything this worker cached before the streams opened may be
+            # stale; the shared tier was kept current by the other workers'
+            # watchers, and a fresh worker starts hot from it
+            clear_caches(self.database, shared=False)
+            self.ready.set()
+            while not self.stopped.is_set() and all(stream.alive for stream in opened):
+                for stream in opened:
+                    change = stream.try_next()
+                    if change is not None:
+                        apply_change(self.database, change)
+
+    def poll(self):
+        versions = None
+        while not self.stopped.is_set():
+            doc = self.database.admin.find_one({"_id": VERSIONS_ID}) or {}
+            latest = {name: doc.get(name, 0) for name in WATCHED_COLLECTIONS}
+            if versions is None:
+                clear_caches(self.database, shared=False)
+            else:
+                for name in WATCHED_COLLECTIONS:
+                    if latest[name] != versions[name]:
+                        cache.invalidate_collection(self.database, name)
+                        if name in ("sku", "batch"):
+                            autocomplete.mark_stale(self.database)
+            versions = latest
+            self.ready.set()
+            self.stopped.wait(poll_seconds)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def resolve_mode(database, mode):
+    if mode == "auto":
+        return "changestream" if supports_change_streams(database.client) else "poll"
+    return mode
+
+
+# (pid, id(client), database name) -> CacheWatcher; the pid makes a forked
+# worker start its own thread instead of trusting the parent's
+_watchers = {}
+_watchers_lock = Lock()
+
+
+def ensure_watcher(database, mode=None):
+    """Starts the cache watcher of `database` in this process, once.
+
+    Returns the watcher, or None when coherence is off."""
+    mode = mode or coherence_mode
+    if mode == "off":
+        return None
+    key = (os.getpid(), id(database.client), database.name)
+    watcher = _watchers.get(key)
+    if watcher is None:
+        with _watchers_lock:
+            watcher = _watchers.get(key)
+            if watcher is None:
+                watcher = CacheWatcher(database, resolve_mode(database, mode))
+                if (watcher.mode == "poll"
+                        and bump_version not in cache.invalidation_listeners):
+                    cache.invalidation_listeners.append(bump_version)
+                watcher.start()
+                _watchers[key] = watcher
+    return watcher
+
+
+def stop_watchers():
+    """Stops every watcher of this process, e.g. between tests."""
+    with _watchers_lock:
+        for watcher in _watchers.values():
+            watcher.stop()
+        _watchers.clear()
+        if bump_version in cache.invalidation_listeners:
+            cache.invalidation_listeners.remove(bump_version)
@@ -1,6 +1,16 @@
 from email.policy import default
+import copy
 import json
-from bson.decimal128 import Decimal128
+from collections import namedtuple
+from itertools import islice
+from types import MappingProxyType, MemberDescriptorType
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from inventorius.json_encoding import value_encoder
+from inventorius.model_codegen import install_specialized_methods
+from inventorius.money import Money
+from inventorius.revisions import REV_KEY
 
 # -------- Helper functions
 
@@ -19,22 +29,109 @@ def get_class_variables(cls):
 
 
 def get_fields(cls):
-    return [attr for attr in get_class_variables(cls)
-            if issubclass(getattr(cls, attr).__class__, DataField) or issubclass(getattr(cls, attr).__class__, Subdoc)
-            ]
+    return sorted(declared_fields(cls))
+
+
+def declared_fields(cls):
+    """Returns {name: DataField or Subdoc} for every field of cls, including
+    fields of slotted models, whose declarations are moved out of the class
+    namespace by DataModelType."""
+    fields = {}
+    for klass in reversed(cls.__mro__):
+        for attr, attr_value in vars(klass).items():
+            if isinstance(attr_value, (DataField, Subdoc)):
+                fields[attr] = attr_value
+            elif (attr in fields and not attr.startswith('__')
+                  and not isinstance(attr_value, LazyField)):
+                # overridden by a plain class variable or method
+                del fields[attr]
+        fields.update(vars(klass).get("_slotted_fields", {}))
+    return fields
 
 # def get_subdocs(cls):
 #     return list(filter(lambda attr: issubclass(getattr(cls, attr).__class__, DataModel),
 #                        get_class_variables(cls)))
 
+
+def default_factory(default):
+    """Returns a function producing the initial value of a field.
+
+    Mutable containers and subdoc models are copied so instances never
+    share a default."""
+    if type(default) in (list, dict):
+        return default.copy
+    if isinstance(default, DataModel):
+        return lambda: copy.copy(default)
+    return lambda: default
+
+
+def compile_fields(cls):
+    """Builds the frozen field table of a DataModel subclass.
+
+    Runs once, when the class is created. The conversion paths read
+    `cls._fields` and `cls._fields_by_db_key` instead of reflecting on the
+    class for every document.
+    """
+    fields = []
+    fields_by_db_key = {}
+    declared = declared_fields(cls)
+    for name in sorted(declared):
+        field = declared[name]
+        is_subdoc = isinstance(field, Subdoc)
+        spec = FieldSpec(
+            name=name,
+            db_key=field.db_key,
+            field=field,
+            is_subdoc=is_subdoc,
+            required=not is_subdoc and field.required,
+            default=field.default,
+            default_factory=default_factory(field.default),
+            value_to_bson=None if is_subdoc else field.value_to_bson,
+            bson_to_value=None if is_subdoc else field.bson_to_value,
+            bypass_none=not is_subdoc and field.bypass_none,
+            raw_value_to_bson=None if is_subdoc or field.raw_value_to_bson is identity
+            else field.raw_value_to_bson,
+            raw_bson_to_value=None if is_subdoc or field.raw_bson_to_value is identity
+            else field.raw_bson_to_value,
+            value_to_json=None if is_subdoc or field.value_to_json is identity
+            else field.value_to_json,
+            json_to_value=None if is_subdoc or field.json_to_value is identity
+            else field.json_to_value,
+        )
+        fields.append(spec)
+        if spec.db_key is not None:
+            # like the old linear search, the first field (by name) wins
+            fields_by_db_key.setdefault(spec.db_key, spec)
+
+    cls._fields = tuple(fields)
+    cls._fields_by_name = MappingProxyType({spec.name: spec for spec in fields})
+    cls._fields_by_db_key = MappingProxyType(fields_by_db_key)
+    cls._has_additional_fields = issubclass(cls, HasAdditionalFields)
+    if "_eager_type" not in vars(cls):
+        cls._eager_type = cls
+
 # -------- Utility classes
 
 
+FieldSpec = namedtuple("FieldSpec", [
+    "name", "db_key", "field", "is_subdoc", "required", "default",
+    "default_factory", "value_to_bson", "bson_to_value", "bypass_none",
+    "raw_value_to_bson", "raw_bson_to_value", "value_to_json", "json_to_value"])
+FieldSpec.__doc__ = """One precompiled entry of a DataModel field table."""
+
+
 class DataModelJSONEncoder(json.JSONEncoder):
     def default(self, o):
+        if isinstance(o, DataModel):
+            return {spec.name: getattr(o, spec.name) for spec in o._fields}
+        if isinstance(o, Money):
+            return o.to_json()
         return {k: v for k, v in o.__dict__.items() if k != None}
 
 
+encode_data_model_value = value_encoder(DataModelJSONEncoder)
+
+
 def identity(x): return x
 
 
@@ -51,12 +148,22 @@ class DataField():
     """An individual field of the DataModel.
 
     If db_key=None Then will not be retained when transformed to a mongodb doc.
+
+    value_to_json and json_to_value convert between the model value and its
+    json form (to_dict, from_json). They are never called with None.
     """
 
-    def __init__(self, db_key=None, required=False, default=None, value_to_bson=identity, bson_to_value=identity, bypass_none=True):
+    def __init__(self, db_key=None, required=False, default=None, value_to_bson=identity, bson_to_value=identity, bypass_none=True,
+                 value_to_json=identity, json_to_value=identity):
         self.db_key = db_key
         self.required = required
         self.default = default
+        self.value_to_json = value_to_json
+        self.json_to_value = json_to_value
+        # unwrapped converters, used by the generated conversion methods
+        self.bypass_none = bypass_none
+        self.raw_value_to_bson = value_to_bson
+        self.raw_bson_to_value = bson_to_value
         if bypass_none:
             self.value_to_bson = bypass_decorator(None, value_to_bson)
             self.bson_to_value = bypass_decorator(None, bson_to_value)
@@ -80,18 +187,144 @@ class Subdoc():
             self.default = default
 
 
-class DataModel():
+class _InstanceDictStorage():
+    """Stores lazily converted field values of models that have a __dict__."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        try:
+            return instance.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name) from None
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
+def inflate_raw_bson(value):
+    """Turns nested RawBSONDocuments of a top level value into dicts."""
+    if isinstance(value, RawBSONDocument):
+        return bson.decode(value.raw)
+    if type(value) is list:
+        return [inflate_raw_bson(element) for element in value]
+    return value
+
+
+class LazyField():
+    """A field of a lazy model (see `DataModel.from_raw_bson`).
+
+    The value is converted from the instance's raw BSON document on first
+    access, then kept in the model's own storage (its slot or __dict__)."""
+
+    def __init__(self, spec, storage, model_name, reads_db_key):
+        self.spec = spec
+        self.storage = storage
+        self.model_name = model_name
+        self.reads_db_key = reads_db_key
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return self.storage.__get__(instance, owner)
+        except AttributeError:
+            value = self.convert(instance._raw)
+            self.storage.__set__(instance, value)
+            return value
+
+    def __set__(self, instance, value):
+        self.storage.__set__(instance, value)
+
+    def convert(self, raw_doc):
+        """Same conversion as from_mongodb_doc, for a single field."""
+        spec = self.spec
+        db_value = raw_doc.get(spec.db_key, _MISSING) if self.reads_db_key else _MISSING
+        if spec.is_subdoc:
+            if db_value is _MISSING:
+                return spec.default_factory()
+            return spec.field.data_model_type.from_mongodb_doc(inflate_raw_bson(db_value))
+
+        value = None if db_value is _MISSING else spec.bson_to_value(inflate_raw_bson(db_value))
+        if value is not None:
+            return value
+        if spec.required:
+            raise KeyError("'{}' is a required field in class '{}'".format(
+                spec.name, self.model_name))
+        return spec.default_factory()
+
+
+_MISSING = object()
+
+
+def lazy_model_type(cls):
+    """Returns the lazy variant of a DataModel subclass, creating it on first use."""
+    lazy_type = vars(cls).get("_lazy_type")
+    if lazy_type is not None:
+        return lazy_type
+
+    namespace = {
+        "__slots__": ("_raw",),
+        "__module__": cls.__module__,
+        "__qualname__": f"{cls.__qualname__}._lazy_type",
+        "_eager_type": cls,
+    }
+    for spec in cls._fields:
+        storage = next((vars(klass)[spec.name] for klass in cls.__mro__
+                        if isinstance(vars(klass).get(spec.name), MemberDescriptorType)),
+                       None) or _InstanceDictStorage(spec.name)
+        reads_db_key = spec.db_key is not None and cls._fields_by_db_key[spec.db_key] is spec
+        namespace[spec.name] = LazyField(spec, storage, cls.__name__, reads_db_key)
+
+    lazy_type = type(cls)(f"Lazy{cls.__name__}", (cls,), namespace)
+    cls._lazy_type = lazy_type
+    return lazy_type
+
+
+class DataModelType(type):
+    """Metaclass of DataModel. Adds the `slots` class keyword.
+
+    `class Bin(DataModel, slots=True)` gives Bin instances a `__slots__`
+    layout with one slot per declared field and no `__dict__`. The field
+    declarations are moved out of the class namespace (a slot can not share
+    its name with a class variable) into `_slotted_fields`.
+    """
+
+    def __new__(mcls, name, bases, namespace, slots=False, **kwargs):
+        if slots:
+            slotted_fields = {attr: value for attr, value in namespace.items()
+                              if isinstance(value, (DataField, Subdoc))}
+            namespace = {attr: value for attr, value in namespace.items()
+                         if attr not in slotted_fields}
+            namespace["__slots__"] = tuple(slotted_fields)
+            namespace["_slotted_fields"] = MappingProxyType(slotted_fields)
+        return super().__new__(mcls, name, bases, namespace, **kwargs)
+
+    def __init__(cls, name, bases, namespace, slots=False, **kwargs):
+        super().__init__(name, bases, namespace, **kwargs)
+
+
+class DataModel(metaclass=DataModelType):
     """Abstract base class for managing conversion between app data structures and
        mongodb bson documents.
 
        Subclasses must have `DataField` class variables.
     """
+    __slots__ = ()
 
-    def __init__(self, **kwargs):
-        for field in get_class_variables(type(self)):
-            class_variable = getattr(self.__class__, field)
+    _fields = ()
+    _fields_by_db_key = MappingProxyType({})
+    _has_additional_fields = False
 
-            if isinstance(class_variable, DataField):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        compile_fields(cls)
+        install_specialized_methods(cls)
+
+    def __init__(self, **kwargs):
+        for spec in self._fields:
+            if not spec.is_subdoc:
                 # if field in kwargs:
                 # then called like ChildModel(field=value) so then simulate dataclass
                 #   types by setting self.<field> = kwargs[field] (also masking class variable)
@@ -99,51 +332,48 @@ class DataModel():
                 #   sometimes called like ChildModel(field=None). in this case kwargs[field]
                 #   is none. Don't treat this special. Don't use default. If I take the time
                 #   to write field=None, assume I really want None.
-
-                if kwargs.get(field) != None:
-                    setattr(self, field, kwargs[field])
-                #
-                # elif class_variable.default is set: then self.<field> = field.default.copy()
+                value = kwargs.get(spec.name)
+                if value is not None:
+                    if spec.json_to_value is not None:
+                        value = spec.json_to_value(value)
+                    setattr(self, spec.name, value)
                 #
                 # elif field.required: raise exception
                 #
-                # else: pass # field was not required and left undefined
-                elif class_variable.required:
+                # else: self.<field> = field.default (None when no default is set)
+                elif spec.required:
                     raise KeyError("'{}' is a required field in class '{}'".format(
-                        field, self.__class__.__name__))
-                elif class_variable.default != None and type(class_variable.default) == list:
-                    setattr(self, field, class_variable.default.copy())
-                elif class_variable.default != None:
-                    setattr(self, field, class_variable.default)
-                else:
-                    setattr(self, field, None)
-
-            elif isinstance(class_variable, Subdoc):
-                if field in kwargs:
-                    if type(kwargs[field]) is dict:
-                        setattr(self, field, class_variable.data_model_type(
-                            **kwargs[field]))
-                    else:
-                        setattr(self, field, kwargs[field])
+                        spec.name, self.__class__.__name__))
                 else:
-                    if class_variable.default is not None and type(class_variable.default) is list:
-                        setattr(self, field, class_variable.default.copy())
-                    elif class_variable.default is not None:
-                        setattr(self, field, class_variable.default)
+                    setattr(self, spec.name, spec.default_factory())
+
+            elif spec.name in kwargs:
+                value = kwargs[spec.name]
+                if type(value) is dict:
+                    value = spec.field.data_model_type(**value)
+                setattr(self, spec.name, value)
+            else:
+                setattr(self, spec.name, spec.default_factory())
 
     def __eq__(self, other):
-        if type(self) != type(other):
+        if not isinstance(other, DataModel) or self._eager_type is not other._eager_type:
             return False
-        for field in get_class_variables(self):
-            if getattr(self, field) != getattr(other, field):
+        for spec in self._fields:
+            if getattr(self, spec.name) != getattr(other, spec.name):
                 return False
         return True
 
     def to_json(self, mask_default=True):
-        return json.dumps(self.to_dict(mask_default), cls=DataModelJSONEncoder)
+        return self.encode_json(mask_default, encode_data_model_value)
+
+    def encode_json(self, mask_default, encode):
+        """Returns the JSON text of `self.to_dict(mask_default)`, encoding
+        values with `encode` (see inventorius.json_encoding). Subclasses get a
+        generated version that skips the intermediate dict."""
+        return encode(self.to_dict(mask_default))
 
     def __repr__(self):
-        return f'{self.__class__.__name__}({", ".join("=".join((k, v.__repr__())) for k, v in self.__dict__.items() if k!=None)})'
+        return f'{self.__class__.__name__}({", ".join("=".join((spec.name, getattr(self, spec.name).__repr__())) for spec in self._fields)})'
 
     @classmethod
     def from_json(cls, json_str):
@@ -154,104 +384,133 @@ class DataModel():
 
     @classmethod
     def from_mongodb_doc(cls, mongo_dict):
-        model_keys = get_fields(cls)
-
-        def db_key_to_model_key(db_key):
-            # search model_keys
-            for model_key in model_keys:
-                if getattr(cls, model_key).db_key == db_key:
-                    return model_key
-            if issubclass(cls, HasAdditionalFields):
-                return db_key
-            else:
-                raise Exception(
-                    "db_key not in DataModel schema, and class does not inherit HasAdditionalFields")
-
-        def db_value_to_model_value(model_key, db_value):
-            if not issubclass(cls, HasAdditionalFields):
-                if not hasattr(cls, model_key):
-                    raise Exception(
-                        "db_key not in DataModel schema, and class does not inherit HasAdditionalFields")
-                attribute = getattr(cls, model_key)
-                if isinstance(attribute, DataField):
-                    return attribute.bson_to_value(db_value)
-                if isinstance(attribute, Subdoc):
-                    return attribute.data_model_type.from_mongodb_doc(db_value)
-            else:
-                attribute = getattr(cls, model_key)
-                return attribute.bson_to_value(db_value)
-                # return db_value
-
         if mongo_dict is None:
             return None
+        fields_by_db_key = cls._fields_by_db_key
         data_model_dict = {}
         for db_key, db_value in mongo_dict.items():
-            model_key = db_key_to_model_key(db_key)
-            model_value = db_value_to_model_value(
-                model_key=model_key, db_value=db_value)
-            if model_key in model_keys:
-                data_model_dict[model_key] = model_value
+            spec = fields_by_db_key.get(db_key)
+            if spec is None:
+                if cls._has_additional_fields or db_key == REV_KEY:
+                    continue
+                raise Exception(
+                    "db_key not in DataModel schema, and class does not inherit HasAdditionalFields")
+            if spec.is_subdoc:
+                data_model_dict[spec.name] = \
+                    spec.field.data_model_type.from_mongodb_doc(db_value)
+            else:
+                data_model_dict[spec.name] = spec.bson_to_value(db_value)
         return cls(**data_model_dict)
 
-    def to_mongodb_doc(self):
-        model_keys = get_fields(type(self))
-
-        def model_key_to_db_key(model_key):
-            return getattr(self.__class__, model_key).db_key
+    @classmethod
+    def from_mongodb_cursor(cls, cursor, batch_size=100):
+        """Yields a model for every document of a pymongo cursor.
+
+        Documents are converted batch_size at a time, as the cursor fetches
+        them, so only one batch of models is held at once. Any iterable of
+        documents is accepted.
+        """
+        if hasattr(cursor, "batch_size"):
+            cursor.batch_size(batch_size)
+        from_mongodb_doc = cls.from_mongodb_doc
+        docs = iter(cursor)
+        while True:
+            batch = [from_mongodb_doc(doc) for doc in islice(docs, batch_size)]
+            if not batch:
+                return
+            yield from batch
 
-        def model_value_to_db_value(model_key, model_value):
-            attribute = getattr(self.__class__, model_key)
-            if isinstance(attribute, DataField):
-                return attribute.value_to_bson(model_value)
-            if isinstance(attribute, Subdoc) \
-                    and type(model_value) is not Subdoc:  # guard against undefined instance variables.
-                return model_value.to_mongodb_doc()
+    @classmethod
+    def from_raw_bson(cls, raw_doc):
+        """Returns a lazy model over a pymongo RawBSONDocument.
+
+        Nothing is decoded up front. Each field is decoded and converted
+        the first time it is read, so reading `bin.id` never touches a large
+        `contents` map. Lazy models compare equal to eager ones and support
+        every conversion method. Unlike from_mongodb_doc, keys missing from
+        the schema are not reported. Query with `db.raw_collection` to get
+        raw documents.
+        """
+        if raw_doc is None:
+            return None
+        model = object.__new__(lazy_model_type(cls))
+        model._raw = raw_doc
+        return model
 
-        # transform self.__dict__ like {k: v} => {f(k): v}
+    def to_mongodb_doc(self):
         transformed_dict = {}
-        for model_key in model_keys:
-
-            # If a model_key is not an instance variable,
-            # then getattr should return the value model_key in the subclass.
-            model_value = getattr(self, model_key)
-
+        for spec in self._fields:
             # don't break the db schema
-            assert getattr(type(self), model_key) != None
+            if spec.db_key is None:
+                continue
+            model_value = getattr(self, spec.name)
+            if spec.is_subdoc:
+                transformed_dict[spec.db_key] = model_value.to_mongodb_doc()
+            else:
+                transformed_dict[spec.db_key] = spec.value_to_bson(model_value)
+        return transformed_dict
 
-            db_key = model_key_to_db_key(model_key)
-            db_value = model_value_to_db_value(model_key, model_value)
+    @classmethod
+    def patch_to_mongodb_update(cls, patch):
+        """Returns one mongodb update document applying a json patch.
+
+        `patch` maps field names to json values, like the arguments of
+        from_json. A None value unsets the field, anything else is converted
+        to bson and set. Subdoc values replace the whole subdocument. The
+        `_id` field and fields without a db_key are skipped. Returns an empty
+        dict when there is nothing to update.
+        """
+        set_fields = {}
+        unset_fields = {}
+        for name, value in patch.items():
+            spec = cls._fields_by_name.get(name)
+            if spec is None:
+                raise KeyError(f"'{name}' is not a field in class '{cls.__name__}'")
+            if spec.db_key is None or spec.db_key == "_id":
+                continue
+            if value is None:
+                unset_fields[spec.db_key] = ""
+            elif spec.is_subdoc:
+                set_fields[spec.db_key] = \
+                    spec.field.data_model_type.from_json(value).to_mongodb_doc()
+            else:
+                if spec.json_to_value is not None:
+                    value = spec.json_to_value(value)
+                set_fields[spec.db_key] = spec.value_to_bson(value)
 
-            if db_key is not None and type(db_value) != DataField:
-                transformed_dict[db_key] = db_value
-        return transformed_dict
+        update = {}
+        if set_fields:
+            update["$set"] = set_fields
+        if unset_fields:
+            update["$unset"] = unset_fields
+        return update
 
     def to_dict(self, mask_default=False):
         prepared_dict = {}
-        for key, value in self.__dict__.items():
-            class_variable = getattr(type(self), key)
-            if isinstance(class_variable, Subdoc):
-                if type(value) == class_variable.data_model_type:
+        for spec in self._fields:
+            value = getattr(self, spec.name)
+            if spec.is_subdoc:
+                if type(value) == spec.field.data_model_type:
                     subdoc_dict = value.to_dict(mask_default)
-                    default_dict = class_variable.default.to_dict(
-                        mask_default=True)
-                    if not mask_default or (mask_default and subdoc_dict != default_dict):
-                        prepared_dict[key] = subdoc_dict
+                    if not mask_default or subdoc_dict != spec.default.to_dict(mask_default=True):
+                        prepared_dict[spec.name] = subdoc_dict
                 assert type(value) is not dict
 
-            elif isinstance(class_variable, DataField):
-                if mask_default and value == class_variable.default:
-                    # if value is default don't include it in the output
-                    continue
-                else:
-                    # otherwise include the value in the output
-                    prepared_dict[key] = value
+            elif mask_default and value == spec.default:
+                # if value is default don't include it in the output
+                continue
+            else:
+                # otherwise include the value in the output
+                if spec.value_to_json is not None and value is not None:
+                    value = spec.value_to_json(value)
+                prepared_dict[spec.name] = value
         return prepared_dict
 
 # -------- Data model flags
 
 
 class HasAdditionalFields:
-    pass
+    __slots__ = ()
 
 
 # -------- Data models for db
@@ -268,25 +527,39 @@ class UserData(DataModel):
 
 
 def currency_from_bson(units):
-    assert units["unit"] == "USD"
-    return {"unit": "USD", "value": float(units['value'].to_decimal())}
+    return Money.from_bson(units)
+
+
+def currency_to_bson(money):
+    if type(money) is dict:
+        money = Money.from_json(money)
+    return money.to_bson()
+
+
+def currency_to_json(money):
+    if type(money) is dict:
+        return money
+    return money.to_json()
 
 
-def currency_to_bson(units):
-    assert units["unit"] == "USD"
-    return {"unit": "USD", "value": Decimal128(str(units['value']))}
+def currency_from_json(units):
+    if type(units) is dict:
+        return Money.from_json(units)
+    return units
 
 
 class Props(DataModel, HasAdditionalFields):
     cost_per_case = DataField(
-        "cost_per_case", value_to_bson=currency_to_bson, bson_to_value=currency_from_bson)
+        "cost_per_case", value_to_bson=currency_to_bson, bson_to_value=currency_from_bson,
+        value_to_json=currency_to_json, json_to_value=currency_from_json)
     count_per_case = DataField("count_per_case")
     original_cost_per_case = DataField(
-        "original_cost_per_case", value_to_bson=currency_to_bson, bson_to_value=currency_from_bson)
+        "original_cost_per_case", value_to_bson=currency_to_bson, bson_to_value=currency_from_bson,
+        value_to_json=currency_to_json, json_to_value=currency_from_json)
     original_count_per_case = DataField("original_count_per_case")
 
 
-class Bin(DataModel):
+class Bin(DataModel, slots=True):
     """Models a physical bin in the inventory system."""
     # if a datafield does not have a db_key set then it should not be stored as a db field
     id = DataField("_id", required=True)
@@ -303,7 +576,7 @@ class Bin(DataModel):
     #     return out
 
 
-class Sku(DataModel):
+class Sku(DataModel, slots=True):
     id = DataField("_id", required=True)
     owned_codes = DataField("owned_codes", default=[])
     associated_codes = DataField("associated_codes", default=[])
@@ -313,7 +586,7 @@ class Sku(DataModel):
     props = DataField("props")
 
 
-class Batch(DataModel):
+class Batch(DataModel, slots=True):
     id = DataField("_id", required=True)
     sku_id = DataField("sku_id")
     name = DataField("name")
@@ -1,8 +1,12 @@
 from flask import g
-from pymongo import MongoClient, TEXT
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient
 from werkzeug.local import LocalProxy
 from gridfs import GridFS
 
+from inventorius.indexes import ensure_indexes
+
 # memoize mongo_client
 _mongo_client = None
 
@@ -12,13 +16,44 @@ def get_mongo_client():
     if _mongo_client is None:
         db_host = "localhost"
         _mongo_client = MongoClient(db_host, 27017)
-        _mongo_client.inventoriusdb.sku.create_index([('name', TEXT)])
-        _mongo_client.inventoriusdb.batch.create_index([('name', TEXT)])
-        _mongo_client.inventoriusdb.user.create_index([('name', TEXT)])
+        ensure_indexes(_mongo_client.inventoriusdb)
 
     return _mongo_client
 
 
+# id(client) -> isMaster reply
+_is_master = {}
+
+
+def is_master(client):
+    """The isMaster reply of the deployment behind client, read once.
+
+    isMaster, since servers before 4.4.2 don't know `hello`."""
+    key = id(client)
+    if key not in _is_master:
+        _is_master[key] = client.admin.command("isMaster")
+    return _is_master[key]
+
+
+def supports_transactions(client):
+    """Whether the deployment behind client can run multi-document transactions.
+
+    Standalone servers reject them, replica sets support them from MongoDB
+    4.0 (wire version 7) and sharded clusters from 4.2 (wire version 8)."""
+    reply = is_master(client)
+    wire_version = reply.get("maxWireVersion", 0)
+    return (("setName" in reply and wire_version >= 7)
+            or (reply.get("msg") == "isdbgrid" and wire_version >= 8))
+
+
+def supports_change_streams(client):
+    """Whether the deployment behind client is a replica set or sharded cluster.
+
+    Standalone servers have no oplog to stream changes from."""
+    reply = is_master(client)
+    return "setName" in reply or reply.get("msg") == "isdbgrid"
+
+
 def get_db():
     if 'db' not in g:
         g.db = get_mongo_client().inventoriusdb
@@ -29,5 +64,16 @@ def get_gridfs_db():
         g.fs = GridFS(get_mongo_client().gridfsdb)
     return g.fs
 
+
+RAW_BSON_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+
+def raw_collection(collection):
+    """Returns a view of collection whose queries return RawBSONDocuments.
+
+    Meant for lazy models, see DataModel.from_raw_bson."""
+    return collection.with_options(codec_options=RAW_BSON_CODEC_OPTIONS)
+
+
 db = LocalProxy(get_db)
 fs = LocalProxy(get_gridfs_db)
\ No newline at end of file
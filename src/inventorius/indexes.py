@@ -0,0 +1,92 @@
+"""Every index the api relies on, declared in one place.
+
+`ensure_indexes(database)` creates the declared indexes (creating an index
+that already exists is a no-op) and records which indexes each collection
+really has. It runs once per database per worker: `get_mongo_client`
+applies it to the production database, and `index_capabilities` applies
+it to any other database the first time a handler asks.
+
+Handlers check for optional indexes with `has_index(db, "sku", "name_text")`
+instead of calling `index_information()` on every request.
+"""
+from pymongo import ASCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+INDEXES = {
+    "sku": [
+        IndexModel([("name", TEXT)], name="name_text"),
+        IndexModel([("owned_codes", ASCENDING)], name="owned_codes_1"),
+        IndexModel([("associated_codes", ASCENDING)], name="associated_codes_1"),
+    ],
+    "batch": [
+        IndexModel([("name", TEXT)], name="name_text"),
+        IndexModel([("owned_codes", ASCENDING)], name="owned_codes_1"),
+        IndexModel([("associated_codes", ASCENDING)], name="associated_codes_1"),
+        IndexModel([("sku_id", ASCENDING)], name="sku_id_1"),
+    ],
+    "user": [
+        IndexModel([("name", TEXT)], name="name_text"),
+        IndexModel([("shadow_id", ASCENDING)], name="shadow_id_1"),
+    ],
+    # see inventorius.codes
+    "codes": [
+        IndexModel([("code", ASCENDING)], name="owned_code_unique",
+                   unique=True, partialFilterExpression={"kind": "owned"}),
+        IndexModel([("code", ASCENDING), ("kind", ASCENDING), ("owner_id", ASCENDING)],
+                   name="code_1_kind_1_owner_id_1", unique=True),
+        IndexModel([("owner_id", ASCENDING)], name="owner_id_1"),
+    ],
+    # see inventorius.stock
+    "stock": [
+        IndexModel([("item_id", ASCENDING), ("bin_id", ASCENDING)],
+                   name="item_id_1_bin_id_1", unique=True),
+        IndexModel([("bin_id", ASCENDING), ("item_id", ASCENDING)],
+                   name="bin_id_1_item_id_1", unique=True),
+    ],
+}
+
+# (id(client), database name) -> {collection name: frozenset of index names}
+_capabilities = {}
+
+
+def _database_key(database):
+    return (id(database.client), database.name)
+
+
+def ensure_indexes(database, refresh=False):
+    """Creates the declared indexes of `database` and returns its capability map.
+
+    Only the first call per database talks to the server, unless `refresh`
+    is set (e.g. after collections were dropped)."""
+    key = _database_key(database)
+    if not refresh and key in _capabilities:
+        return _capabilities[key]
+
+    capabilities = {}
+    for collection_name, indexes in INDEXES.items():
+        collection = database[collection_name]
+        try:
+            collection.create_indexes(indexes)
+        except OperationFailure:
+            # e.g. a conflicting index exists; create what can be created
+            for index in indexes:
+                try:
+                    collection.create_indexes([index])
+                except OperationFailure as e:
+                    print(f"could not create index "
+                          f"{database.name}.{collection_name}.{index.document['name']}: {e}")
+        capabilities[collection_name] = frozenset(collection.index_information())
+    _capabilities[key] = capabilities
+    return capabilities
+
+
+def index_capabilities(database):
+    """The cached capability map of `database`, ensuring indexes on first use."""
+    capabilities = _capabilities.get(_database_key(database))
+    if capabilities is None:
+        capabilities = ensure_indexes(database)
+    return capabilities
+
+
+def has_index(database, collection_name, index_name):
+    return index_name in index_capabilities(database).get(collection_name, ())
@@ -1,13 +1,21 @@
 from inventorius.util import getIntArgs, admin_get_next
 from flask import Blueprint, request, Response, url_for
 from voluptuous.error import MultipleInvalid
-from inventorius.data_models import Bin, Sku, Batch, DataModelJSONEncoder as Encoder
+from inventorius.data_models import DataModelJSONEncoder as Encoder
 from inventorius.db import db
+from inventorius.autocomplete import prefix_index
+from inventorius.cache import document_exists, invalidate
+from inventorius.revisions import bump_rev
+from inventorius.search import encode_continuation, search_page
+from inventorius.stock import adjust_stock
 from inventorius.validation import item_move_schema, item_release_receive_schema
 import inventorius.util_error_responses as problem
 import inventorius.util_success_responses as success
+import inventorius.resource_operations as operations
 from inventorius.util import no_cache
 
+from pymongo import ReturnDocument, UpdateOne
+
 import json
 
 inventorius = Blueprint("inventorius", __name__)
@@ -55,6 +63,32 @@ inventorius = Blueprint("inventorius", __name__)
 #     return Response(status=200)
 
 
+def missing_item_response(item_id):
+    """Returns a missing resource response if item_id does not exist, else None."""
+    if item_id.startswith("SKU"):
+        if not document_exists(db, "sku", item_id):
+            return problem.missing_sku_response(item_id)
+    elif item_id.startswith("BAT"):
+        if not document_exists(db, "batch", item_id):
+            return problem.missing_batch_response(item_id)
+    return None
+
+
+def move_failure_response(id, destination, item_id, quantity):
+    """Explains why the guarded decrement of a move matched nothing."""
+    source = db.bin.find_one({"_id": id}, {f"contents.{item_id}": 1})
+    if not source:
+        return problem.missing_bin_response(id)
+    if not db.bin.find_one({"_id": destination}, {"_id": 1}):
+        return problem.missing_bin_response(destination)
+    missing_item = missing_item_response(item_id)
+    if missing_item:
+        return missing_item
+    availible_quantity = source.get("contents", {}).get(item_id, 0)
+    return problem.move_insufficient_quantity(
+        name="quantity", availible=availible_quantity, requested=quantity)
+
+
 @inventorius.route('/api/bin/<id>/contents/move', methods=['PUT'])
 @no_cache
 def move_bin_contents_put(id):
@@ -67,36 +101,42 @@ def move_bin_contents_put(id):
     destination = json['destination']
     quantity = json['quantity']
 
-    if not db.bin.find_one({"_id": id}):
-        return problem.missing_bin_response(id)
-    if not db.bin.find_one({"_id": destination}):
+    # take the items out of the source bin only if enough are there
+    source = db.bin.find_one_and_update(
+        {"_id": id, f"contents.{item_id}": {"$gte": quantity}},
+        bump_rev({"$inc": {f"contents.{item_id}": -quantity}}),
+        projection={f"contents.{item_id}": 1},
+        return_document=ReturnDocument.AFTER)
+    if source is None:
+        return move_failure_response(id, destination, item_id, quantity)
+
+    requests = [UpdateOne({"_id": destination},
+                          bump_rev({"$inc": {f"contents.{item_id}": quantity}}))]
+    if source["contents"][item_id] == 0:
+        requests.append(UpdateOne({"_id": id, f"contents.{item_id}": 0},
+                                  bump_rev({"$unset": {f"contents.{item_id}": ""}})))
+    result = db.bin.bulk_write(requests)
+    if (result.matched_count < len(requests)
+            and not db.bin.find_one({"_id": destination}, {"_id": 1})):
+        # put the items back
+        db.bin.update_one({"_id": id},
+                          bump_rev({"$inc": {f"contents.{item_id}": quantity}}))
+        invalidate(db, "bin", id)
         return problem.missing_bin_response(destination)
-
-    if item_id.startswith("SKU"):
-        if not db.sku.find_one({"_id": item_id}):
-            return problem.missing_sku_response(item_id)
-    elif item_id.startswith("BAT"):
-        if not db.batch.find_one({"_id": item_id}):
-            return problem.missing_batch_response(item_id)
-
-    availible_quantity = Bin.from_mongodb_doc(
-        db.bin.find_one({"_id": id})).contents.get(item_id, 0)
-    if availible_quantity < quantity:
-        return problem.move_insufficient_quantity(
-            name="quantity", availible=availible_quantity, requested=quantity)
-
-    db.bin.update_one({"_id": id},
-                      {"$inc": {f"contents.{item_id}": - quantity}})
-    db.bin.update_one({"_id": destination},
-                      {"$inc": {f"contents.{item_id}": quantity}})
-    db.bin.update_one({"_id": id, f"contents.{item_id}": 0},
-                      {"$unset": {f"contents.{item_id}": ""}})
+    invalidate(db, "bin", id, destination)
+    adjust_stock(db, [(item_id, id, -quantity), (item_id, destination, quantity)])
 
     return success.moved_response()
 
 
 @inventorius.route('/api/next/sku', methods=['GET'])
 def next_sku():
+    """The next sku id, to offer as the default id of a new sku.
+
+    The id is not reserved: a POST with it gets 409 duplicate-resource on
+    "id" if another sku was created with it first, and the client asks
+    for the next id again. Items of POST /api/bulk/skus without an id
+    get a reserved one instead."""
     resp = Response()
     resp.status_code == 200
     resp.mimetype = "application/json"
@@ -115,6 +155,12 @@ def next_sku():
 
 @inventorius.route('/api/next/batch', methods=['GET'])
 def next_batch():
+    """The next batch id, to offer as the default id of a new batch.
+
+    The id is not reserved: a POST with it gets 409 duplicate-resource on
+    "id" if another batch was created with it first, and the client asks
+    for the next id again. Items of POST /api/bulk/batches without an id
+    get a reserved one instead."""
     resp = Response()
     resp.status_code == 200
     resp.mimetype = "application/json"
@@ -133,6 +179,12 @@ def next_batch():
 
 @inventorius.route('/api/next/bin', methods=['GET'])
 def next_bin():
+    """The next bin id, to offer as the default id of a new bin.
+
+    The id is not reserved: a POST with it gets 409 duplicate-resource on
+    "id" if another bin was created with it first, and the client asks
+    for the next id again. Items of POST /api/bulk/bins without an id
+    get a reserved one instead."""
     resp = Response()
     resp.status_code == 200
     resp.mimetype = "application/json"
@@ -180,26 +232,37 @@ def bin_contents_post(bin_id):
     item_id = json["id"]
     quantity = json["quantity"]
 
-    if not db.bin.find_one({"_id": bin_id}):
-        return problem.missing_bin_response(bin_id)
-
-    if item_id.startswith("SKU"):
-        if not db.sku.find_one({"_id": item_id}):
-            return problem.missing_sku_response(item_id)
-    elif item_id.startswith("BAT"):
-        if not db.batch.find_one({"_id": item_id}):
-            return problem.missing_batch_response(item_id)
-
-    old_quantity = db.bin.find_one(
-        {"_id": bin_id}, {f"contents.{item_id}": 1})["contents"].get(item_id, 0)
-    if quantity + old_quantity < 0:
-        return problem.release_insufficient_quantity()
-
-    db.bin.update_one({"_id": bin_id},
-                        {"$inc": {f"contents.{item_id}": quantity}})
-
-    db.bin.update_one({"_id": bin_id, f"contents.{item_id}": 0},
-                        {"$unset": {f"contents.{item_id}": ""}})
+    increment = bump_rev({"$inc": {f"contents.{item_id}": quantity}})
+    # an $inc by 0, or a release of everything, leaves a 0 quantity behind
+    cleanup = UpdateOne({"_id": bin_id, f"contents.{item_id}": 0},
+                        bump_rev({"$unset": {f"contents.{item_id}": ""}}))
+    if quantity >= 0:
+        missing_item = missing_item_response(item_id)
+        if missing_item:
+            if not db.bin.find_one({"_id": bin_id}, {"_id": 1}):
+                return problem.missing_bin_response(bin_id)
+            return missing_item
+        result = db.bin.bulk_write(
+            [UpdateOne({"_id": bin_id}, increment), cleanup], ordered=True)
+        if result.matched_count == 0:
+            return problem.missing_bin_response(bin_id)
+    else:
+        # release only if enough items are in the bin. Without the release,
+        # the cleanup only matches a 0 that an interrupted write left behind,
+        # and then the bin held none of the item; that release is answered
+        # as done, without changing any quantity
+        result = db.bin.bulk_write([
+            UpdateOne({"_id": bin_id, f"contents.{item_id}": {"$gte": -quantity}}, increment),
+            cleanup,
+        ], ordered=True)
+        if result.matched_count == 0:
+            if not db.bin.find_one({"_id": bin_id}, {"_id": 1}):
+                return problem.missing_bin_response(bin_id)
+            return missing_item_response(item_id) or problem.release_insufficient_quantity()
+
+    invalidate(db, "bin", bin_id)
+    if quantity:
+        adjust_stock(db, [(item_id, bin_id, quantity)])
     return success.bin_contents_post_response(quantity)
 
 
@@ -207,86 +270,58 @@ def bin_contents_post(bin_id):
 @inventorius.route('/api/search', methods=['GET'])
 def search():
     query = request.args['query']
-    limit = getIntArgs(request.args, "limit", 20)
-    startingFrom = getIntArgs(request.args, "startingFrom", 0)
+    limit = max(getIntArgs(request.args, "limit", 20), 0)
+    startingFrom = max(getIntArgs(request.args, "startingFrom", 0), 0)
+    continuation = request.args.get("continuation")
+
+    try:
+        # the branch queries run on other threads, which can't see the request context
+        page = search_page(db._get_current_object(), query, limit,
+                           startingFrom, continuation)
+    except ValueError as e:
+        return problem.problem_response(json={
+            "type": "validation-error",
+            "title": problem.problem_titles["validation-error"],
+            "invalid-params": [{"name": "continuation", "reason": str(e)}],
+        })
+
+    page_operations = []
+    if page.next_position is not None:
+        page_operations.append(operations.search_next(
+            query, limit, encode_continuation(query, page.next_position)))
+    if page.offset > 0:
+        page_operations.append(operations.search_prev(
+            query, limit, max(page.offset - limit, 0)))
+
     resp = Response()
+    resp.status_code = 200
+    resp.mimetype = "application/json"
+    resp.data = json.dumps({'state': {
+        "total_num_results": page.total,
+        "starting_from": page.offset,
+        "limit": limit,
+        "returned_num_results": len(page.results),
+        "results": page.results
+    }, "operations": page_operations}, cls=Encoder)
+    resp.headers["Server-Timing"] = page.server_timing()
+    return resp
 
-    results = []
 
-    # debug flags
-    if query == '!ALL':
-        results.extend([Sku.from_mongodb_doc(e) for e in db.sku.find()])
-        results.extend([Batch.from_mongodb_doc(e) for e in db.batch.find()])
-        results.extend([Bin.from_mongodb_doc(e) for e in db.bin.find()])
-    if query == '!BINS':
-        results.extend([Bin.from_mongodb_doc(e) for e in db.bin.find()])
-    if query == '!SKUS':
-        results.extend([Sku.from_mongodb_doc(e) for e in db.sku.find()])
-    if query == '!BATCHES':
-        results.extend([Batch.from_mongodb_doc(e) for e in db.batch.find()])
-
-    # search by label
-    if query.startswith('SKU'):
-        results.append(Sku.from_mongodb_doc(db.sku.find_one({'_id': query})))
-    if query.startswith('BIN'):
-        results.append(Bin.from_mongodb_doc(db.bin.find_one({'_id': query})))
-    if query.startswith('BAT'):
-        results.append(Batch.from_mongodb_doc(
-            db.batch.find_one({'_id': query})))
-    results = [result for result in results if result != None]
-
-    # search for skus with owned_codes
-    cursor = db.sku.find({"owned_codes": query})
-    for sku_doc in cursor:
-        results.append(Sku.from_mongodb_doc(sku_doc))
-
-    # search for skus with associated codes
-    cursor = db.sku.find({"associated_codes": query})
-    for sku_doc in cursor:
-        results.append(Sku.from_mongodb_doc(sku_doc))
-
-    # search for skus with owned_codes
-    cursor = db.batch.find({"owned_codes": query})
-    for batch_doc in cursor:
-        results.append(Batch.from_mongodb_doc(batch_doc))
-
-    # search for batchs with associated codes
-    cursor = db.batch.find({"associated_codes": query})
-    for batch_doc in cursor:
-        results.append(Batch.from_mongodb_doc(batch_doc))
-
-    # if not DEV_ENV: # maybe use global flag + env variable instead. Shouldn't need to check this every time in production/
-    if "name_text" in db.sku.index_information().keys():
-        cursor = db.sku.find({"$text": {"$search": query}})
-        for sku_doc in cursor:
-            results.append(Sku.from_mongodb_doc(sku_doc))
-    if "name_text" in db.batch.index_information().keys():
-        cursor = db.batch.find({"$text": {"$search": query}})
-        for batch_doc in cursor:
-            results.append(Batch.from_mongodb_doc(batch_doc))
-
-    if results != []:
-        paged = results[startingFrom:(startingFrom + limit)]
-        resp.status_code = 200
-        resp.mimetype = "application/json"
-        # TODO: Add next page / prev page operations
-        resp.data = json.dumps({'state': {
-            "total_num_results": len(results),
-            "starting_from": startingFrom,
-            "limit": limit,
-            "returned_num_results": len(paged),
-            "results": paged
-        },
-            "operations": []}, cls=Encoder)
-        return resp
+@inventorius.route('/api/autocomplete', methods=['GET'])
+def autocomplete():
+    prefix = request.args.get('prefix', '')
+    limit = max(getIntArgs(request.args, "limit", 10), 0)
 
+    results = []
+    if prefix.strip():
+        results = prefix_index(db).complete(prefix, limit)
+
+    resp = Response()
     resp.status_code = 200
     resp.mimetype = "application/json"
     resp.data = json.dumps({'state': {
-        "total_num_results": len(results),
-        "starting_from": startingFrom,
+        "prefix": prefix,
         "limit": limit,
-        "returned_num_results": 0,
-        "results": []
-    }, "operations": []}, cls=Encoder)
+        "results": results
+    }})
     return resp
@@ -0,0 +1,44 @@
+"""Value encoders for the direct-to-JSON serializer.
+
+Models write their JSON text field by field (see `DataModel.encode_json`)
+and hand each value to an encoder built here. With the default "json"
+backend the output is byte for byte what `json.dumps(..., cls=...)` gives
+for the equivalent dict.
+
+Setting INVENTORIUS_JSON_BACKEND=orjson switches value encoding to orjson
+when it is installed. orjson writes compact separators, raw UTF-8 and
+`null` for infinities, so responses stay equivalent JSON but are no
+longer byte identical. That is why it is opt-in.
+"""
+import os
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+json_backend = os.getenv("INVENTORIUS_JSON_BACKEND", "json")
+
+if json_backend == "orjson" and orjson is None:
+    print("INVENTORIUS_JSON_BACKEND=orjson ignored: 'orjson' not installed")
+    json_backend = "json"
+
+
+def value_encoder(encoder_class):
+    """Returns a function that encodes one value to a JSON str.
+
+    `encoder_class` is a json.JSONEncoder subclass; its `default` handles
+    values neither backend can serialize."""
+    encoder = encoder_class()
+    if json_backend != "orjson":
+        return encoder.encode
+
+    options = orjson.OPT_NON_STR_KEYS
+
+    def encode(value):
+        try:
+            return orjson.dumps(value, default=encoder.default, option=options).decode()
+        except orjson.JSONEncodeError:
+            # e.g. integers wider than 64 bits
+            return encoder.encode(value)
+    return encode
@@ -0,0 +1,53 @@
+"""Whether the stock and codes collections mirror their source documents yet.
+
+Both collections were added to databases that already had bins, skus and
+batches, and handlers only keep them up to date from then on. Until
+`flask rebuild-stock` or `flask rebuild-codes` has run once on such a
+database, readers fall back to querying the source documents. The rebuild
+commands mark their collection built in the `admin` collection
+(`{"_id": "mirrors"}`). A database whose sources are still empty has
+nothing to rebuild, so its first use marks it built.
+"""
+from threading import Lock
+
+MIRRORS_ID = "mirrors"
+
+# (id(client), database name, mirror) known to be built
+_built = set()
+_warned = set()
+_lock = Lock()
+
+
+def _key(database, mirror):
+    return (id(database.client), database.name, mirror)
+
+
+def mirror_is_built(database, mirror, sources):
+    """Whether the `mirror` collection can be read instead of `sources`.
+
+    Costs nothing once it is, two point reads until then."""
+    key = _key(database, mirror)
+    if key in _built:
+        return True
+    if database.admin.find_one({"_id": MIRRORS_ID, mirror: True}, {"_id": 1}) is None:
+        if any(database[source].find_one({}, {"_id": 1}) is not None for source in sources):
+            if key not in _warned:
+                _warned.add(key)
+                print(f"{database.name}.{mirror} is not built, reading "
+                      f"{' and '.join(sources)} instead until `flask rebuild-{mirror}` runs")
+            return False
+        mark_mirror_built(database, mirror)
+    with _lock:
+        _built.add(key)
+    return True
+
+
+def mark_mirror_built(database, mirror):
+    database.admin.update_one({"_id": MIRRORS_ID}, {"$set": {mirror: True}}, upsert=True)
+
+
+def reset():
+    """Forgets what is known, e.g. after the collections were dropped."""
+    with _lock:
+        _built.clear()
+        _warned.clear()
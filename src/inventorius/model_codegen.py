@@ -0,0 +1,279 @@
+"""Generates specialized conversion methods for DataModel subclasses.
+
+The generic `DataModel.from_mongodb_doc`, `to_mongodb_doc` and `to_dict`
+walk the field table of the model for every document. The functions built
+here unroll that walk once per class into straight-line code: converters
+are called directly (identity converters are dropped), None bypassing is
+an inline `is None` test and there is no per-field type dispatch.
+
+`encode_json` writes the JSON text of `to_dict` directly; see
+`inventorius.json_encoding`.
+
+The generated methods must produce exactly the same output as the generic
+ones. `tests/test_data_models.py` checks this against the hypothesis
+strategies.
+"""
+import json
+import linecache
+
+from inventorius.revisions import REV_KEY
+
+_MISSING = object()
+
+SCHEMA_ERROR = "db_key not in DataModel schema, and class does not inherit HasAdditionalFields"
+
+
+def _compile(cls, method_name, lines, namespace):
+    """Executes generated source and returns the function it defines."""
+    source = "\n".join(lines) + "\n"
+    filename = f"<generated {cls.__module__}.{cls.__qualname__}.{method_name}>"
+    # make generated code show up in tracebacks
+    linecache.cache[filename] = (
+        len(source), None, source.splitlines(True), filename)
+    exec(compile(source, filename, "exec"), namespace)
+    function = namespace[method_name]
+    function.__qualname__ = f"{cls.__qualname__}.{method_name}"
+    function.__generated_source__ = source
+    return function
+
+
+def build_from_mongodb_doc(cls):
+    namespace = {
+        "_MISSING": _MISSING,
+        "_new": object.__new__,
+        "_known_db_keys": frozenset(cls._fields_by_db_key) | {REV_KEY},
+        "SCHEMA_ERROR": SCHEMA_ERROR,
+    }
+    lines = [
+        "def from_mongodb_doc(cls, mongo_dict):",
+        "    if mongo_dict is None:",
+        "        return None",
+    ]
+    if not cls._has_additional_fields:
+        lines += [
+            "    if not _known_db_keys.issuperset(mongo_dict):",
+            "        raise Exception(SCHEMA_ERROR)",
+        ]
+    lines += [
+        "    get = mongo_dict.get",
+        "    self = _new(cls)",
+    ]
+
+    for i, spec in enumerate(cls._fields):
+        if spec.db_key is None or cls._fields_by_db_key[spec.db_key] is not spec:
+            # never read from a document, always starts at its default
+            namespace[f"_default_{i}"] = spec.default_factory
+            if spec.required:
+                namespace[f"_required_{i}"] = \
+                    f"'{spec.name}' is a required field in class '{cls.__name__}'"
+                lines.append(f"    raise KeyError(_required_{i})")
+            else:
+                lines.append(f"    self.{spec.name} = _default_{i}()")
+            continue
+
+        key = repr(spec.db_key)
+        if spec.is_subdoc:
+            namespace[f"_subdoc_{i}"] = spec.field.data_model_type
+            namespace[f"_default_{i}"] = spec.default_factory
+            lines += [
+                f"    value = get({key}, _MISSING)",
+                f"    self.{spec.name} = _default_{i}() if value is _MISSING "
+                f"else _subdoc_{i}.from_mongodb_doc(value)",
+            ]
+            continue
+
+        namespace[f"_from_bson_{i}"] = spec.raw_bson_to_value
+        if spec.bypass_none:
+            lines.append(f"    value = get({key})")
+            if spec.raw_bson_to_value is not None:
+                lines += [
+                    "    if value is not None:",
+                    f"        value = _from_bson_{i}(value)",
+                ]
+        else:
+            lines += [
+                f"    value = get({key}, _MISSING)",
+                f"    value = None if value is _MISSING else _from_bson_{i}(value)",
+            ]
+
+        if spec.required:
+            namespace[f"_required_{i}"] = f"'{spec.name}' is a required field in class '{cls.__name__}'"
+            lines += [
+                "    if value is None:",
+                f"        raise KeyError(_required_{i})",
+                f"    self.{spec.name} = value",
+            ]
+        elif spec.default is None:
+            lines.append(f"    self.{spec.name} = value")
+        else:
+            namespace[f"_default_{i}"] = spec.default_factory
+            lines.append(
+                f"    self.{spec.name} = value if value is not None else _default_{i}()")
+
+    lines.append("    return self")
+    return classmethod(_compile(cls, "from_mongodb_doc", lines, namespace))
+
+
+def build_to_mongodb_doc(cls):
+    namespace = {}
+    lines = ["def to_mongodb_doc(self):"]
+    items = []
+    for i, spec in enumerate(cls._fields):
+        if spec.db_key is None:
+            continue
+        if spec.is_subdoc:
+            lines.append(f"    value_{i} = self.{spec.name}.to_mongodb_doc()")
+        else:
+            lines.append(f"    value_{i} = self.{spec.name}")
+            if spec.raw_value_to_bson is not None:
+                namespace[f"_to_bson_{i}"] = spec.raw_value_to_bson
+                if spec.bypass_none:
+                    lines += [
+                        f"    if value_{i} is not None:",
+                        f"        value_{i} = _to_bson_{i}(value_{i})",
+                    ]
+                else:
+                    lines.append(f"    value_{i} = _to_bson_{i}(value_{i})")
+        items.append(f"{spec.db_key!r}: value_{i}")
+    lines.append(f"    return {{{', '.join(items)}}}")
+    return _compile(cls, "to_mongodb_doc", lines, namespace)
+
+
+def build_to_dict(cls):
+    namespace = {}
+
+    def masked_lines(i, spec):
+        if spec.is_subdoc:
+            namespace[f"_subdoc_{i}"] = spec.field.data_model_type
+            namespace[f"_default_dict_{i}"] = spec.default.to_dict(mask_default=True)
+            return [
+                f"        value = self.{spec.name}",
+                f"        if type(value) is _subdoc_{i}:",
+                "            subdoc_dict = value.to_dict(True)",
+                f"            if subdoc_dict != _default_dict_{i}:",
+                f"                prepared_dict[{spec.name!r}] = subdoc_dict",
+            ]
+        if spec.default is None:
+            test = "value is not None"
+        else:
+            namespace[f"_default_{i}"] = spec.default
+            test = f"not value == _default_{i}"
+        lines = [
+            f"        value = self.{spec.name}",
+            f"        if {test}:",
+        ]
+        if spec.value_to_json is not None:
+            namespace[f"_to_json_{i}"] = spec.value_to_json
+            if spec.default is None:
+                lines.append(f"            value = _to_json_{i}(value)")
+            else:
+                lines += [
+                    "            if value is not None:",
+                    f"                value = _to_json_{i}(value)",
+                ]
+        lines.append(f"            prepared_dict[{spec.name!r}] = value")
+        return lines
+
+    def unmasked_lines(i, spec):
+        namespace[f"_subdoc_{i}"] = spec.field.data_model_type
+        return [
+            f"        value = self.{spec.name}",
+            f"        if type(value) is _subdoc_{i}:",
+            f"            prepared_dict[{spec.name!r}] = value.to_dict(False)",
+        ]
+
+    lines = [
+        "def to_dict(self, mask_default=False):",
+        "    if mask_default:",
+        "        prepared_dict = {}",
+    ]
+    for i, spec in enumerate(cls._fields):
+        lines += masked_lines(i, spec)
+    lines.append("        return prepared_dict")
+
+    # without masking every plain field is copied, so the fields before the
+    # first subdoc or json converted field become one dict literal
+    leading = []
+    for spec in cls._fields:
+        if spec.is_subdoc or spec.value_to_json is not None:
+            break
+        leading.append(f"{spec.name!r}: self.{spec.name}")
+    lines.append(f"    prepared_dict = {{{', '.join(leading)}}}")
+    for i, spec in enumerate(cls._fields[len(leading):], len(leading)):
+        if spec.is_subdoc:
+            lines += [line[4:] for line in unmasked_lines(i, spec)]
+        elif spec.value_to_json is not None:
+            lines += [
+                f"    value = self.{spec.name}",
+                f"    prepared_dict[{spec.name!r}] = "
+                f"None if value is None else _to_json_{i}(value)",
+            ]
+        else:
+            lines.append(f"    prepared_dict[{spec.name!r}] = self.{spec.name}")
+    lines.append("    return prepared_dict")
+    return _compile(cls, "to_dict", lines, namespace)
+
+
+def build_encode_json(cls):
+    """Writes the JSON text of `to_dict(mask_default)` without building the dict.
+
+    Keys are written from precomputed `"name": ` prefixes, values go through
+    `encode`, and a subdoc is masked by comparing its JSON text with the
+    JSON text of the subdoc default, cached per `encode` function."""
+    namespace = {}
+    lines = [
+        "def encode_json(self, mask_default, encode):",
+        "    parts = []",
+        "    append = parts.append",
+    ]
+    for i, spec in enumerate(cls._fields):
+        prefix = repr(json.dumps(spec.name) + ": ")
+        lines.append(f"    value = self.{spec.name}")
+        if spec.is_subdoc:
+            namespace[f"_subdoc_{i}"] = spec.field.data_model_type
+            namespace[f"_default_{i}"] = spec.default
+            namespace[f"_default_json_{i}"] = {}
+            lines += [
+                f"    if type(value) is _subdoc_{i}:",
+                "        subdoc_json = value.encode_json(mask_default, encode)",
+                "        if mask_default:",
+                f"            default_json = _default_json_{i}.get(encode)",
+                "            if default_json is None:",
+                f"                default_json = _default_json_{i}[encode] = \\",
+                f"                    _default_{i}.encode_json(True, encode)",
+                "        if not mask_default or subdoc_json != default_json:",
+                f"            append({prefix} + subdoc_json)",
+            ]
+            continue
+        if spec.default is None:
+            test = "not mask_default or value is not None"
+        else:
+            namespace[f"_default_{i}"] = spec.default
+            test = f"not mask_default or not value == _default_{i}"
+        lines.append(f"    if {test}:")
+        if spec.value_to_json is not None:
+            namespace[f"_to_json_{i}"] = spec.value_to_json
+            lines += [
+                "        if value is not None:",
+                f"            value = _to_json_{i}(value)",
+            ]
+        lines.append(f"        append({prefix} + encode(value))")
+    lines.append("    return '{' + ', '.join(parts) + '}'")
+    return _compile(cls, "encode_json", lines, namespace)
+
+
+builders = {
+    "from_mongodb_doc": build_from_mongodb_doc,
+    "to_mongodb_doc": build_to_mongodb_doc,
+    "to_dict": build_to_dict,
+    "encode_json": build_encode_json,
+}
+
+
+def install_specialized_methods(cls):
+    """Replaces the generic conversion methods of `cls` with generated ones.
+
+    Methods defined on the class itself are left alone."""
+    for method_name, build in builders.items():
+        if method_name not in vars(cls):
+            setattr(cls, method_name, build(cls))
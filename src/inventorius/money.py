@@ -0,0 +1,144 @@
+"""Fixed-point money amounts.
+
+A `Money` is an integer count of minor units plus a unit code. The
+number of decimal places of a unit is given by `MINOR_UNIT_EXPONENTS`,
+e.g. USD amounts are kept in 1/10000 dollars. Arithmetic on amounts is
+exact integer arithmetic, so totals over many batches never drift.
+
+Amounts are stored in mongodb as `{"unit": "USD", "value": Decimal128}`,
+the same layout as before, and are written to json as
+`{"unit": "USD", "value": float}`. The Decimal128 values are packed and
+unpacked directly from their 128 bit BID encoding instead of going
+through `decimal.Decimal` and `str`.
+"""
+from decimal import Context, Decimal, ROUND_HALF_EVEN
+
+from bson.decimal128 import Decimal128
+
+MINOR_UNIT_EXPONENTS = {
+    "USD": 4,
+}
+
+_EXPONENT_BIAS = 6176
+_COEFFICIENT_MASK = (1 << 113) - 1
+# wide enough to scale any Decimal128 without rounding
+_CONTEXT = Context(prec=80, rounding=ROUND_HALF_EVEN)
+
+
+def minor_unit_exponent(unit):
+    try:
+        return MINOR_UNIT_EXPONENTS[unit]
+    except KeyError:
+        raise ValueError(f"unsupported currency unit '{unit}'") from None
+
+
+class Money():
+    __slots__ = ("minor_units", "unit")
+
+    def __init__(self, minor_units, unit="USD"):
+        minor_unit_exponent(unit)
+        self.minor_units = minor_units
+        self.unit = unit
+
+    @classmethod
+    def from_value(cls, value, unit="USD"):
+        """Rounds a number or decimal string to the minor units of `unit`."""
+        exponent = minor_unit_exponent(unit)
+        if type(value) is int:
+            return cls(value * 10**exponent, unit)
+        return cls(_decimal_to_minor_units(Decimal(str(value)), exponent), unit)
+
+    @classmethod
+    def from_json(cls, json):
+        """Converts `{"unit": ..., "value": ...}` to Money."""
+        return cls.from_value(json["value"], json["unit"])
+
+    def to_json(self):
+        exponent = MINOR_UNIT_EXPONENTS[self.unit]
+        return {"unit": self.unit, "value": self.minor_units / 10**exponent}
+
+    @classmethod
+    def from_bson(cls, bson):
+        return cls(decimal128_to_minor_units(
+            bson["value"], minor_unit_exponent(bson["unit"])), bson["unit"])
+
+    def to_bson(self):
+        return {"unit": self.unit, "value": minor_units_to_decimal128(
+            self.minor_units, MINOR_UNIT_EXPONENTS[self.unit])}
+
+    @classmethod
+    def sum(cls, amounts, unit="USD"):
+        """Exact total of an iterable of Money amounts, all in `unit`.
+
+        None entries (unset costs) are skipped."""
+        total = 0
+        for amount in amounts:
+            if amount is None:
+                continue
+            if amount.unit != unit:
+                raise ValueError(
+                    f"can not add '{amount.unit}' amount to '{unit}' total")
+            total += amount.minor_units
+        return cls(total, unit)
+
+    def __add__(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        if other.unit != self.unit:
+            raise ValueError(
+                f"can not add '{other.unit}' amount to '{self.unit}' amount")
+        return Money(self.minor_units + other.minor_units, self.unit)
+
+    def __mul__(self, count):
+        if type(count) is not int:
+            return NotImplemented
+        return Money(self.minor_units * count, self.unit)
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        return self.minor_units == other.minor_units and self.unit == other.unit
+
+    def __hash__(self):
+        return hash((self.minor_units, self.unit))
+
+    def __repr__(self):
+        return f"Money({self.minor_units}, {self.unit!r})"
+
+
+def minor_units_to_decimal128(minor_units, exponent):
+    """Packs `minor_units * 10**-exponent` as a Decimal128."""
+    sign = 0
+    if minor_units < 0:
+        sign = 1 << 127
+        minor_units = -minor_units
+    if minor_units > _COEFFICIENT_MASK:
+        raise ValueError("money amount does not fit in a Decimal128")
+    bits = sign | (_EXPONENT_BIAS - exponent) << 113 | minor_units
+    return Decimal128.from_bid(bits.to_bytes(16, "little"))
+
+
+def decimal128_to_minor_units(value, exponent):
+    """Unpacks a Decimal128 to minor units, rounding half to even."""
+    bits = int.from_bytes(value.bid, "little")
+    high = bits >> 64
+    if high & 0x6000000000000000 == 0x6000000000000000:
+        # infinity, nan or a noncanonical coefficient
+        return _decimal_to_minor_units(value.to_decimal(), exponent)
+    coefficient = bits & _COEFFICIENT_MASK
+    shift = ((high >> 49) & 0x3fff) - _EXPONENT_BIAS + exponent
+    if shift >= 0:
+        minor_units = coefficient * 10**shift
+    else:
+        minor_units, remainder = divmod(coefficient, 10**-shift)
+        if remainder:
+            return _decimal_to_minor_units(value.to_decimal(), exponent)
+    return -minor_units if high >> 63 else minor_units
+
+
+def _decimal_to_minor_units(value, exponent):
+    if not value.is_finite():
+        raise ValueError(f"money amount must be finite, not {value}")
+    return int(value.scaleb(exponent, _CONTEXT).to_integral_value(context=_CONTEXT))
@@ -1,11 +1,15 @@
-from flask import Response, url_for
+from flask import Response, request, url_for
 import json
 from flask_login import current_user
 from flask_login.utils import encode_cookie
 
+from inventorius.cache import cached_response, document_rev
 from inventorius.db import db
-from inventorius.data_models import DataModel, DataModelJSONEncoder, UserData, Batch, Bin
+from inventorius.data_models import DataModel, DataModelJSONEncoder, UserData, Batch, Bin, Sku
+from inventorius.json_encoding import value_encoder
+from inventorius.revisions import rev_etag
 import inventorius.resource_operations as operations
+from inventorius.stock import item_locations
 
 # operation = {
 #   "rel": operation name (resource method),
@@ -21,29 +25,73 @@ class BlankEncoder(json.JSONEncoder):
         return {}
 
 
+encode_blank = value_encoder(BlankEncoder)
+
+
 class HypermediaEndpoint:
-    def __init__(self, resource_uri=None, state=None, operations=None):
+    # the collection of endpoints that show one stored document, see
+    # cached_get_response
+    collection_name = None
+
+    def __init__(self, resource_uri=None, state=None, operations=None, mask_default=True):
         self.resource_uri = resource_uri
         self.state = state
         self.operations = operations
+        # only used when state is a DataModel
+        self.mask_default = mask_default
 
     def get_response(self, status_code=200, mimetype="application/json"):
         resp = Response()
         resp.status_code = status_code
         resp.mimetype = mimetype
 
-        data = {}
+        # same text as json.dumps of the {"Id", "state", "operations"} dict,
+        # but a DataModel state is written directly by encode_json
+        parts = []
         if self.resource_uri is not None:
-            data["Id"] = self.resource_uri
+            parts.append('"Id": ' + encode_blank(self.resource_uri))
         if self.state is not None:
             if isinstance(self.state, DataModel):
-                data["state"] = self.state.to_dict(mask_default=True)
+                state_json = self.state.encode_json(self.mask_default, encode_blank)
             else:
-                data["state"] = self.state
+                state_json = encode_blank(self.state)
+            parts.append('"state": ' + state_json)
         if self.operations is not None:
-            data["operations"] = self.operations
+            parts.append('"operations": ' + encode_blank(self.operations))
+
+        resp.data = "{" + ", ".join(parts) + "}"
+        return resp
 
-        resp.data = json.dumps(data, cls=BlankEncoder)
+    @classmethod
+    def from_mongodb_doc(cls, doc):
+        raise NotImplementedError()
+
+    @classmethod
+    def cached_get_response(cls, doc_id):
+        """The get_response of stored document `doc_id`, or None if it is missing.
+
+        The body is cached by document revision, so a GET of an unchanged
+        document skips decoding, url_for and json encoding. The revision is
+        sent as a strong ETag; a GET whose If-None-Match has it gets a 304
+        after reading nothing but the revision."""
+        if request.if_none_match:
+            exists, rev = document_rev(db, cls.collection_name, doc_id)
+            if not exists:
+                return None
+            if rev is not None and request.if_none_match.contains_weak(rev_etag(rev)):
+                resp = Response(status=304)
+                resp.set_etag(rev_etag(rev))
+                return resp
+
+        cached = cached_response(
+            db, cls.collection_name, doc_id, request.script_root,
+            lambda doc: cls.from_mongodb_doc(doc).get_response().get_data())
+        if cached is None:
+            return None
+        body, rev = cached
+        resp = Response(body, status=200, mimetype="application/json")
+        if rev is not None:
+            resp.set_etag(rev_etag(rev))
         return resp
 
     def redirect_response(self, redirect=True):
@@ -132,11 +180,17 @@ class PrivateProfile(Profile):
 
 
 class BatchEndpoint(HypermediaEndpoint):
+    collection_name = "batch"
+
+    @classmethod
+    def from_mongodb_doc(cls, doc):
+        return cls.from_batch(Batch.from_mongodb_doc(doc))
+
     @classmethod
     def from_batch(cls, data_batch: Batch):
         endpoint = BatchEndpoint(
             resource_uri=url_for("batch.batch_get", id=data_batch.id),
-            state=data_batch.to_dict(mask_default=True),
+            state=data_batch,
             operations=[
                 operations.batch_update(data_batch.id),
                 operations.batch_delete(data_batch.id),
@@ -177,13 +231,8 @@ class BatchBinsEndpoint(HypermediaEndpoint):
         if not retrieve:
             raise NotImplementedError()
 
-        contained_by_bins = [
-            Bin.from_mongodb_doc(bson)
-            for bson in db.bin.find({
-                f"contents.{batch_id}": {"$exists": True}
-            })]
-        locations = {bin.id: {batch_id: bin.contents[batch_id]}
-                     for bin in contained_by_bins}
+        locations = {bin_id: {batch_id: quantity}
+                     for bin_id, quantity in item_locations(db, batch_id).items()}
 
         endpoint = BatchBinsEndpoint(
             resource_uri=url_for("batch.batch_bins_get", id=batch_id),
@@ -193,11 +242,18 @@ class BatchBinsEndpoint(HypermediaEndpoint):
 
 
 class BinEndpoint(HypermediaEndpoint):
+    collection_name = "bin"
+
+    @classmethod
+    def from_mongodb_doc(cls, doc):
+        return cls.from_bin(Bin.from_mongodb_doc(doc))
+
     @classmethod
     def from_bin(cls, bin):
         endpoint = BinEndpoint(
             resource_uri=url_for("bin.bin_get", id=bin.id),
-            state=bin.to_dict(),
+            state=bin,
+            mask_default=False,
             operations=[
                 operations.bin_update(bin.id),
                 operations.bin_delete(bin.id),
@@ -216,11 +272,18 @@ class BinEndpoint(HypermediaEndpoint):
 
 
 class SkuEndpoint(HypermediaEndpoint):
+    collection_name = "sku"
+
+    @classmethod
+    def from_mongodb_doc(cls, doc):
+        return cls.from_sku(Sku.from_mongodb_doc(doc))
+
     @classmethod
     def from_sku(cls, sku):
         endpoint = SkuEndpoint(
             resource_uri=url_for("sku.sku_get", id=sku.id),
-            state=sku.to_dict(),
+            state=sku,
+            mask_default=False,
             operations=[
                 operations.sku_update(sku.id),
                 operations.sku_delete(sku.id),
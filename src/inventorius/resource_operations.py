@@ -63,4 +63,14 @@ def sku_delete(id):
     return operation("delete", DELETE, url_for("sku.sku_delete", id=id))
 
 def sku_bins(id):
-    return operation("bins", GET, url_for("sku.sku_bins_get", id=id))
\ No newline at end of file
+    return operation("bins", GET, url_for("sku.sku_bins_get", id=id))
+
+
+def search_next(query, limit, continuation):
+    return operation("next", GET, url_for(
+        "inventorius.search", query=query, limit=limit, continuation=continuation))
+
+
+def search_prev(query, limit, starting_from):
+    return operation("prev", GET, url_for(
+        "inventorius.search", query=query, limit=limit, startingFrom=starting_from))
@@ -0,0 +1,48 @@
+"""Revision numbers of the sku, batch and bin documents.
+
+Every write to one of these documents also increments its `_rev` field, so
+`(_id, _rev)` names one version of a document. New documents start at their
+insert time in microseconds instead of at 1, so a document that is deleted
+and created again under the same id doesn't reuse the revisions of the old
+one. Documents written before revisions were added get one on their next
+write.
+
+`_rev` is not a model field; models skip it when reading documents.
+
+The revision is also the strong ETag of the GET response of a document,
+and PATCH handlers take `If-Match` as a condition on `_rev`.
+"""
+from time import time_ns
+
+REV_KEY = "_rev"
+
+
+def with_rev(doc):
+    """Gives a new document its first revision, and returns it."""
+    doc[REV_KEY] = time_ns() // 1000
+    return doc
+
+
+def bump_rev(update):
+    """The update document `update`, also incrementing `_rev`."""
+    return {**update, "$inc": {**update.get("$inc", {}), REV_KEY: 1}}
+
+
+def rev_etag(rev):
+    """The ETag (unquoted) of a revision, or None for a document without one."""
+    return None if rev is None else str(rev)
+
+
+def if_match_query(if_match):
+    """The query condition of an If-Match header (werkzeug ETags).
+
+    Empty when there is no header or it is `*`. Weak and foreign tags
+    match no revision."""
+    if not if_match or if_match.star_tag:
+        return {}
+    return {REV_KEY: {"$in": [int(tag) for tag in if_match.as_set()
+                            if tag.isascii() and tag.isdigit()]}}
+
+
+def if_match_allows(if_match, rev):
+    return not if_match or if_match.contains(rev_etag(rev) or "")
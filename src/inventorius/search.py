@@ -0,0 +1,353 @@
+"""Paged search over several query branches.
+
+A search is a list of `SearchBranch`es (label lookup, owned codes,
+associated codes, text index, ...). The results of a search are the
+results of each branch in turn, each branch ordered by `_id`. Pages are
+read from the database with a limit, so only the documents on the page are
+decoded; the total is counted separately with `count_documents`.
+
+A page can be asked for by offset (`startingFrom`) or with the
+continuation token of the previous page. The token records the branch and
+the last `_id` returned, so the next page is an `_id > last` range scan
+instead of a skip over everything before it. Tokens are opaque to clients.
+
+The branch queries are independent, so they run concurrently on one
+process wide thread pool (INVENTORIUS_SEARCH_THREADS workers, default 8):
+first the counts of every branch, then the finds of the branches that the
+page covers. Results are merged in branch order. The time of each query is
+kept on the page and sent back in a Server-Timing header.
+
+Setting INVENTORIUS_SEARCH_ENGINE=union runs every branch in one
+aggregation instead, joined with `$unionWith` (mongodb 4.4+). Hits are
+deduplicated by `_id` and ranked: exact id and debug listings first, then
+owned codes, associated codes, and text matches by text score. Only the
+`_id` and rank of each hit go through the union, which may spill to disk;
+the documents of the page are read afterwards, one `$in` query per
+collection. Pages of the union are read by offset.
+"""
+import base64
+import binascii
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from time import perf_counter
+
+from inventorius.data_models import Batch, Bin, Sku
+from inventorius.codes import ASSOCIATED, OWNED, lookup_code
+from inventorius.indexes import has_index
+
+search_engine = os.getenv("INVENTORIUS_SEARCH_ENGINE", "branches")
+
+if search_engine not in ("branches", "union"):
+    print(f"INVENTORIUS_SEARCH_ENGINE={search_engine} ignored: "
+          "expected 'branches' or 'union'")
+    search_engine = "branches"
+
+# union ranks, lowest first
+RANK_ID = 0
+RANK_OWNED_CODE = 1
+RANK_ASSOCIATED_CODE = 2
+RANK_TEXT = 3
+
+MODEL_TYPES = {"sku": Sku, "batch": Batch, "bin": Bin}
+
+# one pool per process, shared by every request; the branch queries share
+# the pymongo connection pool of the request's database
+search_threads = int(os.getenv("INVENTORIUS_SEARCH_THREADS", "8"))
+_pool = None
+_pool_lock = Lock()
+
+
+class SearchBranch:
+    def __init__(self, name, collection_name, model_type, filter, rank=RANK_ID):
+        self.name = name
+        self.collection_name = collection_name
+        self.model_type = model_type
+        self.filter = filter
+        self.rank = rank
+
+    def count(self, database):
+        return database[self.collection_name].count_documents(self.filter)
+
+    def find(self, database, after=None, skip=0, limit=0):
+        filter = self.filter
+        if after is not None:
+            filter = {"$and": [filter, {"_id": {"$gt": after}}]}
+        return database[self.collection_name].find(
+            filter, sort=[("_id", 1)], skip=skip, limit=limit)
+
+    def union_pipeline(self):
+        if "$text" in self.filter:
+            score = {"$meta": "textScore"}
+        else:
+            score = 0
+        return [
+            {"$match": self.filter},
+            {"$project": {"_rank": {"$literal": self.rank}, "_score": score,
+                          "_collection": {"$literal": self.collection_name}}},
+        ]
+
+
+def search_branches(database, query):
+    branches = []
+
+    # debug flags
+    if query in ('!ALL', '!SKUS'):
+        branches.append(SearchBranch("sku_all", "sku", Sku, {}))
+    if query in ('!ALL', '!BATCHES'):
+        branches.append(SearchBranch("batch_all", "batch", Batch, {}))
+    if query in ('!ALL', '!BINS'):
+        branches.append(SearchBranch("bin_all", "bin", Bin, {}))
+
+    # search by label
+    if query.startswith('SKU'):
+        branches.append(SearchBranch("sku_id", "sku", Sku, {"_id": query}))
+    if query.startswith('BIN'):
+        branches.append(SearchBranch("bin_id", "bin", Bin, {"_id": query}))
+    if query.startswith('BAT'):
+        branches.append(SearchBranch("batch_id", "batch", Batch, {"_id": query}))
+
+    # one point read on the code registry instead of a query per code field
+    code_owners = {}
+    for row in lookup_code(database, query):
+        code_owners.setdefault((row["owner_type"], row["kind"]), []).append(row["owner_id"])
+    for owner_type, model_type in (("sku", Sku), ("batch", Batch)):
+        for kind, rank in ((OWNED, RANK_OWNED_CODE), (ASSOCIATED, RANK_ASSOCIATED_CODE)):
+            owner_ids = code_owners.get((owner_type, kind))
+            if owner_ids:
+                branches.append(SearchBranch(
+                    f"{owner_type}_{kind}_codes", owner_type, model_type,
+                    {"_id": {"$in": sorted(owner_ids)}}, rank))
+
+    if has_index(database, "sku", "name_text"):
+        branches.append(SearchBranch(
+            "sku_text", "sku", Sku, {"$text": {"$search": query}}, RANK_TEXT))
+    if has_index(database, "batch", "name_text"):
+        branches.append(SearchBranch(
+            "batch_text", "batch", Batch, {"$text": {"$search": query}}, RANK_TEXT))
+    return branches
+
+
+class Position:
+    """Where a page starts: `offset` results in, inside branch `branch`,
+    after the document `after` (None for the start of the branch)."""
+
+    def __init__(self, offset, branch=0, after=None):
+        self.offset = offset
+        self.branch = branch
+        self.after = after
+
+
+def encode_continuation(query, position):
+    token = json.dumps({"q": query, "o": position.offset,
+                        "b": position.branch, "a": position.after},
+                       separators=(",", ":"))
+    return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii")
+
+
+def decode_continuation(query, continuation):
+    """Returns the Position of a continuation token.
+
+    Raises ValueError if the token is malformed or belongs to another query."""
+    try:
+        token = json.loads(base64.urlsafe_b64decode(continuation.encode("ascii")))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("malformed continuation token") from None
+    if not (isinstance(token, dict)
+            and token.get("q") == query
+            and type(token.get("o")) is int and token["o"] >= 0
+            and type(token.get("b")) is int and token["b"] >= 0
+            and isinstance(token.get("a"), (str, type(None)))):
+        raise ValueError("continuation token does not match query")
+    return Position(token["o"], token["b"], token["a"])
+
+
+def locate_offset(counts, offset):
+    """The Position of the `offset`th result, and the skip into its branch."""
+    remaining = offset
+    for branch, count in enumerate(counts):
+        if remaining < count:
+            return Position(offset, branch), remaining
+        remaining -= count
+    return Position(offset, len(counts)), 0
+
+
+class SearchPage:
+    def __init__(self, results, total, offset, next_position, timings=()):
+        self.results = results
+        self.total = total
+        self.offset = offset
+        # None on the last page
+        self.next_position = next_position
+        # [(name, seconds)] of each database call, for diagnostics
+        self.timings = timings
+
+    def server_timing(self):
+        """The value of a Server-Timing header listing `timings`."""
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}"
+                         for name, seconds in self.timings)
+
+
+def branch_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(
+                    max_workers=search_threads, thread_name_prefix="search")
+    return _pool
+
+
+def timed(call):
+    start = perf_counter()
+    result = call()
+    return result, perf_counter() - start
+
+
+def run_branches(calls, timings):
+    """Runs `[(name, call)]` on the search thread pool.
+
+    Returns the results in the order of `calls` and appends `(name, seconds)`
+    to `timings`, also in order. With INVENTORIUS_SEARCH_THREADS=1 (or a
+    single call) everything runs on the calling thread."""
+    if search_threads <= 1 or len(calls) <= 1:
+        timed_results = [timed(call) for name, call in calls]
+    else:
+        pool = branch_pool()
+        futures = [pool.submit(timed, call) for name, call in calls]
+        timed_results = [future.result() for future in futures]
+
+    results = []
+    for (name, call), (result, seconds) in zip(calls, timed_results):
+        timings.append((name, seconds))
+        results.append(result)
+    return results
+
+
+def search_page(database, query, limit, starting_from=0, continuation=None):
+    """Reads one page of search results.
+
+    Raises ValueError for a bad continuation token."""
+    if search_engine == "union":
+        return union_search_page(database, query, limit, starting_from, continuation)
+    return branches_search_page(database, query, limit, starting_from, continuation)
+
+
+def branches_search_page(database, query, limit, starting_from=0, continuation=None):
+    branches = search_branches(database, query)
+    timings = []
+    counts = run_branches(
+        [(f"{branch.name}-count", partial(branch.count, database)) for branch in branches],
+        timings)
+    total = sum(counts)
+
+    if continuation is not None:
+        position = decode_continuation(query, continuation)
+        skip = 0
+        # results of the first branch that earlier pages already returned
+        consumed = position.offset - sum(counts[:position.branch])
+    else:
+        position, skip = locate_offset(counts, starting_from)
+        consumed = skip
+
+    # every branch that can contribute to this page, fetched all at once
+    calls = []
+    needed = limit
+    branch_index = position.branch
+    after = position.after
+    while branch_index < len(branches) and needed > 0:
+        branch = branches[branch_index]
+        calls.append((f"{branch.name}-find", partial(
+            fetch_branch, branch, database, after, skip, needed)))
+        needed -= counts[branch_index] - consumed
+        branch_index += 1
+        after = None
+        skip = 0
+        consumed = 0
+    fetched = run_branches(calls, timings)
+
+    results = []
+    last_position = position
+    for branch_index, docs in enumerate(fetched, position.branch):
+        docs = docs[:limit - len(results)]
+        if not docs:
+            continue
+        results.extend(docs)
+        last_position = Position(position.offset + len(results),
+                                 branch_index, docs[-1].id)
+
+    next_position = None
+    if results and last_position.offset < total:
+        next_position = last_position
+    return SearchPage(results, total, position.offset, next_position, timings)
+
+
+def fetch_branch(branch, database, after, skip, limit):
+    return [branch.model_type.from_mongodb_doc(doc)
+            for doc in branch.find(database, after, skip, limit)]
+
+
+def union_pipeline(branches, skip, limit):
+    """One pipeline, run on the collection of `branches[0]`, that returns
+    `[{"total": [{"count": n}], "page": [...]}]`, where the page holds the
+    `_id`, `_rank`, `_score` and `_collection` of each hit."""
+    pipeline = list(branches[0].union_pipeline())
+    for branch in branches[1:]:
+        pipeline.append({"$unionWith": {
+            "coll": branch.collection_name,
+            "pipeline": branch.union_pipeline(),
+        }})
+    order = {"_rank": 1, "_score": -1, "_id": 1}
+    pipeline += [
+        # keep the best ranked hit of each document
+        {"$sort": order},
+        {"$group": {"_id": "$_id", "doc": {"$first": "$$ROOT"}}},
+        {"$replaceRoot": {"newRoot": "$doc"}},
+        {"$sort": order},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            # $limit must be positive, an empty page is sliced off by the caller
+            "page": [{"$skip": skip}, {"$limit": max(limit, 1)}],
+        }},
+    ]
+    return pipeline
+
+
+def union_search_page(database, query, limit, starting_from=0, continuation=None):
+    if continuation is not None:
+        offset = decode_continuation(query, continuation).offset
+    else:
+        offset = starting_from
+
+    branches = search_branches(database, query)
+    if not branches:
+        return SearchPage([], 0, offset, None)
+    pipeline = union_pipeline(branches, offset, limit)
+    facets, seconds = timed(lambda: next(database[branches[0].collection_name].aggregate(
+        pipeline, allowDiskUse=True)))
+    timings = [("union", seconds)]
+    total = facets["total"][0]["count"] if facets["total"] else 0
+    hits = facets["page"][:limit]
+
+    page_ids = {}
+    for hit in hits:
+        page_ids.setdefault(hit["_collection"], []).append(hit["_id"])
+    docs = {}
+    for collection_name, ids in page_ids.items():
+        found, seconds = timed(lambda: list(database[collection_name].find({"_id": {"$in": ids}})))
+        timings.append((f"{collection_name}-page", seconds))
+        docs.update(((collection_name, doc["_id"]), doc) for doc in found)
+
+    # a hit deleted since the union ran is left out of the page
+    results = []
+    for hit in hits:
+        doc = docs.get((hit["_collection"], hit["_id"]))
+        if doc is not None:
+            results.append(MODEL_TYPES[hit["_collection"]].from_mongodb_doc(doc))
+
+    next_position = None
+    if hits and offset + len(hits) < total:
+        next_position = Position(offset + len(hits))
+    return SearchPage(results, total, offset, next_position, timings)
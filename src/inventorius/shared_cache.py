@@ -0,0 +1,241 @@
+"""Host wide tier of the entity cache, shared by every worker process.
+
+Set INVENTORIUS_SHARED_CACHE to a file path (ideally on tmpfs, e.g.
+`/dev/shm/inventorius-api-cache`) and every worker maps that file as one
+hash table of fixed size slots. A document read from mongodb by one worker
+is then a hit for all of them, including workers forked after it was read.
+Memory is INVENTORIUS_SHARED_CACHE_MB (default 64) however many workers run.
+
+The file starts with a header:
+
+    magic (8 bytes) | slot count (u32) | slot size (u32) | generation (u64)
+
+followed by the slots, each:
+
+    sequence (u64) | key hash (u64) | expires (f64) | key length (u32) |
+    value length (u32) | key | value
+
+A key hashes to a window of PROBE consecutive slots. Readers don't lock:
+a writer makes the slot's sequence odd while it writes and even again
+after, and a reader that sees an odd or changed sequence treats the slot
+as a miss (a seqlock). Writers take an flock on the file, plus a thread
+lock since flocks are per open file.
+
+Like `EntityCache`, the header generation is bumped by every invalidation,
+and a `put` of a read that started before one is dropped. Expiry uses the
+monotonic clock, which Linux shares between processes. Values larger than
+a slot (INVENTORIUS_SHARED_CACHE_SLOT_BYTES, default 4096, minus the slot
+header and key) are not stored.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+from threading import Lock
+from time import monotonic
+
+path = os.getenv("INVENTORIUS_SHARED_CACHE")
+size_mb = float(os.getenv("INVENTORIUS_SHARED_CACHE_MB", "64"))
+slot_bytes = int(os.getenv("INVENTORIUS_SHARED_CACHE_SLOT_BYTES", "4096"))
+
+MAGIC = b"INVCACH1"
+HEADER = struct.Struct("<8sIIQ")
+GENERATION_OFFSET = 16
+GENERATION = struct.Struct("<Q")
+SLOT_HEADER = struct.Struct("<QQdII")
+SEQUENCE = struct.Struct("<Q")
+PROBE = 4
+
+
+def key_bytes(database_name, collection_name, doc_id):
+    return "\0".join((database_name, collection_name, str(doc_id))).encode("utf-8")
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class SharedTable:
+    def __init__(self, path, slot_count, slot_size):
+        if slot_size <= SLOT_HEADER.size:
+            raise ValueError(f"slot size must be more than {SLOT_HEADER.size} bytes")
+        self.path = path
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        length = HEADER.size + slot_count * slot_size
+        with self.locked():
+            header = os.pread(self.fd, HEADER.size, 0)
+            if (os.fstat(self.fd).st_size != length or len(header) < HEADER.size
+                    or HEADER.unpack(header)[:3] != (MAGIC, slot_count, slot_size)):
+                # new file, or one made with other settings: start empty
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, length)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, slot_count, slot_size, 0), 0)
+        self.map = mmap.mmap(self.fd, length)
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+
+    def locked(self):
+        return _FileLock(self)
+
+    def generation(self):
+        return GENERATION.unpack_from(self.map, GENERATION_OFFSET)[0]
+
+    def _bump_generation(self):
+        GENERATION.pack_into(self.map, GENERATION_OFFSET, self.generation() + 1)
+
+    def _slots(self, hashed):
+        first = hashed % self.slot_count
+        for i in range(min(PROBE, self.slot_count)):
+            yield HEADER.size + (first + i) % self.slot_count * self.slot_size
+
+    def _read(self, offset, key, hashed):
+        """The value in the slot at `offset` if it holds `key`, else None."""
+        sequence, slot_hash, expires, key_length, value_length = \
+            SLOT_HEADER.unpack_from(self.map, offset)
+        if sequence % 2 or slot_hash != hashed or key_length != len(key):
+            return None
+        start = offset + SLOT_HEADER.size
+        slot_key = self.map[start:start + key_length]
+        value = self.map[start + key_length:start + key_length + value_length]
+        if SEQUENCE.unpack_from(self.map, offset)[0] != sequence:
+            # a writer changed the slot while it was read
+            return None
+        if slot_key != key or expires <= monotonic():
+            return None
+        return value
+
+    def get(self, key):
+        hashed = key_hash(key)
+        for offset in self._slots(hashed):
+            value = self._read(offset, key, hashed)
+            if value is not None:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def _write(self, offset, hashed=0, expires=0.0, key=b"", value=b""):
+        sequence = SEQUENCE.unpack_from(self.map, offset)[0]
+        SEQUENCE.pack_into(self.map, offset, sequence + 1)
+        start = offset + SLOT_HEADER.size
+        self.map[start:start + len(key) + len(value)] = key + value
+        SLOT_HEADER.pack_into(self.map, offset, sequence + 1, hashed, expires,
+                              len(key), len(value))
+        SEQUENCE.pack_into(self.map, offset, sequence + 2)
+
+    def put(self, key, value, ttl_seconds, generation):
+        """Stores `value` unless something was invalidated since `generation`."""
+        if SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+            return
+        hashed = key_hash(key)
+        now = monotonic()
+        with self.locked():
+            if self.generation() != generation:
+                return
+            # the slot of this key, else a free or expired one, else the
+            # one that expires first
+            victim = None
+            victim_expires = None
+            for offset in self._slots(hashed):
+                _, slot_hash, expires, key_length, _ = \
+                    SLOT_HEADER.unpack_from(self.map, offset)
+                start = offset + SLOT_HEADER.size
+                if slot_hash == hashed and self.map[start:start + key_length] == key:
+                    victim = offset
+                    break
+                if victim is None or expires < victim_expires:
+                    victim, victim_expires = offset, expires
+            self._write(victim, hashed, now + ttl_seconds, key, value)
+
+    def invalidate(self, keys):
+        with self.locked():
+            self._bump_generation()
+            for key in keys:
+                hashed = key_hash(key)
+                for offset in self._slots(hashed):
+                    _, slot_hash, _, key_length, _ = SLOT_HEADER.unpack_from(self.map, offset)
+                    start = offset + SLOT_HEADER.size
+                    if slot_hash == hashed and self.map[start:start + key_length] == key:
+                        self._write(offset)
+
+    def invalidate_prefix(self, prefix):
+        with self.locked():
+            self._bump_generation()
+            for slot in range(self.slot_count):
+                offset = HEADER.size + slot * self.slot_size
+                _, _, _, key_length, _ = SLOT_HEADER.unpack_from(self.map, offset)
+                start = offset + SLOT_HEADER.size
+                if key_length and self.map[start:start + key_length].startswith(prefix):
+                    self._write(offset)
+
+    def clear(self):
+        with self.locked():
+            self._bump_generation()
+            for slot in range(self.slot_count):
+                offset = HEADER.size + slot * self.slot_size
+                if SLOT_HEADER.unpack_from(self.map, offset)[3]:
+                    self._write(offset)
+
+    def stats(self):
+        used = 0
+        now = monotonic()
+        for slot in range(self.slot_count):
+            offset = HEADER.size + slot * self.slot_size
+            _, _, expires, key_length, _ = SLOT_HEADER.unpack_from(self.map, offset)
+            if key_length and expires > now:
+                used += 1
+        return {
+            "path": self.path,
+            "slots": self.slot_count,
+            "slot_bytes": self.slot_size,
+            "entries": used,
+            # of this worker only
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class _FileLock:
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        self.table.lock.acquire()
+        try:
+            fcntl.flock(self.table.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.table.lock.release()
+            raise
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.table.fd, fcntl.LOCK_UN)
+        self.table.lock.release()
+
+
+# (pid, SharedTable); opened again after a fork so each worker has its own
+# file descriptor (flocks of a shared descriptor don't exclude each other)
+# and its own thread lock
+_table = None
+_table_lock = Lock()
+
+
+def shared_table():
+    """This process's SharedTable, or None when INVENTORIUS_SHARED_CACHE is unset."""
+    global _table
+    if not path:
+        return None
+    pid = os.getpid()
+    if _table is None or _table[0] != pid:
+        with _table_lock:
+            if _table is None or _table[0] != pid:
+                slot_count = max(1, int(size_mb * 1024 * 1024) // slot_bytes)
+                _table = (pid, SharedTable(path, slot_count, slot_bytes))
+    return _table[1]
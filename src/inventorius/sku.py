@@ -1,14 +1,20 @@
 from flask import Blueprint, request, Response, url_for
 from voluptuous.error import MultipleInvalid
 from voluptuous.schema_builder import Required
-from inventorius.data_models import Sku, Bin, Batch, DataModelJSONEncoder as Encoder
+from inventorius.data_models import Sku, Batch, DataModelJSONEncoder as Encoder
 from inventorius.db import db
 from inventorius.util import admin_increment_code, check_code_list, no_cache
 from inventorius.validation import new_sku_schema, prefixed_id, sku_patch_schema
 import inventorius.util_error_responses as problem
 from inventorius.resource_models import SkuEndpoint
+from inventorius.stock import item_is_stocked, item_locations
+from inventorius.autocomplete import forget_item, index_item
+from inventorius.cache import document_exists, invalidate
+from inventorius.revisions import REV_KEY, bump_rev, if_match_query, rev_etag, with_rev
+from inventorius.codes import (
+    code_changes, owned_code_conflict_reason, register_codes, unregister_codes)
 
-from pymongo import TEXT
+from pymongo import ReturnDocument
 
 import json
 
@@ -27,15 +33,15 @@ def skus_post():
         return problem.duplicate_resource_response("id")
 
     sku = Sku.from_json(json)
+    conflicts = register_codes(
+        db, "sku", [(sku.id, sku.owned_codes, sku.associated_codes)])
+    if conflicts:
+        return problem.duplicate_resource_response(
+            "owned_codes", owned_code_conflict_reason(conflicts[sku.id]))
     admin_increment_code("SKU", sku.id)
-    db.sku.insert_one(sku.to_mongodb_doc())
+    db.sku.insert_one(with_rev(sku.to_mongodb_doc()))
+    index_item(db, "sku", sku)
     # dbSku = Sku.from_mongodb_doc(db.sku.find_one({'id': sku.id}))
-
-    # Add text index if not yet created
-    # TODO: This should probably be turned into a global flag
-    if "name_text" not in db.sku.index_information().keys():
-        # print("Creating text index for sku#name") # was too noisy
-        db.sku.create_index([("name", TEXT)])
     return SkuEndpoint.from_sku(sku).created_success_response()
 
 
@@ -44,10 +50,10 @@ def skus_post():
 def sku_get(id):
     # detailed = request.args.get("details") == "true"
 
-    sku = Sku.from_mongodb_doc(db.sku.find_one({"_id": id}))
-    if sku is None:
+    resp = SkuEndpoint.cached_get_response(id)
+    if resp is None:
         return problem.missing_bin_response(id)
-    return SkuEndpoint.from_sku(sku).get_response()
+    return resp
 
 
 @ sku.route('/api/sku/<id>', methods=['PATCH'])
@@ -58,24 +64,38 @@ def sku_patch(id):
     except MultipleInvalid as e:
         return problem.invalid_params_response(e)
 
-    existing = Sku.from_mongodb_doc(db.sku.find_one({"_id": id}))
-    if not existing:
+    codes_changed = "owned_codes" in json or "associated_codes" in json
+    if codes_changed:
+        old_codes = db.sku.find_one(
+            {"_id": id}, {"owned_codes": 1, "associated_codes": 1})
+        if not old_codes:
+            return problem.invalid_params_response(problem.missing_resource_param_error("id"))
+        new_codes, added_codes, removed_codes = code_changes(old_codes, json)
+        conflicts = register_codes(db, "sku", [(id, *new_codes)])
+        if conflicts:
+            return problem.duplicate_resource_response(
+                "owned_codes", owned_code_conflict_reason(conflicts[id]))
+
+    query = {"_id": id, **if_match_query(request.if_match)}
+    update = Sku.patch_to_mongodb_update(json)
+    if update:
+        updated_sku = Sku.from_mongodb_doc(db.sku.find_one_and_update(
+            query, bump_rev(update), return_document=ReturnDocument.AFTER))
+    else:
+        updated_sku = Sku.from_mongodb_doc(db.sku.find_one(query))
+    if not updated_sku:
+        if codes_changed:
+            unregister_codes(db, id, *added_codes)
+        current = db.sku.find_one({"_id": id}, {REV_KEY: 1})
+        if current is not None:
+            return problem.precondition_failed_response(
+                url_for("sku.sku_get", id=id), rev_etag(current.get(REV_KEY)))
         return problem.invalid_params_response(problem.missing_resource_param_error("id"))
+    invalidate(db, "sku", id)
+    if codes_changed:
+        unregister_codes(db, id, *removed_codes)
+    index_item(db, "sku", updated_sku)
 
-    if "owned_codes" in json:
-        db.sku.update_one({"_id": id},
-                          {"$set": {"owned_codes": json["owned_codes"]}})
-    if "associated_codes" in json:
-        db.sku.update_one({"_id": id},
-                          {"$set": {"associated_codes": json["associated_codes"]}})
-    if "name" in json:
-        db.sku.update_one({"_id": id},
-                          {"$set": {"name": json["name"]}})
-    if "props" in json:
-        db.sku.update_one({"_id": id},
-                          {"$set": {"props": json["props"]}})
-
-    updated_sku = Sku.from_mongodb_doc(db.sku.find_one({"_id": id}))
     return SkuEndpoint.from_sku(updated_sku).updated_success_response()
 
 @ sku.route('/api/sku/<id>', methods=['DELETE'])
@@ -98,9 +118,7 @@ def sku_delete(id):
         })
         return resp
 
-    num_contained_by_bins = db.bin.count_documents(
-        {f"contents.{id}": {"$exists": True}})
-    if num_contained_by_bins > 0:
+    if item_is_stocked(db, id):
         resp.status_code = 403
         resp.mimetype = "application/problem+json"
         resp.data = json.dumps({
@@ -114,6 +132,9 @@ def sku_delete(id):
         return resp
 
     db.sku.delete_one({"_id": existing.id})
+    invalidate(db, "sku", existing.id)
+    unregister_codes(db, existing.id)
+    forget_item(db, existing.id)
     resp.status_code = 204
     return resp
 
@@ -122,8 +143,7 @@ def sku_delete(id):
 def sku_bins_get(id):
     resp = Response()
 
-    existing = Sku.from_mongodb_doc(db.sku.find_one({"_id": id}))
-    if not existing:
+    if not document_exists(db, "sku", id):
         resp.status_code = 404
         resp.mimetype = "application/problem+json"
         resp.data = json.dumps({
@@ -136,9 +156,8 @@ def sku_bins_get(id):
         })
         return resp
 
-    contained_by_bins = [Bin.from_mongodb_doc(bson) for bson in db.bin.find(
-        {f"contents.{id}": {"$exists": True}})]
-    locations = {bin.id: {id: bin.contents[id]} for bin in contained_by_bins}
+    locations = {bin_id: {id: quantity}
+                 for bin_id, quantity in item_locations(db, id).items()}
 
     resp.status_code = 200
     resp.mimetype = "application/json"
@@ -153,8 +172,7 @@ def sku_bins_get(id):
 def sku_batches_get(id):
     resp = Response()
 
-    existing = Sku.from_mongodb_doc(db.sku.find_one({"_id": id}))
-    if not existing:
+    if not document_exists(db, "sku", id):
         resp.status_code = 404
         resp.mimetype = "application/problem+json"
         resp.data = json.dumps({
@@ -167,8 +185,8 @@ def sku_batches_get(id):
         })
         return resp
 
-    batches = [Batch.from_mongodb_doc(bson).id
-               for bson in db.batch.find({"sku_id": id})]
+    batches = [batch.id for batch in Batch.from_mongodb_cursor(
+        db.batch.find({"sku_id": id}, {"_id": 1}))]
     resp.mimetype = "application/json"
     resp.data = json.dumps({
         "state": batches
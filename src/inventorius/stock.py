@@ -0,0 +1,74 @@
+"""The stock collection: one `{item_id, bin_id, quantity}` row per item per bin.
+
+`bin.contents` stays the source of truth. Stock rows mirror it so that
+"which bins hold this item" is an index lookup instead of a scan of every
+bin for `contents.<item_id>`. Handlers that change bin contents call
+`adjust_stock` right after updating the bin, and `remove_bin_stock` when a
+bin is deleted. Rows whose quantity drops to zero are removed, like the
+`$unset` of zero quantities in `bin.contents`.
+
+If the two ever drift apart (e.g. a worker died between the bin write and
+the stock write), `flask rebuild-stock` rebuilds the rows from the bins.
+Until it has run once on a database that had bins before this collection,
+readers query the bins instead (see inventorius.mirrors).
+"""
+from pymongo import DeleteMany, UpdateOne
+
+from inventorius.mirrors import mark_mirror_built, mirror_is_built
+
+
+def adjust_stock(database, changes, session=None):
+    """Applies `(item_id, bin_id, delta)` changes in one ordered bulk write."""
+    requests = []
+    for item_id, bin_id, delta in changes:
+        row = {"item_id": item_id, "bin_id": bin_id}
+        requests.append(UpdateOne(row, {"$inc": {"quantity": delta}}, upsert=True))
+        requests.append(DeleteMany({**row, "quantity": {"$lte": 0}}))
+    if requests:
+        database.stock.bulk_write(requests, ordered=True, session=session)
+
+
+def remove_bin_stock(database, bin_id):
+    database.stock.delete_many({"bin_id": bin_id})
+
+
+def stock_is_built(database):
+    return mirror_is_built(database, "stock", ("bin",))
+
+
+def item_locations(database, item_id):
+    """Returns `{bin_id: quantity}` for every bin holding `item_id`."""
+    if not stock_is_built(database):
+        return {bin["_id"]: bin["contents"][item_id] for bin in database.bin.find(
+            {f"contents.{item_id}": {"$exists": True}}, {f"contents.{item_id}": 1})}
+    return {row["bin_id"]: row["quantity"] for row in database.stock.find(
+        {"item_id": item_id}, {"_id": 0, "bin_id": 1, "quantity": 1})}
+
+
+def item_is_stocked(database, item_id):
+    if not stock_is_built(database):
+        return database.bin.find_one(
+            {f"contents.{item_id}": {"$exists": True}}, {"_id": 1}) is not None
+    return database.stock.find_one({"item_id": item_id}, {"_id": 1}) is not None
+
+
+def rebuild_stock(database, batch_size=1000):
+    """Replaces every stock row with rows built from `bin.contents`.
+
+    Returns the number of rows written."""
+    database.stock.delete_many({})
+    count = 0
+    rows = []
+    for bin in database.bin.find({}, {"contents": 1}):
+        for item_id, quantity in bin.get("contents", {}).items():
+            if quantity > 0:
+                rows.append({"item_id": item_id, "bin_id": bin["_id"], "quantity": quantity})
+        if len(rows) >= batch_size:
+            database.stock.insert_many(rows, ordered=False)
+            count += len(rows)
+            rows = []
+    if rows:
+        database.stock.insert_many(rows, ordered=False)
+        count += len(rows)
+    mark_mirror_built(database, "stock")
+    return count
@@ -4,8 +4,9 @@ from flask.helpers import make_response
 from flask_login import LoginManager
 from flask_principal import Principal, Permission, RoleNeed
 import re
-from string import ascii_letters
 
+from inventorius.codes import OWNED, lookup_code
+from inventorius.data_models import Sku
 from inventorius.db import db
 
 login_manager = LoginManager()
@@ -32,59 +33,99 @@ def get_body_type():
 
 
 def owned_code_get(id):
-    existing = Sku.from_mongodb_doc(
-        db.sku.find_one({'owned_codes': id}))
-    return existing
+    owner_ids = [row["owner_id"] for row in lookup_code(db, id)
+                 if row["kind"] == OWNED and row["owner_type"] == "sku"]
+    if not owner_ids:
+        return None
+    return Sku.from_mongodb_doc(db.sku.find_one({"_id": owner_ids[0]}))
 
 
-def admin_increment_code(prefix, code):
-    code_number = int(re.sub('[^0-9]', '', code))
-    next_unused = int(re.sub('[^0-9]', '', admin_get_next(prefix)))
-
-    if code_number >= next_unused:
-        max_code = code_number
-        if prefix == "SKU":
-            db.admin.replace_one({"_id": "SKU"}, {"_id": "SKU",
-                                                  "next": f"SKU{max_code+1:06}"})
-        if prefix == "BAT":
-            db.admin.replace_one({"_id": "BAT"}, {"_id": "BAT",
-                                                  "next": f"BAT{max_code+1:06}"})
-        if prefix == "BIN":
-            db.admin.replace_one({"_id": "BIN"}, {"_id": "BIN",
-                                                  "next": f"BIN{max_code+1:06}"})
+code_collections = {
+    "SKU": "sku",
+    "BAT": "batch",
+    "BIN": "bin",
+}
 
 
-def admin_get_next(prefix):
+def code_number(code):
+    return int(re.sub('[^0-9]', '', code))
+
+
+def format_code(prefix, number):
+    return f"{prefix}{number:06}"
+
+
+def largest_code_number(collection, prefix):
+    """The largest number of the ids of collection that are prefix and
+    digits, or 0 if there are none.
+
+    Reads the _id index only. Ids are zero padded to one width (see
+    format_code), but clients may choose longer ones, so the longest ids
+    are found first, and then the highest _id of that length, since ids of
+    one length sort like their numbers."""
+    width = 0
+    while True:
+        longer = collection.find_one(
+            {"_id": {"$regex": f"^{prefix}[0-9]{{{width + 1},}}$"}}, {"_id": 1})
+        if longer is None:
+            break
+        width = len(longer["_id"]) - len(prefix)
+    if width == 0:
+        return 0
+    top = collection.find_one(
+        {"_id": {"$regex": f"^{prefix}[0-9]{{{width}}}$"}}, {"_id": 1}, sort=[("_id", -1)])
+    return code_number(top["_id"])
+
 
-    def max_code_value(collection, prefix=ascii_letters):
-        cursor = collection.find()
-        max_value = 0
-        for doc in cursor:
-            code_number = int(doc['_id'].strip(prefix))
-            if code_number > max_value:
-                max_value = code_number
-        return max_value
-
-    next_code_doc = db.admin.find_one({"_id": prefix})
-    if not next_code_doc:
-        if prefix == "SKU":
-            max_value = max_code_value(db.sku, "SKU")
-            db.admin.insert_one({"_id": "SKU",
-                                 "next": f"SKU{max_value+1:06}"})
-        if prefix == "BAT":
-            max_value = max_code_value(db.batch)
-            db.admin.insert_one({"_id": "BAT",
-                                 "next": f"BAT{max_value+1:06}"})
-        if prefix == "BIN":
-            max_value = max_code_value(db.bin, "BIN")
-            db.admin.insert_one({"_id": "BIN",
-                                 "next": f"BIN{max_value+1:06}"})
-        next_code_doc = db.admin.find_one({"_id": prefix})
-
-    if next_code_doc:
-        return next_code_doc['next']
-    else:
+def init_code_counter(prefix):
+    """Makes sure the admin counter doc of prefix has a numeric next_number.
+
+    Starts after the largest existing id, or from a legacy "next" string,
+    whichever is higher. $max keeps concurrent initializations from moving
+    the counter back."""
+    if prefix not in code_collections:
         raise Exception("bad prefix", prefix)
+    next_number = largest_code_number(db[code_collections[prefix]], prefix) + 1
+    legacy = db.admin.find_one({"_id": prefix, "next": {"$exists": True}})
+    if legacy:
+        next_number = max(next_number, code_number(legacy["next"]))
+    db.admin.update_one({"_id": prefix},
+                        {"$max": {"next_number": next_number}, "$unset": {"next": ""}},
+                        upsert=True)
+
+
+def allocate_codes(prefix, count=1):
+    """Reserves count consecutive ids of prefix in one round trip."""
+    while True:
+        counter = db.admin.find_one_and_update(
+            {"_id": prefix, "next_number": {"$exists": True}},
+            {"$inc": {"next_number": count}})
+        if counter:
+            return [format_code(prefix, number) for number in
+                    range(counter["next_number"], counter["next_number"] + count)]
+        init_code_counter(prefix)
+
+
+def admin_increment_code(prefix, code):
+    """Moves the counter of prefix past code, e.g. after a create with a client chosen id."""
+    while True:
+        result = db.admin.update_one(
+            {"_id": prefix, "next_number": {"$exists": True}},
+            {"$max": {"next_number": code_number(code) + 1}})
+        if result.matched_count:
+            return
+        init_code_counter(prefix)
+
+
+def admin_get_next(prefix):
+    """Returns the next unused id of prefix without reserving it.
+
+    Another create can take the id first; see the /api/next endpoints."""
+    while True:
+        counter = db.admin.find_one({"_id": prefix, "next_number": {"$exists": True}})
+        if counter:
+            return format_code(prefix, counter["next_number"])
+        init_code_counter(prefix)
 
 
 def check_code_list(codes):
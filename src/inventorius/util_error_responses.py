@@ -12,7 +12,8 @@ problem_titles = {
     "insufficient-quantity": "Requested greater quantity than is available.",
     "invalid-credentials": "Identity not authorized.",
     "account-deactivated": "Account is deactivated.",
-    "dangerous-operation": "This operation requires force=true."
+    "dangerous-operation": "This operation requires force=true.",
+    "precondition-failed": "Resource has changed since it was read."
 }
 
 
@@ -43,19 +44,22 @@ def missing_resource_param_error(name, reason=None):
     return MultipleInvalid(errors)
 
 
-def invalid_params_response(error: MultipleInvalid, type="validation-error", status_code=400):
+def invalid_params(error: MultipleInvalid):
     invalid_params = []
     for invalid in error.errors:
         name = invalid.path
         if isinstance(name, list):
             name = name[0]
         invalid_params.append({"name": name, "reason": invalid.msg})
+    return invalid_params
+
 
+def invalid_params_response(error: MultipleInvalid, type="validation-error", status_code=400):
     return problem_response(
         json={
             "type": type,
             "title": problem_titles[type],
-            "invalid-params": invalid_params
+            "invalid-params": invalid_params(error)
         },
         status_code=status_code)
 
@@ -111,6 +115,18 @@ def missing_sku_response(id):
     )
 
 
+def precondition_failed_response(uri, etag=None):
+    """If-Match did not match. `etag` is the current ETag of the resource."""
+    resp = problem_response(status_code=412, json={
+        "type": "precondition-failed",
+        "title": problem_titles["precondition-failed"],
+        "Id": uri,
+    })
+    if etag is not None:
+        resp.set_etag(etag)
+    return resp
+
+
 def bad_username_password_response(name, reason=None):
     if name == "id" and reason == None:
         reason = "Id does not exist"
@@ -7,8 +7,11 @@ from setuptools import Require
 from voluptuous import Schema, Required, All, Length, Range, ALLOW_EXTRA
 from voluptuous.error import Invalid, MultipleInvalid
 from voluptuous.validators import Any
+from decimal import Decimal
 import re
 
+from inventorius.money import Money, minor_unit_exponent, minor_units_to_decimal128
+
 
 def NoneOr(Else):
     return Any(None, Else)
@@ -101,7 +104,22 @@ def base_unit(unit):
     return units_schema.extend({
         Required("unit"): unit,
     })
-currency = base_unit("USD")
+
+
+def storable_amount(units):
+    """Rejects amounts that Money would round or can not store as a Decimal128."""
+    exponent = minor_unit_exponent(units["unit"])
+    try:
+        amount = Money.from_json(units)
+        minor_units_to_decimal128(amount.minor_units, exponent)
+    except (ValueError, ArithmeticError):
+        raise Invalid("must be a finite amount that fits in a Decimal128", ["value"])
+    if Decimal(str(units["value"])) != Decimal(amount.minor_units).scaleb(-exponent):
+        raise Invalid(f"must have at most {exponent} decimal places", ["value"])
+    return units
+
+
+currency = All(base_unit("USD"), storable_amount)
 
 props_schema = Schema({
     "cost_per_case": currency,
@@ -164,4 +182,22 @@ item_move_schema = Schema({
 item_release_receive_schema = Schema({
     Required("id"): Any(prefixed_id("SKU"), prefixed_id("BAT")),
     Required("quantity"): int # can be positive or negative
+})
+
+# bulk requests are validated line by line, see inventorius.bulk
+bulk_lines_schema = Schema(All([dict], Length(min=1, max=10000)))
+# items of bulk creates are checked by the new_*_schema of their resource
+bulk_create_schema = Schema(All(list, Length(min=1, max=50000)))
+
+bulk_move_line_schema = Schema({
+    Required("source"): prefixed_id("BIN"),
+    Required("destination"): prefixed_id("BIN"),
+    Required("id"): Any(prefixed_id("SKU"), prefixed_id("BAT")),
+    Required("quantity"): All(int, positive),
+})
+
+bulk_receive_line_schema = Schema({
+    Required("bin_id"): prefixed_id("BIN"),
+    Required("id"): Any(prefixed_id("SKU"), prefixed_id("BAT")),
+    Required("quantity"): All(int, positive),
 })
\ No newline at end of file
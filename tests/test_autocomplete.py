@@ -0,0 +1,34 @@
+from inventorius.autocomplete import PrefixIndex, item_entries
+
+
+class ScanDatabase:
+    """Sku and batch collections whose scan runs `during_scan` first."""
+
+    def __init__(self, docs, during_scan):
+        self.docs = docs
+        self.during_scan = during_scan
+
+    def __getitem__(self, owner_type):
+        return self
+
+    def find(self, query, projection):
+        docs = self.docs
+        self.docs = []
+        self.during_scan()
+        return docs
+
+
+def test_writes_during_rebuild_are_kept():
+    index = PrefixIndex()
+    old = {"_id": "SKU000000", "name": "Old name", "owned_codes": [], "associated_codes": []}
+
+    def during_scan():
+        # written after the scan read the old documents
+        index.replace_item("SKU000000", item_entries("sku", "SKU000000", "New name"))
+        index.replace_item("SKU000001", item_entries("sku", "SKU000001", "Newest"))
+
+    index.rebuild(ScanDatabase([old], during_scan))
+    assert index.built.is_set()
+    assert [hit["value"] for hit in index.complete("new", 10)] == ["New name", "Newest"]
+    assert index.complete("old", 10) == []
+    assert index.pending is None
@@ -0,0 +1,35 @@
+import bson
+
+from inventorius.cache import EntityCache
+
+
+def test_lru_eviction():
+    cache = EntityCache(max_entries=2, ttl_seconds=60)
+    for key in "abc":
+        cache.put(key, bson.encode({"_id": key}), cache.generation)
+        cache.get("a")
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_expiry():
+    cache = EntityCache(max_entries=10, ttl_seconds=0)
+    cache.put("a", b"doc", cache.generation)
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_read_racing_invalidation_is_not_stored():
+    cache = EntityCache(max_entries=10, ttl_seconds=60)
+    generation = cache.generation
+    # a writer invalidates while the read is in flight
+    cache.invalidate(["a"])
+    cache.put("a", b"old doc", generation)
+    assert cache.get("a") is None
+
+    cache.put("a", b"new doc", cache.generation)
+    assert cache.get("a") == b"new doc"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from conftest import clientContext
+from inventorius.db import get_mongo_client, supports_change_streams
+import inventorius.cache as cache
+import inventorius.coherence as coherence
+
+
+def wait_for(condition, seconds=5):
+    deadline = time.monotonic() + seconds
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def cached_name(database, sku_id):
+    return cache.cached_document(database, "sku", sku_id)["name"]
+
+
+def rename_elsewhere(database, sku_id, name):
+    """A write made by another worker, which this worker's cache doesn't see."""
+    database.sku.update_one({"_id": sku_id}, {"$set": {"name": name}})
+
+
+def test_poll_invalidates_other_workers_writes(monkeypatch):
+    monkeypatch.setattr(coherence, "poll_seconds", 0.05)
+    with clientContext():
+        database = get_mongo_client().testing
+        database.sku.insert_one({"_id": "SKU000001", "name": "old"})
+        watcher = coherence.ensure_watcher(database, "poll")
+        try:
+            assert watcher.ready.wait(5)
+            assert cached_name(database, "SKU000001") == "old"
+            rename_elsewhere(database, "SKU000001", "new")
+            assert cached_name(database, "SKU000001") == "old"
+            # as the other worker's handler does through cache.invalidate
+            coherence.bump_version(database, "sku")
+            assert wait_for(lambda: cached_name(database, "SKU000001") == "new")
+        finally:
+            coherence.stop_watchers()
+
+
+def test_change_stream_invalidates_other_workers_writes():
+    if not supports_change_streams(get_mongo_client()):
+        pytest.skip("change streams need a replica set")
+    with clientContext():
+        database = get_mongo_client().testing
+        database.sku.insert_one({"_id": "SKU000001", "name": "old"})
+        watcher = coherence.ensure_watcher(database, "changestream")
+        try:
+            assert watcher.ready.wait(5)
+            assert cached_name(database, "SKU000001") == "old"
+            rename_elsewhere(database, "SKU000001", "new")
+            assert wait_for(lambda: cached_name(database, "SKU000001") == "new")
+        finally:
+            coherence.stop_watchers()
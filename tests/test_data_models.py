@@ -1,11 +1,14 @@
-from inventorius.data_models import Bin, Sku, Batch, Props, DataModelJSONEncoder as Encoder
+from inventorius.data_models import Bin, Sku, Batch, Props, DataModel, DataModelJSONEncoder as Encoder
 
 import pytest
 import json
-from hypothesis import given, example
-from hypothesis.strategies import composite, integers
+import bson
+from bson.raw_bson import RawBSONDocument
+from hypothesis import assume, given, example
+from hypothesis.strategies import composite, integers, one_of, builds, none, floats
 
 import tests.data_models_strategies as dst
+from inventorius.revisions import with_rev
 
 
 def test_get_attr():
@@ -68,6 +71,133 @@ def test_batch_no_props():
     batch = Batch(id="BAT0123456")
     print(batch.props)
 
+
+def test_field_table():
+    assert [spec.name for spec in Batch._fields] == [
+        "associated_codes", "id", "name", "owned_codes", "props", "sku_id"]
+    assert Batch._fields_by_db_key["_id"].name == "id"
+    assert Batch._fields_by_db_key["props"].is_subdoc
+    assert Props._has_additional_fields and not Sku._has_additional_fields
+
+
+def test_slotted_models():
+    bin = Bin(id="BIN000001", contents={"SKU000001": 2})
+    assert not hasattr(bin, "__dict__")
+    assert Bin._fields_by_db_key["contents"].name == "contents"
+    assert repr(bin) == "Bin(contents={'SKU000001': 2}, id='BIN000001', props=None)"
+    assert json.loads(json.dumps(bin, cls=Encoder)) == {
+        "contents": {"SKU000001": 2}, "id": "BIN000001", "props": None}
+    assert bin == Bin.from_mongodb_doc(bin.to_mongodb_doc())
+    with pytest.raises(AttributeError):
+        bin.not_a_field = 1
+
+
+@given(one_of(dst.skus_(), dst.bins_(contents={"SKU000001": 3, "BAT000002": 4}), dst.batches_()))
+def test_lazy_model_matches_eager(model):
+    try:
+        raw = RawBSONDocument(bson.encode(model.to_mongodb_doc()))
+    except OverflowError:
+        # props may hold ints wider than bson allows
+        assume(False)
+    lazy = type(model).from_raw_bson(raw)
+    assert lazy == model and model == lazy
+    assert lazy.to_dict(mask_default=True) == model.to_dict(mask_default=True)
+    assert lazy.to_mongodb_doc() == model.to_mongodb_doc()
+
+
+def test_lazy_model_converts_on_access():
+    raw = RawBSONDocument(bson.encode(
+        Bin(id="BIN000001", contents={"SKU000001": 2}).to_mongodb_doc()))
+    bin = Bin.from_raw_bson(raw)
+    contents_slot = vars(Bin)["contents"]
+    assert bin.id == "BIN000001"
+    with pytest.raises(AttributeError):
+        contents_slot.__get__(bin)
+    assert bin.contents["SKU000001"] == 2
+    assert type(contents_slot.__get__(bin)) is dict
+    assert Bin.from_raw_bson(None) is None
+
+
+def test_from_mongodb_cursor():
+    skus = [Sku(id=f"SKU{i:06}", name=str(i)) for i in range(5)]
+    converted = Sku.from_mongodb_cursor(
+        iter([sku.to_mongodb_doc() for sku in skus]), batch_size=2)
+    assert next(converted) == skus[0]
+    assert list(converted) == skus[1:]
+
+
+def test_default_containers_not_shared():
+    bin1, bin2 = Bin(id="BIN000001"), Bin(id="BIN000002")
+    bin1.contents["SKU000001"] = 1
+    assert bin2.contents == {}
+
+
+costs = one_of(none(), builds(lambda value: {"unit": "USD", "value": value},
+                              floats(0, 10**6, allow_nan=False)))
+
+
+@given(one_of(dst.skus_(), dst.bins_(), dst.batches_(),
+              builds(Batch, id=dst.label_("BAT"), props=builds(
+                  Props, cost_per_case=costs, original_cost_per_case=costs,
+                  count_per_case=one_of(none(), integers())))))
+def test_generated_conversions_match_generic(model):
+    cls = type(model)
+    for mask_default in (True, False):
+        assert json.dumps(model.to_dict(mask_default), cls=Encoder) \
+            == json.dumps(DataModel.to_dict(model, mask_default), cls=Encoder)
+
+    doc = model.to_mongodb_doc()
+    assert repr(doc) == repr(DataModel.to_mongodb_doc(model))
+
+    generated = cls.from_mongodb_doc(doc)
+    generic = DataModel.from_mongodb_doc.__func__(cls, doc)
+    assert repr(generated) == repr(generic)
+    assert generated == generic
+
+
+@given(one_of(dst.skus_(), dst.bins_(), dst.batches_(),
+              builds(Batch, id=dst.label_("BAT"), props=builds(
+                  Props, cost_per_case=costs, count_per_case=one_of(none(), integers())))))
+def test_encode_json_matches_dumps(model):
+    encode = Encoder().encode
+    for mask_default in (True, False):
+        expected = json.dumps(model.to_dict(mask_default), cls=Encoder)
+        assert model.encode_json(mask_default, encode) == expected
+        assert DataModel.encode_json(model, mask_default, encode) == expected
+    assert model.to_json() == json.dumps(model.to_dict(True), cls=Encoder)
+
+
+def test_patch_to_mongodb_update():
+    assert Sku.patch_to_mongodb_update({"id": "SKU000001"}) == {}
+    assert Sku.patch_to_mongodb_update({
+        "id": "SKU000001", "name": "Resistor", "owned_codes": ["123"], "props": None,
+    }) == {"$set": {"name": "Resistor", "owned_codes": ["123"]}, "$unset": {"props": ""}}
+
+    update = Batch.patch_to_mongodb_update({
+        "sku_id": None,
+        "props": {"cost_per_case": {"unit": "USD", "value": 1.5}}})
+    assert update["$unset"] == {"sku_id": ""}
+    assert update["$set"]["props"] == Batch(
+        id="BAT000001", props={"cost_per_case": {"unit": "USD", "value": 1.5}}
+    ).to_mongodb_doc()["props"]
+
+    with pytest.raises(KeyError):
+        Bin.patch_to_mongodb_update({"name": "bins have no name"})
+
+
+def test_generated_from_mongodb_doc_rejects_unknown_keys():
+    with pytest.raises(Exception):
+        Sku.from_mongodb_doc({"_id": "SKU000001", "unknown": 1})
+    with pytest.raises(KeyError):
+        Sku.from_mongodb_doc({"name": "missing id"})
+
+
+def test_from_mongodb_doc_skips_rev():
+    sku = Sku(id="SKU000001", name="Resistor")
+    doc = with_rev(sku.to_mongodb_doc())
+    assert Sku.from_mongodb_doc(doc) == sku
+    assert DataModel.from_mongodb_doc.__func__(Sku, doc) == sku
+
 # def test_bin_extended():
 #     pass
 
@@ -1,4 +1,5 @@
 import os
+import json
 from hypothesis.errors import NonInteractiveExampleWarning
 import tests.data_models_strategies as dst
 from inventorius.data_models import Bin, Props, Sku, Batch, Subdoc
@@ -10,10 +11,29 @@ from hypothesis.stateful import Bundle, RuleBasedStateMachine, rule, initialize,
 
 from datetime import timedelta
 import itertools as it
+import bson
+from urllib.parse import urlencode
 
 # @reproduce_failure('5.44.0', b'AXicY2BkUGcAA0ZGKC0KZgIABDQAQw==')
 
 
+def disjoint_owned_codes(items):
+    """Drops owned codes that an earlier item of `items` also owns."""
+    seen = set()
+    for item in items:
+        item.owned_codes = [code for code in item.owned_codes if code not in seen]
+        seen.update(item.owned_codes)
+
+
+def storable(model):
+    """Whether mongodb can store `model`; props may hold ints beyond 64 bits."""
+    try:
+        bson.encode(model.to_mongodb_doc())
+        return True
+    except OverflowError:
+        return False
+
+
 class InventoriusStateMachine(RuleBasedStateMachine):
     def __init__(self):
         super(InventoriusStateMachine, self).__init__()
@@ -30,6 +50,20 @@ class InventoriusStateMachine(RuleBasedStateMachine):
     a_batch_id = Bundle("batch_id")
     a_user_id = Bundle("user_id")
 
+    def owned_code_conflicts(self, item_id, owned_codes):
+        """Owned codes that another modelled sku or batch already owns."""
+        taken = {code
+                 for item in it.chain(self.model_skus.values(), self.model_batches.values())
+                 if item.id != item_id
+                 for code in item.owned_codes}
+        return taken.intersection(owned_codes or [])
+
+    def assert_owned_code_conflict(self, rp):
+        assert rp.status_code == 409
+        assert rp.is_json
+        assert rp.json['type'] == 'duplicate-resource'
+        assert rp.json['invalid-params'][0]['name'] == 'owned_codes'
+
     @rule(target=a_user_id, user=dst.users_())
     def new_user(self, user):
         resp = self.client.post("/api/users", json=user)
@@ -163,6 +197,26 @@ class InventoriusStateMachine(RuleBasedStateMachine):
             self.model_bins[bin.id] = bin
             return bin.id
 
+    @rule(target=a_bin_id, bins=st.lists(dst.bins_(), min_size=1, max_size=5))
+    def bulk_new_bins(self, bins):
+        ndjson = "\n".join(json.dumps(bin.to_dict(mask_default=True)) for bin in bins)
+        rp = self.client.post("/api/bulk/bins", data=ndjson,
+                              content_type="application/x-ndjson")
+        assert rp.status_code == 200
+        created = []
+        for bin, result in zip(bins, rp.json["state"]["results"]):
+            if not storable(bin):
+                assert result["status"] == 400
+                assert result["type"] == "validation-error"
+            elif bin.id in self.model_bins.keys():
+                assert result["status"] == 409
+                assert result["type"] == "duplicate-resource"
+            else:
+                assert result["status"] == 201
+                self.model_bins[bin.id] = bin
+                created.append(bin.id)
+        return multiple(*created)
+
     @rule(bin_id=a_bin_id)
     def get_existing_bin(self, bin_id):
         assert bin_id in self.model_bins.keys()
@@ -240,11 +294,58 @@ class InventoriusStateMachine(RuleBasedStateMachine):
             assert resp.is_json
             assert resp.json['type'] == 'duplicate-resource'
             return multiple()
+        elif self.owned_code_conflicts(sku.id, sku.owned_codes):
+            self.assert_owned_code_conflict(resp)
+            return multiple()
         else:
             assert resp.status_code == 201
             self.model_skus[sku.id] = sku
             return sku.id
 
+    @rule(target=a_sku_id, skus=st.lists(dst.skus_(), min_size=1, max_size=5))
+    def bulk_new_skus(self, skus):
+        disjoint_owned_codes(skus)
+        rp = self.client.post(
+            "/api/bulk/skus", json=[sku.to_dict(mask_default=True) for sku in skus])
+        assert rp.status_code == 200
+        created = []
+        for sku, result in zip(skus, rp.json["state"]["results"]):
+            if not storable(sku):
+                assert result["status"] == 400
+            elif sku.id in self.model_skus.keys():
+                assert result["status"] == 409
+                assert result["type"] == "duplicate-resource"
+            elif self.owned_code_conflicts(sku.id, sku.owned_codes):
+                assert result["status"] == 409
+                assert result["invalid-params"][0]["name"] == "owned_codes"
+            else:
+                assert result["status"] == 201
+                self.model_skus[sku.id] = sku
+                created.append(sku.id)
+        return multiple(*created)
+
+    @rule(target=a_sku_id, skus=st.lists(dst.skus_(), min_size=1, max_size=5))
+    def bulk_new_skus_without_ids(self, skus):
+        disjoint_owned_codes(skus)
+        rp = self.client.post("/api/bulk/skus", json=[
+            {k: v for k, v in sku.to_dict(mask_default=True).items() if k != "id"} for sku in skus])
+        assert rp.status_code == 200
+        created = []
+        for sku, result in zip(skus, rp.json["state"]["results"]):
+            if not storable(sku):
+                assert result["status"] == 400
+                continue
+            if self.owned_code_conflicts(None, sku.owned_codes):
+                assert result["status"] == 409
+                assert result["invalid-params"][0]["name"] == "owned_codes"
+                continue
+            assert result["status"] == 201
+            sku.id = result["Id"].rsplit("/", 1)[-1]
+            assert sku.id not in self.model_skus.keys()
+            self.model_skus[sku.id] = sku
+            created.append(sku.id)
+        return multiple(*created)
+
     @rule(sku=dst.skus_(), bad_code=st.sampled_from(["", " ", "\t", "     ", " 123", "1 2 3", "123 abc"]))
     def new_sku_bad_format_owned_codes(self, sku, bad_code):
         assume(sku.id not in self.model_skus.keys())
@@ -270,6 +371,15 @@ class InventoriusStateMachine(RuleBasedStateMachine):
         found_sku = Sku(**rp.json['state'])
         assert found_sku == self.model_skus[sku_id]
 
+    @rule(sku_id=a_sku_id)
+    def get_unmodified_sku(self, sku_id):
+        etag, weak = self.client.get(f"/api/sku/{sku_id}").get_etag()
+        assert etag and not weak
+        rp = self.client.get(f"/api/sku/{sku_id}", headers={"If-None-Match": f'"{etag}"'})
+        assert rp.status_code == 304
+        assert rp.get_etag() == (etag, False)
+        assert rp.data == b""
+
     @rule(sku_id=dst.label_("SKU"))
     def get_missing_sku(self, sku_id):
         assume(sku_id not in self.model_skus.keys())
@@ -279,7 +389,7 @@ class InventoriusStateMachine(RuleBasedStateMachine):
         assert rp.json['type'] == 'missing-resource'
 
     sku_patch = st.builds(lambda sku, use_keys: {
-                          k: v for k, v in sku.__dict__.items() if k in use_keys},
+                          k: v for k, v in sku.to_dict().items() if k in use_keys},
                           dst.skus_(),
                           st.sets(st.sampled_from([
                               "owned_codes",
@@ -291,6 +401,9 @@ class InventoriusStateMachine(RuleBasedStateMachine):
     @rule(sku_id=a_sku_id, patch=sku_patch)
     def update_sku(self, sku_id, patch):
         rp = self.client.patch(f'/api/sku/{sku_id}', json=patch)
+        if self.owned_code_conflicts(sku_id, patch.get("owned_codes")):
+            self.assert_owned_code_conflict(rp)
+            return
         assert rp.status_code == 200
         assert rp.cache_control.no_cache
         for key in patch.keys():
@@ -365,6 +478,9 @@ class InventoriusStateMachine(RuleBasedStateMachine):
             assert rp.json['type'] == 'duplicate-resource'
             assert rp.is_json
             return multiple()
+        elif self.owned_code_conflicts(batch.id, batch.owned_codes):
+            self.assert_owned_code_conflict(rp)
+            return multiple()
         else:
             assert rp.status_code == 201
             self.model_batches[batch.id] = batch
@@ -410,6 +526,9 @@ class InventoriusStateMachine(RuleBasedStateMachine):
             assert rp.json['type'] == 'duplicate-resource'
             assert rp.is_json
             return multiple()
+        elif self.owned_code_conflicts(batch.id, batch.owned_codes):
+            self.assert_owned_code_conflict(rp)
+            return multiple()
         else:
             assert rp.json.get('type') is None
             assert rp.status_code == 201
@@ -433,7 +552,7 @@ class InventoriusStateMachine(RuleBasedStateMachine):
         assert rp.json['type'] == "missing-resource"
 
     batch_patch = st.builds(lambda batch, use_keys: {
-        k: v for k, v in batch.__dict__.items() if k in use_keys},
+        k: v for k, v in batch.to_dict().items() if k in use_keys},
         dst.skus_(),
         st.sets(st.sampled_from([
             "owned_codes",
@@ -445,6 +564,9 @@ class InventoriusStateMachine(RuleBasedStateMachine):
     def update_batch(self, batch_id, patch):
         patch['id'] = batch_id
         rp = self.client.patch(f'/api/batch/{batch_id}', json=patch)
+        if self.owned_code_conflicts(batch_id, patch.get("owned_codes")):
+            self.assert_owned_code_conflict(rp)
+            return
         assert rp.status_code == 200
         assert rp.cache_control.no_cache
         for key in patch.keys():
@@ -472,6 +594,9 @@ class InventoriusStateMachine(RuleBasedStateMachine):
         assume(sku_id != self.model_batches[batch_id].sku_id)
         patch['sku_id'] = sku_id
         rp = self.client.patch(f'/api/batch/{batch_id}', json=patch)
+        if self.owned_code_conflicts(batch_id, patch.get("owned_codes")):
+            self.assert_owned_code_conflict(rp)
+            return
         assert rp.status_code == 405
         assert rp.is_json
         assert rp.json['type'] == "dangerous-operation"
@@ -483,6 +608,9 @@ class InventoriusStateMachine(RuleBasedStateMachine):
         assume(not self.model_batches[batch_id].sku_id)
         patch['sku_id'] = sku_id
         rp = self.client.patch(f"/api/batch/{batch_id}", json=patch)
+        if self.owned_code_conflicts(batch_id, patch.get("owned_codes")):
+            self.assert_owned_code_conflict(rp)
+            return
         assert rp.status_code == 200
         assert rp.cache_control.no_cache
         for key in patch.keys():
@@ -647,6 +775,70 @@ class InventoriusStateMachine(RuleBasedStateMachine):
             if self.model_bins[bin_id].contents[batch_id] == 0:
                 del self.model_bins[bin_id].contents[batch_id]
 
+    @rule(data=st.data())
+    def bulk_receive(self, data):
+        assume(self.model_bins != {})
+        assume(self.model_skus != {} or self.model_batches != {})
+        item_ids = list(self.model_skus.keys()) + list(self.model_batches.keys())
+        lines = data.draw(st.lists(st.fixed_dictionaries({
+            "bin_id": st.sampled_from(list(self.model_bins.keys())),
+            "id": st.sampled_from(item_ids),
+            "quantity": st.integers(1, 100),
+        }), min_size=1, max_size=10))
+        rp = self.client.post("/api/bulk/receive", json=lines)
+        assert rp.status_code == 200
+        assert rp.json["state"]["succeeded"] == len(lines)
+        assert [result["status"] for result in rp.json["state"]["results"]] == [201] * len(lines)
+        for line in lines:
+            contents = self.model_bins[line["bin_id"]].contents
+            contents[line["id"]] = contents.get(line["id"], 0) + line["quantity"]
+
+    @rule(data=st.data())
+    def bulk_move(self, data):
+        sources = [bin_id for bin_id, bin in self.model_bins.items() if bin.contents != {}]
+        assume(sources != [] and len(self.model_bins) > 1)
+        # what is left in each source after the lines drawn so far
+        availible = {bin_id: dict(self.model_bins[bin_id].contents) for bin_id in sources}
+        lines = []
+        for _ in range(data.draw(st.integers(1, 5))):
+            source = data.draw(st.sampled_from(sources))
+            if availible[source] == {}:
+                continue
+            item_id = data.draw(st.sampled_from(sorted(availible[source])))
+            quantity = data.draw(st.integers(1, availible[source][item_id]))
+            destination = data.draw(st.sampled_from(
+                [bin_id for bin_id in self.model_bins if bin_id != source]))
+            availible[source][item_id] -= quantity
+            if availible[source][item_id] == 0:
+                del availible[source][item_id]
+            lines.append({"source": source, "destination": destination,
+                          "id": item_id, "quantity": quantity})
+        assume(lines != [])
+
+        rp = self.client.post("/api/bulk/move", json=lines)
+        assert rp.status_code == 200
+        assert rp.json["state"]["succeeded"] == len(lines)
+        for line in lines:
+            source = self.model_bins[line["source"]].contents
+            destination = self.model_bins[line["destination"]].contents
+            source[line["id"]] -= line["quantity"]
+            if source[line["id"]] == 0:
+                del source[line["id"]]
+            destination[line["id"]] = destination.get(line["id"], 0) + line["quantity"]
+
+    @rule(bin_id=a_bin_id, sku_id=a_sku_id, data=st.data())
+    def bulk_move_insufficient(self, bin_id, sku_id, data):
+        destination = data.draw(st.sampled_from(list(self.model_bins)))
+        quantity = self.model_bins[bin_id].contents.get(sku_id, 0) + 1
+        rp = self.client.post("/api/bulk/move", json=[
+            {"source": bin_id, "destination": destination, "id": sku_id, "quantity": 1},
+            {"source": bin_id, "destination": destination, "id": sku_id, "quantity": quantity - 1},
+        ])
+        assert rp.status_code == 200
+        assert rp.json["state"]["succeeded"] == 0
+        assert [result["status"] for result in rp.json["state"]["results"]] \
+            == ([405, 405] if quantity > 1 else [409, 400])
+
     @rule(source_binId=a_bin_id, destination_binId=a_bin_id, data=st.data())
     def move(self, source_binId, destination_binId, data):
         assume(source_binId != destination_binId)
@@ -748,6 +940,36 @@ class InventoriusStateMachine(RuleBasedStateMachine):
     #         else:
     #             assert unit not in results
 
+    @rule(limit=st.integers(1, 5))
+    def search_all_pages(self, limit):
+        href = "/api/search?" + urlencode({"query": "!ALL", "limit": limit})
+        results = []
+        while True:
+            rp = self.client.get(href)
+            assert rp.status_code == 200
+            state = rp.json["state"]
+            assert state["starting_from"] == len(results)
+            assert state["returned_num_results"] <= limit
+            results.extend(result["id"] for result in state["results"])
+            next_ops = [op for op in rp.json["operations"] if op["rel"] == "next"]
+            if not next_ops:
+                break
+            href = next_ops[0]["href"]
+        assert state["total_num_results"] == len(results)
+        assert sorted(results) == sorted(it.chain(
+            self.model_skus.keys(), self.model_batches.keys(), self.model_bins.keys()))
+
+    @rule(sku_id=a_sku_id, data=st.data())
+    def autocomplete_sku_code(self, sku_id, data):
+        sku = self.model_skus[sku_id]
+        codes = sku.owned_codes + sku.associated_codes
+        assume(codes)
+        code = data.draw(st.sampled_from(codes))
+        prefix = code[:data.draw(st.integers(1, len(code)))]
+        rp = self.client.get("/api/autocomplete", query_string={"prefix": prefix, "limit": 1000})
+        assert rp.status_code == 200
+        assert {"value": code, "kind": "code", "type": "sku", "id": sku_id} in rp.json["state"]["results"]
+
     @rule()
     def search_no_query(self):
         results = list(self.search_results_generator(""))
@@ -1,6 +1,16 @@
 from tests.test_inventorius import InventoriusStateMachine
 import tests.data_models_strategies as dst
 from inventorius.data_models import Bin, Sku, Batch, Props
+from inventorius.db import get_mongo_client
+from inventorius.indexes import INDEXES, index_capabilities
+from inventorius.stock import item_locations, rebuild_stock
+from inventorius.codes import lookup_code, rebuild_codes
+import inventorius.search
+from conftest import clientContext
+from inventorius import app as inventorius_flask_app
+from inventorius.util import admin_get_next, admin_increment_code, allocate_codes
+from inventorius.bulk import move_with_guarded_updates
+from flask import g
 
 import pytest
 import hypothesis.strategies as st
@@ -395,3 +405,280 @@ def test_add_sku_to_anonymous_batch():
                                                  'associated_codes': [], 'owned_codes': [], 'props': {}}, sku_id=v2)
     state.get_existing_batch(batch_id=v1)
     state.teardown()
+
+
+def test_indexes_ensured():
+    with clientContext():
+        testing = get_mongo_client().testing
+        for collection_name, indexes in INDEXES.items():
+            names = set(testing[collection_name].index_information())
+            assert {index.document["name"] for index in indexes} <= names
+            assert index_capabilities(testing)[collection_name] == names
+
+
+def test_rebuild_stock():
+    state = InventoriusStateMachine()
+    v1 = state.new_bin(bin=Bin(id='BIN000000'))
+    v2 = state.new_bin(bin=Bin(id='BIN000001'))
+    v3 = state.new_sku(sku=Sku(id='SKU000000'))
+    state.receive_sku(bin_id=v1, sku_id=v3, quantity=3)
+    state.client.put(f'/api/bin/{v1}/contents/move', json={
+        "id": v3, "quantity": 1, "destination": v2})
+    testing = get_mongo_client().testing
+    assert item_locations(testing, v3) == {v1: 2, v2: 1}
+    assert rebuild_stock(testing) == 2
+    assert item_locations(testing, v3) == {v1: 2, v2: 1}
+    state.teardown()
+
+
+def test_stock_not_built_yet():
+    with clientContext() as client:
+        # a database from before the stock collection
+        testing = get_mongo_client().testing
+        testing.sku.insert_one(Sku(id='SKU000000').to_mongodb_doc())
+        testing.bin.insert_one(Bin(id='BIN000000', contents={'SKU000000': 3}).to_mongodb_doc())
+        assert item_locations(testing, 'SKU000000') == {'BIN000000': 3}
+        assert client.get('/api/sku/SKU000000/bins').json["state"] == {
+            'BIN000000': {'SKU000000': 3}}
+        assert client.delete('/api/sku/SKU000000').status_code == 403
+
+        assert rebuild_stock(testing) == 1
+        testing.bin.delete_many({})
+        assert item_locations(testing, 'SKU000000') == {'BIN000000': 3}
+
+
+def test_allocate_codes():
+    with clientContext():
+        with inventorius_flask_app.test_request_context():
+            g.db = get_mongo_client().testing
+            # counter written by the old string based allocator
+            g.db.admin.insert_one({"_id": "SKU", "next": "SKU000010"})
+            assert admin_get_next("SKU") == "SKU000010"
+            assert allocate_codes("SKU", 3) == ["SKU000010", "SKU000011", "SKU000012"]
+            admin_increment_code("SKU", "SKU000020")
+            assert admin_get_next("SKU") == "SKU000021"
+
+            g.db.bin.insert_one({"_id": "BIN000041"})
+            assert allocate_codes("BIN") == ["BIN000042"]
+
+            # the numeric maximum, not the last id in index order
+            g.db.batch.insert_many([{"_id": "BAT999999"}, {"_id": "BAT1000000"}])
+            assert admin_get_next("BAT") == "BAT1000001"
+
+
+def test_guarded_move_failures():
+    with clientContext():
+        with inventorius_flask_app.test_request_context():
+            g.db = get_mongo_client().testing
+            g.db.bin.insert_one({"_id": "BIN000001", "contents": {"SKU000001": 5}})
+
+            # the destination was deleted after the existence check
+            outcome = move_with_guarded_updates(
+                {("BIN000001", "SKU000001"): 2}, {("BIN000002", "SKU000001"): 2})
+            assert outcome.missing_bins == {"BIN000002"}
+            assert g.db.bin.find_one({"_id": "BIN000001"})["contents"] == {"SKU000001": 5}
+            assert g.db.stock.count_documents({"bin_id": "BIN000002"}) == 0
+
+            # so was the source
+            outcome = move_with_guarded_updates(
+                {("BIN000003", "SKU000001"): 2}, {("BIN000001", "SKU000001"): 2})
+            assert outcome.missing_bins == {"BIN000003"}
+            assert not outcome.shortfalls
+
+            outcome = move_with_guarded_updates(
+                {("BIN000001", "SKU000001"): 6}, {("BIN000001", "SKU000001"): 6})
+            assert outcome.shortfalls == {("BIN000001", "SKU000001"): 5}
+
+
+def test_search_continuation():
+    state = InventoriusStateMachine()
+    for i in range(3):
+        state.new_bin(bin=Bin(id=f'BIN00000{i}'))
+    rp = state.client.get("/api/search", query_string={"query": "!BINS", "limit": 2})
+    assert [result["id"] for result in rp.json["state"]["results"]] == ["BIN000000", "BIN000001"]
+    timings = rp.headers["Server-Timing"].split(", ")
+    assert timings[0].startswith("bin_all-count;dur=")
+    assert timings[-1].startswith("bin_all-find;dur=")
+    next_href = [op["href"] for op in rp.json["operations"] if op["rel"] == "next"][0]
+
+    rp = state.client.get(next_href)
+    assert rp.json["state"]["starting_from"] == 2
+    assert [result["id"] for result in rp.json["state"]["results"]] == ["BIN000002"]
+    assert [op["rel"] for op in rp.json["operations"]] == ["prev"]
+
+    rp = state.client.get("/api/search", query_string={
+        "query": "!BINS", "continuation": "not a token"})
+    assert rp.status_code == 400
+    state.teardown()
+
+
+def test_union_search(monkeypatch):
+    monkeypatch.setattr(inventorius.search, "search_engine", "union")
+    state = InventoriusStateMachine()
+    state.new_sku(sku=Sku(id='SKU000000', name='', owned_codes=[], associated_codes=['123']))
+    state.new_sku(sku=Sku(id='SKU000001', name='', owned_codes=['123'], associated_codes=['123']))
+    state.new_anonymous_batch(batch=Batch(id='BAT000000', owned_codes=[], associated_codes=['123']))
+
+    rp = state.client.get("/api/search", query_string={"query": "123", "limit": 2})
+    assert rp.json["state"]["total_num_results"] == 3
+    assert [result["id"] for result in rp.json["state"]["results"]] == ["SKU000001", "BAT000000"]
+    next_href = [op["href"] for op in rp.json["operations"] if op["rel"] == "next"][0]
+    rp = state.client.get(next_href)
+    assert [result["id"] for result in rp.json["state"]["results"]] == ["SKU000000"]
+
+    rp = state.client.get("/api/search", query_string={"query": "SKU000000"})
+    assert [result["id"] for result in rp.json["state"]["results"]] == ["SKU000000"]
+    state.teardown()
+
+
+def test_codes_not_built_yet():
+    with clientContext() as client:
+        # a database from before the codes collection
+        testing = get_mongo_client().testing
+        testing.sku.insert_one(Sku(id='SKU000000', owned_codes=['123']).to_mongodb_doc())
+        testing.batch.insert_one(Batch(id='BAT000000', associated_codes=['123']).to_mongodb_doc())
+        assert lookup_code(testing, '123') == [
+            {"kind": "owned", "owner_type": "sku", "owner_id": "SKU000000"},
+            {"kind": "associated", "owner_type": "batch", "owner_id": "BAT000000"}]
+        rp = client.get("/api/search", query_string={"query": "123"})
+        assert [result["id"] for result in rp.json["state"]["results"]] == ["SKU000000", "BAT000000"]
+
+        assert rebuild_codes(testing) == (2, {})
+        testing.sku.update_one({"_id": "SKU000000"}, {"$set": {"owned_codes": []}})
+        assert sorted(row["owner_id"] for row in lookup_code(testing, '123')) == [
+            "BAT000000", "SKU000000"]
+
+
+def test_owned_codes_are_unique():
+    state = InventoriusStateMachine()
+    state.new_sku(sku=Sku(id='SKU000000', name='', owned_codes=['123'], associated_codes=['abc']))
+    state.new_sku(sku=Sku(id='SKU000001', name='', owned_codes=['123'], associated_codes=['abc']))
+    state.new_anonymous_batch(batch=Batch(id='BAT000000', owned_codes=['123'], associated_codes=[]))
+    assert list(state.model_skus) == ['SKU000000']
+    assert state.model_batches == {}
+
+    state.update_sku(sku_id='SKU000000', patch={"owned_codes": ['456']})
+    state.new_sku(sku=Sku(id='SKU000001', name='', owned_codes=['123'], associated_codes=['abc']))
+    rp = state.client.get("/api/search", query_string={"query": "abc"})
+    assert [result["id"] for result in rp.json["state"]["results"]] == ["SKU000000", "SKU000001"]
+
+    db = get_mongo_client().testing
+    assert rebuild_codes(db) == (4, {})
+    assert lookup_code(db, '123') == [{"kind": "owned", "owner_type": "sku", "owner_id": "SKU000001"}]
+    state.teardown()
+
+
+def test_autocomplete():
+    state = InventoriusStateMachine()
+    state.new_sku(sku=Sku(id='SKU000000', name='Red Widget', owned_codes=['12345'], associated_codes=[]))
+    rp = state.client.get("/api/autocomplete", query_string={"prefix": "wid"})
+    assert rp.json["state"]["results"] == [
+        {"value": "Red Widget", "kind": "name", "type": "sku", "id": "SKU000000"}]
+
+    # the built index follows later writes
+    state.new_anonymous_batch(batch=Batch(id='BAT000000', name='Widget box',
+                                          owned_codes=['12399'], associated_codes=[]))
+    state.update_sku(sku_id='SKU000000', patch={"owned_codes": ['12346']})
+    rp = state.client.get("/api/autocomplete", query_string={"prefix": "123"})
+    assert [(result["value"], result["id"]) for result in rp.json["state"]["results"]] == [
+        ("12346", "SKU000000"), ("12399", "BAT000000")]
+
+    state.delete_unused_sku(sku_id='SKU000000')
+    rp = state.client.get("/api/autocomplete", query_string={"prefix": "w"})
+    assert [result["id"] for result in rp.json["state"]["results"]] == ["BAT000000"]
+    state.teardown()
+
+
+def test_entity_cache():
+    state = InventoriusStateMachine()
+    state.new_sku(sku=Sku(id='SKU000000', name='cached', owned_codes=[], associated_codes=[]))
+    state.get_existing_sku(sku_id='SKU000000')
+    hits = state.client.get("/api/status/cache").json["state"]["hits"]
+    state.get_existing_sku(sku_id='SKU000000')
+    assert state.client.get("/api/status/cache").json["state"]["hits"] == hits + 1
+
+    # writes invalidate the cached document
+    state.update_sku(sku_id='SKU000000', patch={"name": "renamed"})
+    state.get_existing_sku(sku_id='SKU000000')
+    state.new_bin(bin=Bin(id='BIN000000'))
+    state.get_existing_bin(bin_id='BIN000000')
+    state.receive_sku(bin_id='BIN000000', sku_id='SKU000000', quantity=3)
+    state.get_existing_bin(bin_id='BIN000000')
+    state.teardown()
+
+
+def test_revisions_and_response_cache():
+    state = InventoriusStateMachine()
+    state.new_bin(bin=Bin(id='BIN000000'))
+    state.new_sku(sku=Sku(id='SKU000000', name='cached', owned_codes=[], associated_codes=[]))
+    revs = [get_mongo_client().testing.bin.find_one({"_id": "BIN000000"})["_rev"]]
+
+    state.get_existing_bin(bin_id='BIN000000')
+    hits = state.client.get("/api/status/cache").json["state"]["responses"]["hits"]
+    state.get_existing_bin(bin_id='BIN000000')
+    assert state.client.get("/api/status/cache").json["state"]["responses"]["hits"] == hits + 1
+
+    # every write to the bin makes a new revision, and GETs follow it
+    state.receive_sku(bin_id='BIN000000', sku_id='SKU000000', quantity=3)
+    revs.append(get_mongo_client().testing.bin.find_one({"_id": "BIN000000"})["_rev"])
+    state.get_existing_bin(bin_id='BIN000000')
+    state.update_bin(bin_id='BIN000000', newProps={"note": "patched"})
+    revs.append(get_mongo_client().testing.bin.find_one({"_id": "BIN000000"})["_rev"])
+    state.get_existing_bin(bin_id='BIN000000')
+    assert revs == sorted(set(revs))
+
+    state.update_sku(sku_id='SKU000000', patch={"name": "renamed"})
+    state.get_existing_sku(sku_id='SKU000000')
+    state.teardown()
+
+
+def test_conditional_requests():
+    state = InventoriusStateMachine()
+    state.new_bin(bin=Bin(id='BIN000000'))
+    rp = state.client.get('/api/bin/BIN000000')
+    etag, _ = rp.get_etag()
+    assert state.client.get('/api/bin/BIN000000', headers={
+        "If-None-Match": f'"{etag}"'}).status_code == 304
+
+    rp = state.client.patch('/api/bin/BIN000000', json={"id": "BIN000000", "props": {"a": 1}},
+                            headers={"If-Match": f'"{etag}"'})
+    assert rp.status_code == 200
+    state.model_bins['BIN000000'].props = {"a": 1}
+
+    # the first etag is stale now
+    rp = state.client.patch('/api/bin/BIN000000', json={"id": "BIN000000", "props": {"a": 2}},
+                            headers={"If-Match": f'"{etag}"'})
+    assert rp.status_code == 412
+    assert rp.json["type"] == "precondition-failed"
+    new_etag, _ = rp.get_etag()
+    assert new_etag != etag
+    rp = state.client.get('/api/bin/BIN000000', headers={"If-None-Match": f'"{etag}"'})
+    assert rp.status_code == 200
+    assert rp.get_etag() == (new_etag, False)
+    state.get_existing_bin(bin_id='BIN000000')
+
+    state.new_sku(sku=Sku(id='SKU000000', name='etag', owned_codes=[], associated_codes=[]))
+    rp = state.client.patch('/api/sku/SKU000000', json={"id": "SKU000000", "name": "stale"},
+                            headers={"If-Match": '"1"'})
+    assert rp.status_code == 412
+    etag, _ = state.client.get('/api/sku/SKU000000').get_etag()
+    state.update_sku(sku_id='SKU000000', patch={"name": "fresh"})
+    assert state.client.get('/api/sku/SKU000000').get_etag()[0] != etag
+    state.get_existing_sku(sku_id='SKU000000')
+    state.teardown()
+
+
+def test_bulk_create_claims_codes_first():
+    state = InventoriusStateMachine()
+    state.new_sku(sku=Sku(id='SKU000001', name='first', owned_codes=['A'], associated_codes=[]))
+    rp = state.client.post("/api/bulk/skus", json=[
+        {"id": "SKU000001", "owned_codes": ["A"]},
+        {"id": "SKU000002", "owned_codes": ["A"]},
+        {"id": "SKU000003", "owned_codes": ["B"]},
+    ])
+    assert [result["status"] for result in rp.json["state"]["results"]] == [409, 409, 201]
+    testing = get_mongo_client().testing
+    assert testing.sku.find_one({"_id": "SKU000002"}) is None
+    assert [row["owner_id"] for row in lookup_code(testing, "A")] == ["SKU000001"]
+    assert [row["owner_id"] for row in lookup_code(testing, "B")] == ["SKU000003"]
+    state.teardown()
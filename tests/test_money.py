@@ -0,0 +1,68 @@
+from decimal import Decimal
+
+import bson
+import pytest
+from bson.decimal128 import Decimal128
+from hypothesis import given
+from hypothesis.strategies import integers, decimals
+
+from inventorius.data_models import Batch, Props
+import inventorius.money as money
+from inventorius.money import Money, minor_units_to_decimal128, decimal128_to_minor_units
+from inventorius.validation import props_schema
+from voluptuous import MultipleInvalid
+
+
+@given(integers(-10**30, 10**30))
+def test_decimal128_codec(minor_units):
+    value = minor_units_to_decimal128(minor_units, 4)
+    assert value.to_decimal() == Decimal(f"{minor_units}E-4")
+    assert decimal128_to_minor_units(value, 4) == minor_units
+
+
+@given(decimals(-10**12, 10**12, allow_nan=False, allow_infinity=False, places=10))
+def test_decimal128_decode_rounds_like_decimal(value):
+    expected = int(value.scaleb(4).to_integral_value())
+    assert decimal128_to_minor_units(Decimal128(value), 4) == expected
+
+
+def test_money_json():
+    amount = Money.from_json({"unit": "USD", "value": 12.34})
+    assert amount == Money(123400, "USD")
+    assert amount.to_json() == {"unit": "USD", "value": 12.34}
+    with pytest.raises(ValueError):
+        Money.from_json({"unit": "EUR", "value": 1})
+
+
+def test_money_sum_is_exact(monkeypatch):
+    amounts = [Money.from_value(0.1)] * 10000 + [None]
+    assert Money.sum(amounts) == Money.from_value(1000)
+    assert sum(amount.to_json()["value"] for amount in amounts[:-1]) != 1000
+
+    monkeypatch.setitem(money.MINOR_UNIT_EXPONENTS, "EUR", 2)
+    with pytest.raises(ValueError):
+        Money.sum([Money(1, "USD"), Money(1, "EUR")])
+
+
+def test_props_cost_fields():
+    batch = Batch(id="BAT000001", props={
+        "cost_per_case": {"unit": "USD", "value": 1.5}, "count_per_case": 10})
+    assert batch.props.cost_per_case == Money(15000, "USD")
+    assert batch.to_dict(mask_default=True)["props"] == {
+        "cost_per_case": {"unit": "USD", "value": 1.5}, "count_per_case": 10}
+
+    doc = batch.to_mongodb_doc()
+    assert doc["props"]["cost_per_case"] == {"unit": "USD", "value": Decimal128("1.5000")}
+    assert Batch.from_mongodb_doc(bson.decode(bson.encode(doc))) == batch
+
+    # documents written by the old float codec
+    legacy = Props.from_mongodb_doc(
+        {"cost_per_case": {"unit": "USD", "value": Decimal128("12.34")}})
+    assert legacy.cost_per_case == Money(123400, "USD")
+
+
+def test_props_schema_rejects_unstorable_costs():
+    assert props_schema({"cost_per_case": {"unit": "USD", "value": 12.3456}})
+    for value in (1e40, 10**40, 0.00001, float("inf")):
+        with pytest.raises(MultipleInvalid):
+            props_schema({"cost_per_case": {"unit": "USD", "value": value}})
@@ -0,0 +1,64 @@
+import multiprocessing
+
+from inventorius.shared_cache import SharedTable, key_bytes
+
+
+def open_table(tmp_path, slot_count=64, slot_size=256):
+    return SharedTable(str(tmp_path / "cache"), slot_count, slot_size)
+
+
+def test_put_get_invalidate(tmp_path):
+    table = open_table(tmp_path)
+    key = key_bytes("testing", "sku", "SKU000001")
+    assert table.get(key) is None
+    table.put(key, b"doc", 60, table.generation())
+    assert table.get(key) == b"doc"
+    table.put(key, b"new doc", 60, table.generation())
+    assert table.get(key) == b"new doc"
+    table.invalidate([key])
+    assert table.get(key) is None
+
+
+def test_oversized_and_expired_values_are_misses(tmp_path):
+    table = open_table(tmp_path)
+    key = key_bytes("testing", "sku", "SKU000001")
+    table.put(key, b"x" * 256, 60, table.generation())
+    assert table.get(key) is None
+    table.put(key, b"doc", 0, table.generation())
+    assert table.get(key) is None
+
+
+def test_read_racing_invalidation_is_not_stored(tmp_path):
+    table = open_table(tmp_path)
+    key = key_bytes("testing", "sku", "SKU000001")
+    generation = table.generation()
+    table.invalidate([key])
+    table.put(key, b"old doc", 60, generation)
+    assert table.get(key) is None
+
+
+def test_invalidate_prefix(tmp_path):
+    table = open_table(tmp_path)
+    sku = key_bytes("testing", "sku", "SKU000001")
+    bin = key_bytes("testing", "bin", "BIN000001")
+    table.put(sku, b"sku", 60, table.generation())
+    table.put(bin, b"bin", 60, table.generation())
+    table.invalidate_prefix(key_bytes("testing", "sku", ""))
+    assert table.get(sku) is None
+    assert table.get(bin) == b"bin"
+
+
+def fill_from_other_process(path, key):
+    table = SharedTable(path, 64, 256)
+    table.put(key, b"doc", 60, table.generation())
+
+
+def test_shared_between_processes(tmp_path):
+    table = open_table(tmp_path)
+    key = key_bytes("testing", "sku", "SKU000001")
+    other = multiprocessing.get_context("fork").Process(
+        target=fill_from_other_process, args=(table.path, key))
+    other.start()
+    other.join(10)
+    assert other.exitcode == 0
+    assert table.get(key) == b"doc"